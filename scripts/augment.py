@@ -0,0 +1,251 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scripts import constants as const
+from scripts.manifest import pixel_stats
+from scripts.decode import decode_image, get_backend
+from scripts.lazy import lazy_import
+from scripts.instrument import instrument
+
+pd = lazy_import("pandas")
+cv2 = lazy_import("cv2")
+
+
+def random_affine(rng, width, height, params):
+    """
+    Draw one random affine transform combining flip, rotation, crop, zoom, translation and shear.
+
+    Parameters:
+        rng (np.random.Generator): The random generator.
+        width (int): The image width.
+        height (int): The image height.
+        params (dict): The augmentation parameters of the Augmenter.
+
+    Returns:
+        np.ndarray: The 2x3 affine matrix mapping source to output coordinates.
+    """
+    # Flip horizontally and/or vertically
+    flip_x = -1.0 if params["flip"] and rng.random() < 0.5 else 1.0
+    flip_y = -1.0 if params["flip"] and rng.random() < 0.5 else 1.0
+
+    # Rotation is a fraction of a full turn, as in keras.layers.RandomRotation
+    angle = rng.uniform(-params["rotation"], params["rotation"]) * 2 * np.pi
+
+    # A random crop of the given fraction is a zoom-in with a random offset
+    crop = rng.uniform(params["crop"], 1.0)
+    zoom = rng.uniform(1 - params["zoom"], 1 + params["zoom"]) / crop
+    crop_x = rng.uniform(-0.5, 0.5) * (1 - crop) * width
+    crop_y = rng.uniform(-0.5, 0.5) * (1 - crop) * height
+
+    shear = rng.uniform(-params["shear"], params["shear"])
+    shift_x = rng.uniform(-params["translate"], params["translate"]) * width
+    shift_y = rng.uniform(-params["translate"], params["translate"]) * height
+
+    # Compose the linear part around the image centre
+    cos, sin = np.cos(angle), np.sin(angle)
+    linear = (
+        np.array([[cos, -sin], [sin, cos]])
+        @ np.array([[1.0, shear], [0.0, 1.0]])
+        @ np.diag([zoom * flip_x, zoom * flip_y])
+    )
+    centre = np.array([width / 2, height / 2])
+    offset = centre - linear @ (centre + [crop_x, crop_y]) + [shift_x, shift_y]
+
+    return np.hstack([linear, offset[:, None]])
+
+
+def augment_batch(images, rng, params):
+    """
+    Apply random augmentations to a batch of images of the same shape.
+
+    Parameters:
+        images (np.ndarray): The uint8 batch of shape (N, H, W, C).
+        rng (np.random.Generator): The random generator.
+        params (dict): The augmentation parameters of the Augmenter.
+
+    Returns:
+        np.ndarray: The augmented uint8 batch.
+    """
+    count, height, width = images.shape[:3]
+    output = np.empty_like(images)
+
+    # One warp per image applies every geometric transform at once
+    for i in range(count):
+        matrix = random_affine(rng, width, height, params)
+        output[i] = cv2.warpAffine(
+            images[i],
+            matrix,
+            (width, height),
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_REFLECT_101,
+        )
+
+    # Scale the contrast around each image mean. addWeighted saturates to uint8 in place,
+    # without the float copy of the batch, and releases the GIL for threaded loaders.
+    factors = rng.uniform(1 - params["contrast"], 1 + params["contrast"], size=count)
+    means = output.mean(axis=(1, 2, 3), dtype=np.float32)
+    for i in range(count):
+        cv2.addWeighted(
+            output[i], factors[i], output[i], 0.0, means[i] * (1 - factors[i]), dst=output[i]
+        )
+
+    return output
+
+
+def augment_file(image_path, num_images, output_dir, rng, params, quality=95):
+    """
+    Write augmented copies of an image and describe them as manifest rows.
+
+    Parameters:
+        image_path (str): The path to the image file.
+        num_images (int): The number of augmented images to generate.
+        output_dir (str): The directory to save the augmented images.
+        rng (np.random.Generator): The random generator.
+        params (dict): The augmentation parameters of the Augmenter.
+        quality (int): The JPEG quality of the augmented images. Default is 95.
+
+    Returns:
+        list of tuple: The manifest row of every augmented image.
+    """
+    # OpenCV writes the augmented images, so they stay in BGR order
+    img = decode_image(image_path, mode="BGR")
+
+    # Extract the category and style from the image path
+    path_parts = os.path.normpath(image_path).split(os.path.sep)
+    category, style = path_parts[-3], path_parts[-2]
+    image_filename = os.path.splitext(os.path.basename(image_path))[0]
+
+    # Augment every copy of the image as one batch
+    batch = augment_batch(np.repeat(img[None], num_images, axis=0), rng, params)
+
+    rows = []
+    for i, augmented_img in enumerate(batch):
+        output_path = os.path.join(output_dir, f"aug_{image_filename}_{i}.jpg")
+        if not cv2.imwrite(output_path, augmented_img, [cv2.IMWRITE_JPEG_QUALITY, quality]):
+            raise OSError(f"Could not write the augmented image: {output_path}")
+
+        rows.append(
+            (output_path, category, style, augmented_img.shape[1], augmented_img.shape[0])
+            + pixel_stats(augmented_img)
+        )
+
+    return rows
+
+
+def _augment_safe(task):
+    """Augment one image inside a worker process, returning the error instead of raising it."""
+    image_path, num_images, output_dir, seed, index, params, quality = task
+    try:
+        # Seeding by position keeps the output independent of the worker scheduling
+        rng = np.random.default_rng([seed, index])
+        return augment_file(image_path, num_images, output_dir, rng, params, quality)
+    except Exception as e:
+        return e
+
+
+class Augmenter:
+    def __init__(
+        self,
+        rotation=0.4,
+        zoom=0.3,
+        translate=0.2,
+        shear=0.1,
+        crop=0.8,
+        contrast=0.2,
+        flip=True,
+        quality=95,
+        seed=42,
+        workers=None,
+        chunk_size=4,
+        mp_context=None,
+    ):
+        """
+        Batched augmentation engine writing the augmented images of many files in parallel.
+
+        Parameters:
+            rotation (float): Maximum rotation as a fraction of a full turn. Default is 0.4.
+            zoom (float): Maximum zoom factor. Default is 0.3.
+            translate (float): Maximum translation as a fraction of the image size. Default is 0.2.
+            shear (float): Maximum shear factor. Default is 0.1.
+            crop (float): Minimum fraction of the image kept by the random crop. Default is 0.8.
+            contrast (float): Maximum contrast factor. Default is 0.2.
+            flip (bool): Whether to flip horizontally and vertically at random. Default is True.
+            quality (int): The JPEG quality of the augmented images. Default is 95.
+            seed (int): The seed making the augmentations reproducible. Default is 42.
+            workers (int): Number of worker processes. Default is the number of CPUs.
+            chunk_size (int): Number of files submitted to a worker at once. Default is 4.
+            mp_context (multiprocessing.context.BaseContext): The start method of the worker processes.
+                Default is None (the platform default).
+        """
+        self.params = {
+            "rotation": rotation,
+            "zoom": zoom,
+            "translate": translate,
+            "shear": shear,
+            "crop": crop,
+            "contrast": contrast,
+            "flip": flip,
+        }
+        self.quality = quality
+        self.seed = seed
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.mp_context = mp_context
+
+    def augment_many(self, image_paths, counts, output_dir=None, offset=0):
+        """
+        Augment every image the number of times given by the oversampling plan.
+
+        Parameters:
+            image_paths (list of str): The paths to the image files.
+            counts (list of int): The number of augmented images to generate per path.
+            output_dir (str): The directory to save the augmented images. Default is the directory of each image.
+            offset (int): The position of the first path in the whole plan, so that a plan
+                augmented in chunks gets the same images as in one call. Default is 0.
+
+        Returns:
+            pd.DataFrame: The manifest rows of the augmented images.
+        """
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        tasks = [
+            (
+                image_path,
+                int(count),
+                output_dir or os.path.dirname(image_path),
+                self.seed,
+                offset + index,
+                self.params,
+                self.quality,
+            )
+            for index, (image_path, count) in enumerate(zip(image_paths, counts))
+            if count > 0
+        ]
+
+        if self.workers <= 1 or len(tasks) <= self.chunk_size:
+            results = [_augment_safe(task) for task in tasks]
+        else:
+            # The workers inherit or read the decode backend of this host
+            get_backend()
+            with ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=self.mp_context
+            ) as executor:
+                results = list(
+                    executor.map(_augment_safe, tasks, chunksize=self.chunk_size)
+                )
+
+        # Gather every new row and build the DataFrame once
+        rows = []
+        for task, result in zip(tasks, results):
+            if isinstance(result, Exception):
+                print(f"Error augmenting image '{task[0]}': {result}")
+                instrument.count("decode_failures")
+                continue
+            instrument.count("files_processed")
+            rows.extend(result)
+
+        instrument.count("images_written", len(rows))
+        instrument.count_bytes(task[0] for task in tasks)
+
+        return pd.DataFrame(rows, columns=const.MANIFEST_COLUMNS)
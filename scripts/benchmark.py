@@ -0,0 +1,422 @@
+import os
+import io
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+from contextlib import redirect_stdout
+import numpy as np
+from scripts.synthetic import DatasetGenerator
+from scripts.recommender import RecommenderIndex
+from scripts.loader import AugmentingLoader
+from scripts.leon import Leon
+
+try:
+    import resource
+except ImportError:
+    # Unix only, the peak RSS is then reported as 0
+    resource = None
+
+# Size of the random feature vectors of the recommendation benchmark
+FEATURE_DIM = 512
+NUM_QUERIES = 256
+
+
+def case_get_image_paths(leon, raw_dir, work_dir):
+    """List the images of the dataset."""
+    count = len(leon.get_image_paths(raw_dir))
+    return lambda: leon.get_image_paths(raw_dir), count
+
+
+def case_load_data_frame(leon, raw_dir, work_dir):
+    """Build the manifest of the dataset, without the cache."""
+    count = len(leon.get_image_paths(raw_dir))
+    return lambda: leon.load_data_frame(raw_dir), count
+
+
+def case_detect_duplicates(leon, raw_dir, work_dir):
+    """Find the near duplicates of the dataset with perceptual hashes."""
+    count = len(leon.get_image_paths(raw_dir))
+    return (
+        lambda: leon.detect_duplicates(raw_dir, "phash", limit=-1, max_distance=4),
+        count,
+    )
+
+
+def case_detect_duplicates_ssim(leon, raw_dir, work_dir):
+    """Find the duplicates of the dataset with perceptual hashes verified by SSIM."""
+    count = len(leon.get_image_paths(raw_dir))
+    return lambda: leon.detect_duplicates(raw_dir, "ssim", limit=-1), count
+
+
+def copy_dataset(raw_dir, work_dir, name):
+    """Copy the dataset so that a benchmark can modify it."""
+    copy_dir = os.path.join(work_dir, name)
+    if os.path.exists(copy_dir):
+        shutil.rmtree(copy_dir)
+    shutil.copytree(raw_dir, copy_dir)
+    return copy_dir
+
+
+def case_resize_image(leon, raw_dir, work_dir):
+    """Resize the images of a copy of the dataset one by one."""
+    paths = leon.get_image_paths(copy_dataset(raw_dir, work_dir, "resize_image"))
+
+    def run():
+        for path in paths:
+            leon.resize_image(path, 128, 128)
+
+    return run, len(paths)
+
+
+def case_resize_many(leon, raw_dir, work_dir):
+    """Resize the images of a copy of the dataset in parallel."""
+    paths = leon.get_image_paths(copy_dataset(raw_dir, work_dir, "resize_many"))
+    return lambda: leon.resize_many(paths, 128, 128), len(paths)
+
+
+def case_normalize_image(leon, raw_dir, work_dir):
+    """Normalize the images one by one."""
+    paths = leon.get_image_paths(raw_dir)
+
+    def run():
+        for path in paths:
+            leon.normalize_image(path, verbose=False)
+
+    return run, len(paths)
+
+
+def case_augment_images(leon, raw_dir, work_dir):
+    """Augment every image once."""
+    paths = leon.get_image_paths(raw_dir)
+    output_dir = os.path.join(work_dir, "augmented")
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+
+    return (
+        lambda: leon.augment_images(paths, [1] * len(paths), output_dir=output_dir),
+        len(paths),
+    )
+
+
+def case_augmenting_loader(leon, raw_dir, work_dir):
+    """Load one oversampled epoch, augmenting in memory."""
+    df = leon.load_data_frame(raw_dir)
+    loader = AugmentingLoader(df, leon.plan_oversampling(df), batch_size=32)
+
+    def run():
+        for _ in loader:
+            pass
+
+    return run, loader.samples
+
+
+def case_image_data_generator(leon, raw_dir, work_dir):
+    """Load one epoch with ImageDataGenerator.flow_from_dataframe, for comparison with the loader."""
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    df = leon.load_data_frame(raw_dir)
+    flow = ImageDataGenerator(rescale=1.0 / 255).flow_from_dataframe(
+        dataframe=df,
+        x_col="Path",
+        y_col="Style",
+        batch_size=32,
+        class_mode="categorical",
+        target_size=(256, 256),
+        shuffle=True,
+    )
+
+    def run():
+        for i in range(len(flow)):
+            flow[i]
+
+    return run, len(df)
+
+
+def case_recommend(leon, raw_dir, work_dir):
+    """Rank the items of the same category for a batch of queries."""
+    df = leon.load_data_frame(raw_dir)
+    rng = np.random.default_rng(42)
+
+    vectors = rng.standard_normal((len(df), FEATURE_DIM), dtype=np.float32)
+    index = RecommenderIndex().build(vectors, df["Path"], df["Category"])
+
+    rows = rng.integers(len(df), size=NUM_QUERIES)
+    queries = vectors[rows]
+    categories = df["Category"].to_numpy()[rows]
+    exclude_paths = df["Path"].to_numpy()[rows]
+
+    return lambda: index.query(queries, categories, k=10, exclude_paths=exclude_paths), NUM_QUERIES
+
+
+# Benchmark cases: setup functions returning the timed callable and the number of items it processes
+CASES = {
+    "get_image_paths": case_get_image_paths,
+    "load_data_frame": case_load_data_frame,
+    "detect_duplicates": case_detect_duplicates,
+    "detect_duplicates_ssim": case_detect_duplicates_ssim,
+    "resize_image": case_resize_image,
+    "resize_many": case_resize_many,
+    "normalize_image": case_normalize_image,
+    "augment_images": case_augment_images,
+    "augmenting_loader": case_augmenting_loader,
+    "image_data_generator": case_image_data_generator,
+    "recommend": case_recommend,
+}
+
+
+def peak_rss_mb(children=False):
+    """Get the peak resident set size of this process or of its children, in MiB, or 0 where unknown."""
+    if resource is None:
+        return 0.0
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    usage = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return usage / (1 << 20) if sys.platform == "darwin" else usage / (1 << 10)
+
+
+def run_case(name, raw_dir, work_dir, repeat=1):
+    """
+    Run a benchmark case in the current process.
+
+    Peak RSS is per process, so run_case is meant to run in a fresh interpreter.
+
+    Parameters:
+        name (str): The name of the case, a key of CASES.
+        raw_dir (str): The raw directory of the dataset.
+        work_dir (str): A scratch directory for the files the case writes.
+        repeat (int): Number of timed runs, the fastest is reported. Default is 1.
+
+    Returns:
+        dict: The seconds, items, items per second and peak RSS of the case.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    leon = Leon()
+
+    # Keep the console output of the methods out of the report
+    with redirect_stdout(io.StringIO()):
+        timings = []
+        for _ in range(repeat):
+            try:
+                run, items = CASES[name](leon, raw_dir, work_dir)
+            except ImportError as e:
+                # Cases of optional dependencies, such as TensorFlow
+                return {"case": name, "skipped": str(e)}
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+
+    seconds = min(timings)
+    return {
+        "case": name,
+        "seconds": seconds,
+        "items": items,
+        "items_per_second": items / seconds if seconds else float("inf"),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_child_rss_mb": peak_rss_mb(children=True),
+    }
+
+
+class BenchmarkSuite:
+    def __init__(
+        self,
+        data_root,
+        sizes=(500, 2000),
+        cases=None,
+        width=256,
+        height=256,
+        duplicate_rate=0.05,
+        repeat=1,
+        seed=42,
+    ):
+        """
+        Offline benchmarks of the Leon methods on synthetic datasets of several sizes.
+
+        Every case runs in a fresh interpreter, so that its peak RSS and import cost are its own.
+
+        Parameters:
+            data_root (str): The directory of the synthetic datasets and scratch files.
+            sizes (list of int): Number of images of every dataset. Default is (500, 2000).
+            cases (list of str): The cases to run. Default is all of CASES.
+            width (int): The width of the synthetic images. Default is 256.
+            height (int): The height of the synthetic images. Default is 256.
+            duplicate_rate (float): Fraction of duplicate images. Default is 0.05.
+            repeat (int): Number of timed runs of every case, the fastest is reported. Default is 1.
+            seed (int): The seed of the datasets. Default is 42.
+        """
+        self.data_root = data_root
+        self.sizes = list(sizes)
+        self.cases = list(cases or CASES)
+        self.width = width
+        self.height = height
+        self.duplicate_rate = duplicate_rate
+        self.repeat = repeat
+        self.seed = seed
+
+        unknown = set(self.cases) - set(CASES)
+        if unknown:
+            raise ValueError(f"Unknown cases: {', '.join(sorted(unknown))}")
+
+    def run(self):
+        """
+        Generate the datasets and run every case at every size.
+
+        Returns:
+            dict: The environment and the result of every case and size.
+        """
+        results = []
+        for size in self.sizes:
+            data_dir = os.path.join(self.data_root, f"data_{size}")
+            generator = DatasetGenerator(
+                num_images=size,
+                width=self.width,
+                height=self.height,
+                duplicate_rate=self.duplicate_rate,
+                seed=self.seed,
+            )
+            raw_dir = generator.generate(data_dir)["raw_dir"]
+
+            for name in self.cases:
+                result = self.run_isolated(name, raw_dir, os.path.join(data_dir, "work"))
+                result["size"] = size
+                results.append(result)
+
+                if "skipped" in result:
+                    print(f">>> {name:<24} {size:>7} images  skipped ({result['skipped']})")
+                    continue
+                print(
+                    f">>> {name:<24} {size:>7} images  {result['seconds']:>8.3f}s  "
+                    f"{result['items_per_second']:>10.1f} items/s  {result['peak_rss_mb']:>7.1f} MiB"
+                )
+
+            shutil.rmtree(os.path.join(data_dir, "work"), ignore_errors=True)
+
+        return {
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "results": results,
+        }
+
+    def run_isolated(self, name, raw_dir, work_dir):
+        """Run a case in a fresh interpreter and parse its JSON result."""
+        completed = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "scripts.benchmark",
+                "--run-case",
+                name,
+                "--raw-dir",
+                raw_dir,
+                "--work-dir",
+                work_dir,
+                "--repeat",
+                str(self.repeat),
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(f"Benchmark {name} failed:\n{completed.stderr}")
+
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare benchmark results with a baseline.
+
+    Parameters:
+        results (dict): The results of BenchmarkSuite.run.
+        baseline (dict): The baseline results, in the same format.
+        tolerance (float): Relative slowdown or memory growth tolerated. Default is 0.2.
+
+    Returns:
+        list of str: The description of every regression.
+    """
+    reference = {(r["case"], r["size"]): r for r in baseline["results"]}
+
+    regressions = []
+    for result in results["results"]:
+        base = reference.get((result["case"], result["size"]))
+        if base is None or "skipped" in result or "skipped" in base:
+            continue
+
+        label = f"{result['case']} @ {result['size']}"
+        if result["items_per_second"] < base["items_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{label}: {result['items_per_second']:.1f} items/s "
+                f"(baseline {base['items_per_second']:.1f})"
+            )
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(
+                f"{label}: peak RSS {result['peak_rss_mb']:.1f} MiB "
+                f"(baseline {base['peak_rss_mb']:.1f})"
+            )
+
+    return regressions
+
+
+def main():
+    """Run the benchmark suite from the command line."""
+    parser = argparse.ArgumentParser(description="Benchmark the Leon methods on synthetic data.")
+    parser.add_argument("--data-root", default="benchmark_data", help="Directory of the synthetic datasets.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 2000])
+    parser.add_argument("--cases", nargs="+", default=None, choices=list(CASES))
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--duplicate-rate", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="Compare with the results of this JSON file.")
+    parser.add_argument("--save-baseline", default=None, help="Write the results as a new baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    # Internal: run a single case in this interpreter
+    parser.add_argument("--run-case", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--raw-dir", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.raw_dir, args.work_dir, args.repeat)))
+        return
+
+    suite = BenchmarkSuite(
+        args.data_root,
+        sizes=args.sizes,
+        cases=args.cases,
+        width=args.width,
+        height=args.height,
+        duplicate_rate=args.duplicate_rate,
+        repeat=args.repeat,
+    )
+    results = suite.run()
+
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        if regressions:
+            print(">>> Regressions:")
+            for regression in regressions:
+                print(f"    {regression}")
+            sys.exit(1)
+        print(">>> No regression")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+import os
+import threading
+import pickle
+import shutil
+import sqlite3
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scripts.zip_source import split_archive_path, read_bytes, file_signature
+from scripts.scanner import Scanner
+
+
+def file_key(path):
+    """
+    Get the identity of the content of a file: hard links to the same file share it.
+
+    Parameters:
+        path (str): The file path, possibly inside a ZIP archive.
+
+    Returns:
+        tuple or str: The device and inode of the file, or the path itself for archive members and missing files.
+    """
+    if split_archive_path(path) is not None:
+        return path
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+
+    return stat.st_dev, stat.st_ino
+
+
+def unique_files(paths):
+    """
+    Group the paths that are hard links to the same file, so that it is processed once.
+
+    Parameters:
+        paths (list of str): The file paths.
+
+    Returns:
+        tuple: The index of one path per unique file, and the position of the file of every path in that list.
+    """
+    positions = {}
+    representatives = []
+    inverse = np.empty(len(paths), dtype=np.int64)
+
+    for index, path in enumerate(paths):
+        position = positions.setdefault(file_key(path), len(representatives))
+        if position == len(representatives):
+            representatives.append(index)
+        inverse[index] = position
+
+    return representatives, inverse
+
+
+def map_unique(paths, compute):
+    """
+    Compute a result once per unique file and share it between the hard links to the file.
+
+    Parameters:
+        paths (list of str): The file paths.
+        compute (function): Computes the results of a list of paths, in order.
+
+    Returns:
+        list: The result of every path.
+    """
+    representatives, inverse = unique_files(paths)
+
+    # Nothing to share, skip the copies
+    if len(representatives) == len(paths):
+        return compute(paths)
+
+    results = compute([paths[i] for i in representatives])
+
+    return [results[i] for i in inverse]
+
+
+def content_digest(path):
+    """
+    Hash the content of a file.
+
+    Parameters:
+        path (str): The file path, possibly inside a ZIP archive.
+
+    Returns:
+        str: The SHA-256 hex digest of the content.
+    """
+    if split_archive_path(path) is not None:
+        return hashlib.sha256(read_bytes(path)).hexdigest()
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def link_replace(source, target):
+    """
+    Atomically replace a file with a hard link to another one.
+
+    Parameters:
+        source (str): The file to link to.
+        target (str): The path to replace.
+    """
+    # Unique per process and thread, as links are replaced from thread pools
+    temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.link"
+    os.link(source, temp_path)
+    try:
+        os.replace(temp_path, target)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class BlobStore:
+    def __init__(self, root, workers=8):
+        """
+        Content-addressed store of the images of several dataset trees.
+
+        Every unique image content is stored once as a blob named by its SHA-256. The
+        dataset trees become hard links to the blobs, and results derived from an image
+        (statistics, hashes, resized files) are computed once per blob and shared.
+
+        Hard-linked files share their content: files must be replaced (written to a
+        temporary file, then os.replace) rather than modified in place, as resize does.
+
+        Parameters:
+            root (str): The directory of the store.
+            workers (int): Number of hashing threads. Default is 8.
+        """
+        self.root = root
+        self.workers = workers
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+
+        self.connection = sqlite3.connect(os.path.join(root, "index.sqlite"))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                digest TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS derived (
+                kind TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (kind, digest)
+            );
+            """
+        )
+        self.connection.commit()
+
+    def blob_path(self, digest, ext=".jpg"):
+        """Get the path of the blob of a digest."""
+        return os.path.join(self.root, "blobs", digest[:2], digest + ext)
+
+    def derived_path(self, kind, digest, ext=".jpg"):
+        """Get the path of a file derived from a blob, such as its resized version."""
+        return os.path.join(self.root, "derived", kind, digest[:2], digest + ext)
+
+    def digests(self, paths):
+        """
+        Get the content digest of files, only hashing the new or modified ones.
+
+        Parameters:
+            paths (list of str): The file paths, possibly inside ZIP archives.
+
+        Returns:
+            list of str: The digest of every path, or None if it cannot be read.
+        """
+        keys = [os.path.abspath(path) for path in paths]
+        signatures = []
+        for path in paths:
+            try:
+                if split_archive_path(path) is not None:
+                    size, version = file_signature(path)
+                    signatures.append((size, version, 0))
+                else:
+                    stat = os.stat(path)
+                    signatures.append((stat.st_size, stat.st_mtime_ns, stat.st_ino))
+            except (OSError, KeyError):
+                signatures.append(None)
+
+        known = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            query = f"SELECT * FROM files WHERE path IN ({','.join('?' * len(chunk))})"
+            for row in self.connection.execute(query, chunk):
+                known[row[0]] = row[1:]
+
+        digests = [None] * len(paths)
+        stale = []
+        for index, (key, signature) in enumerate(zip(keys, signatures)):
+            if signature is None:
+                continue
+            row = known.get(key)
+            if row is not None and tuple(row[:3]) == signature:
+                digests[index] = row[3]
+            else:
+                stale.append(index)
+
+        # hashlib releases the GIL on large buffers, so threads hash in parallel
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            hashed = list(executor.map(self._digest_safe, [paths[i] for i in stale]))
+
+        upserts = []
+        for index, digest in zip(stale, hashed):
+            if digest is None:
+                continue
+            digests[index] = digest
+            upserts.append((keys[index], *signatures[index], digest))
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", upserts
+        )
+        self.connection.commit()
+
+        return digests
+
+    @staticmethod
+    def _digest_safe(path):
+        """Hash a file, returning None if it cannot be read."""
+        try:
+            return content_digest(path)
+        except (OSError, KeyError):
+            return None
+
+    def add(self, dir, link=True):
+        """
+        Add the images of a dataset tree to the store.
+
+        Parameters:
+            dir (str): The dataset directory, such as data_1/raw.
+            link (bool): Whether to replace the files by hard links to the blobs. If False,
+                or if the store is on another file system, the blobs are copies and only the
+                index is shared. Default is True.
+
+        Returns:
+            dict: The number of files, new blobs and linked files, and the bytes saved.
+        """
+        if not os.path.isdir(dir):
+            raise NotADirectoryError(f"Not a dataset directory: {dir}")
+
+        paths = Scanner(stat=False).paths(dir)
+
+        report = {"files": len(paths), "new_blobs": 0, "linked": 0, "bytes_saved": 0}
+
+        for path, digest in zip(paths, self.digests(paths)):
+            if digest is None:
+                continue
+
+            blob = self.blob_path(digest, os.path.splitext(path)[1].lower())
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    # The file itself becomes the blob
+                    os.link(path, blob)
+                except OSError:
+                    shutil.copy2(path, blob)
+                report["new_blobs"] += 1
+                continue
+
+            if not link or os.path.samefile(path, blob):
+                continue
+
+            size = os.path.getsize(path)
+            try:
+                link_replace(blob, path)
+            except OSError:
+                # Another file system: keep the copy, the index still shares derived results
+                continue
+            report["linked"] += 1
+            report["bytes_saved"] += size
+
+        # Links change the inode and mtime of the files, refresh their index rows
+        self.digests(paths)
+
+        return report
+
+    def cached(self, kind, paths, compute):
+        """
+        Compute a result once per unique content, reusing the results stored for earlier files.
+
+        Parameters:
+            kind (str): The kind of result, such as "describe_1" or "phash". Results of different kinds never mix.
+            paths (list of str): The file paths.
+            compute (function): Computes the results of a list of paths, returning an exception in place of a failed result.
+
+        Returns:
+            list: The result of every path, or the exception raised for it.
+        """
+        digests = self.digests(paths)
+        unique = sorted({digest for digest in digests if digest is not None})
+
+        known = {}
+        for start in range(0, len(unique), 500):
+            chunk = unique[start : start + 500]
+            query = (
+                f"SELECT digest, value FROM derived WHERE kind = ? "
+                f"AND digest IN ({','.join('?' * len(chunk))})"
+            )
+            for digest, value in self.connection.execute(query, [kind, *chunk]):
+                known[digest] = pickle.loads(value)
+
+        # One path per missing content
+        missing = {}
+        for path, digest in zip(paths, digests):
+            if digest is not None and digest not in known:
+                missing.setdefault(digest, path)
+
+        results = compute(list(missing.values())) if missing else []
+
+        inserts = []
+        for digest, result in zip(missing, results):
+            known[digest] = result
+            if not isinstance(result, Exception):
+                inserts.append((kind, digest, pickle.dumps(result)))
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO derived VALUES (?, ?, ?)", inserts
+        )
+        self.connection.commit()
+
+        return [
+            known[digest] if digest is not None else FileNotFoundError(path)
+            for path, digest in zip(paths, digests)
+        ]
+
+    def stats(self):
+        """
+        Get the size of the store.
+
+        Returns:
+            dict: The number of indexed files, unique blobs and their total bytes.
+        """
+        files = self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        blobs = 0
+        size = 0
+        for root, _, names in os.walk(os.path.join(self.root, "blobs")):
+            for name in names:
+                blobs += 1
+                size += os.path.getsize(os.path.join(root, name))
+
+        return {"files": files, "blobs": blobs, "blob_bytes": size}
+
+    def collect_garbage(self):
+        """
+        Remove the blobs no dataset file links to anymore, and the index rows of deleted files.
+
+        Returns:
+            int: The number of blobs removed.
+        """
+        missing = [
+            (path,)
+            for (path,) in self.connection.execute("SELECT path FROM files")
+            if not os.path.exists(path)
+        ]
+        self.connection.executemany("DELETE FROM files WHERE path = ?", missing)
+        self.connection.commit()
+
+        removed = 0
+        for root, _, names in os.walk(os.path.join(self.root, "blobs")):
+            for name in names:
+                path = os.path.join(root, name)
+                # A blob only linked from the store is no longer part of any tree
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+
+        return removed
+
+    def close(self):
+        """Close the index."""
+        self.connection.close()
@@ -18,3 +18,46 @@ TEST_DATA_DIR = "test"
 # System Constants
 IS_TRAIN = False
 IS_COLAB_UNZIP = False
+
+# Manifest constants
+MANIFEST_COLUMNS = [
+    "Path",
+    "Category",
+    "Style",
+    "Width",
+    "Height",
+    "MinValue",
+    "MaxValue",
+    "StdDev",
+]
+MANIFEST_CHUNK_SIZE = 64
+
+# Image file extensions, matched case-insensitively
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# Files generated next to the raw images by the augmentation and the normalization
+AUGMENTED_PREFIX = "aug_"
+NORMALIZED_SUFFIX = "_norm.jpg"
+
+# Model constants
+CLASS_LABELS = ["beds", "chairs", "dressers", "lamps", "sofas", "tables"]
+STYLE_LABELS = [
+    "Asian",
+    "Beach",
+    "Contemporary",
+    "Craftsman",
+    "Eclectic",
+    "Farmhouse",
+    "Industrial",
+    "Mediterranean",
+    "Midcentury",
+    "Modern",
+    "Rustic",
+    "Scandinavian",
+    "Southwestern",
+    "Traditional",
+    "Transitional",
+    "Tropical",
+    "Victorian",
+]
+IMAGE_SIZE = (256, 256)
@@ -0,0 +1,449 @@
+import io
+import os
+import sys
+import json
+import time
+import tempfile
+import platform
+import threading
+import argparse
+import numpy as np
+from PIL import Image
+from scripts.zip_source import read_bytes
+from scripts.lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+
+# Channel layouts of the decoded arrays
+MODES = ("RGB", "BGR", "L")
+
+# Reduced-scale factors of the JPEG DCT decoders, largest first
+SCALE_FACTORS = (8, 4, 2)
+
+# The backend chosen by the micro-benchmark, per host
+CHOICE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "leon", "decode_backend.json")
+
+
+def scale_factor(width, height, min_size):
+    """
+    Get the largest reduced-scale factor that keeps an image at least min_size.
+
+    Parameters:
+        width (int): The width of the image.
+        height (int): The height of the image.
+        min_size (tuple): The minimum (width, height) of the decoded image.
+
+    Returns:
+        int: The factor, 1, 2, 4 or 8.
+    """
+    for factor in SCALE_FACTORS:
+        if -(-width // factor) >= min_size[0] and -(-height // factor) >= min_size[1]:
+            return factor
+    return 1
+
+
+def image_size(data):
+    """
+    Read the (width, height) of an encoded image from its header, without decoding the pixels.
+
+    Parameters:
+        data (bytes): The encoded image.
+
+    Returns:
+        tuple: The width and height.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        return image.size
+
+
+class PILBackend:
+    name = "pil"
+
+    @staticmethod
+    def available():
+        return True
+
+    def decode(self, data, size=None, min_size=None, mode="RGB"):
+        """
+        Decode an image with PIL, letting the JPEG decoder skip the scales that are not needed.
+
+        Parameters:
+            data (bytes): The encoded image.
+            size (tuple): The exact (width, height) of the array. Default is None (decoded size).
+            min_size (tuple): The minimum (width, height) of a reduced-scale decode. Default is None (full scale).
+            mode (str): "RGB", "BGR" or "L". Default is "RGB".
+
+        Returns:
+            tuple: The uint8 array and the (width, height) of the original image.
+        """
+        pil_mode = "L" if mode == "L" else "RGB"
+
+        with Image.open(io.BytesIO(data)) as image:
+            original_size = image.size
+
+            if min_size is not None:
+                if image.format == "JPEG":
+                    image.draft(pil_mode, min_size)
+                else:
+                    factor = scale_factor(*original_size, min_size)
+                    if factor > 1:
+                        image = image.reduce(factor)
+
+            image = image.convert(pil_mode)
+            if size is not None and image.size != tuple(size):
+                image = image.resize(tuple(size))
+
+            array = np.asarray(image)
+
+        if mode == "BGR":
+            array = np.ascontiguousarray(array[..., ::-1])
+
+        return array, original_size
+
+
+class OpenCVBackend:
+    name = "opencv"
+
+    # imdecode flags of every (grayscale, factor) pair
+    FLAGS = {
+        (False, 1): "IMREAD_COLOR",
+        (False, 2): "IMREAD_REDUCED_COLOR_2",
+        (False, 4): "IMREAD_REDUCED_COLOR_4",
+        (False, 8): "IMREAD_REDUCED_COLOR_8",
+        (True, 1): "IMREAD_GRAYSCALE",
+        (True, 2): "IMREAD_REDUCED_GRAYSCALE_2",
+        (True, 4): "IMREAD_REDUCED_GRAYSCALE_4",
+        (True, 8): "IMREAD_REDUCED_GRAYSCALE_8",
+    }
+
+    @staticmethod
+    def available():
+        try:
+            return cv2.imdecode is not None
+        except ImportError:
+            return False
+
+    def decode(self, data, size=None, min_size=None, mode="RGB"):
+        """
+        Decode an image with OpenCV, using its reduced-scale JPEG decoding.
+
+        Parameters:
+            data (bytes): The encoded image.
+            size (tuple): The exact (width, height) of the array. Default is None (decoded size).
+            min_size (tuple): The minimum (width, height) of a reduced-scale decode. Default is None (full scale).
+            mode (str): "RGB", "BGR" or "L". Default is "RGB".
+
+        Returns:
+            tuple: The uint8 array and the (width, height) of the original image.
+        """
+        original_size = None
+        factor = 1
+        if min_size is not None:
+            original_size = image_size(data)
+            factor = scale_factor(*original_size, min_size)
+
+        # PIL ignores the EXIF orientation, so every backend does
+        flag = getattr(cv2, self.FLAGS[(mode == "L", factor)]) | cv2.IMREAD_IGNORE_ORIENTATION
+        array = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+        if array is None:
+            raise ValueError("Unable to decode image")
+
+        if original_size is None:
+            original_size = (array.shape[1], array.shape[0])
+
+        if size is not None and (array.shape[1], array.shape[0]) != tuple(size):
+            array = cv2.resize(array, tuple(size), interpolation=cv2.INTER_AREA)
+
+        if mode == "RGB":
+            array = cv2.cvtColor(array, cv2.COLOR_BGR2RGB)
+
+        return array, original_size
+
+
+class TurboJPEGBackend:
+    name = "turbojpeg"
+
+    def __init__(self):
+        from turbojpeg import TurboJPEG
+
+        self.jpeg = TurboJPEG()
+        self.fallback = PILBackend()
+
+    @staticmethod
+    def available():
+        try:
+            from turbojpeg import TurboJPEG
+
+            TurboJPEG()
+            return True
+        except Exception:
+            # The package is missing, or the libjpeg-turbo library it loads
+            return False
+
+    def decode(self, data, size=None, min_size=None, mode="RGB"):
+        """
+        Decode a JPEG with libjpeg-turbo, falling back to PIL for the other formats.
+
+        Parameters:
+            data (bytes): The encoded image.
+            size (tuple): The exact (width, height) of the array. Default is None (decoded size).
+            min_size (tuple): The minimum (width, height) of a reduced-scale decode. Default is None (full scale).
+            mode (str): "RGB", "BGR" or "L". Default is "RGB".
+
+        Returns:
+            tuple: The uint8 array and the (width, height) of the original image.
+        """
+        import turbojpeg
+
+        # JPEG files start with the SOI marker
+        if data[:2] != b"\xff\xd8":
+            return self.fallback.decode(data, size, min_size, mode)
+
+        width, height, _, _ = self.jpeg.decode_header(data)
+        factor = scale_factor(width, height, min_size) if min_size is not None else 1
+
+        pixel_format = {
+            "RGB": turbojpeg.TJPF_RGB,
+            "BGR": turbojpeg.TJPF_BGR,
+            "L": turbojpeg.TJPF_GRAY,
+        }[mode]
+        array = self.jpeg.decode(data, pixel_format=pixel_format, scaling_factor=(1, factor))
+        if mode == "L":
+            array = array.reshape(array.shape[:2])
+
+        if size is not None and (array.shape[1], array.shape[0]) != tuple(size):
+            array = cv2.resize(array, tuple(size), interpolation=cv2.INTER_AREA)
+
+        return array, (width, height)
+
+
+BACKENDS = {
+    backend.name: backend for backend in (TurboJPEGBackend, OpenCVBackend, PILBackend)
+}
+
+# The backend of the process, chosen on first use
+_backend = None
+
+# Guards the first selection, which threads of one process may reach together
+_backend_lock = threading.Lock()
+
+
+def available_backends():
+    """Get the names of the backends that can be used on this host."""
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+def sample_jpeg(width=1024, height=768, quality=90, seed=0):
+    """
+    Encode a deterministic photo-like JPEG for the micro-benchmark.
+
+    Parameters:
+        width (int): The width of the image. Default is 1024.
+        height (int): The height of the image. Default is 768.
+        quality (int): The JPEG quality. Default is 90.
+        seed (int): The seed of the noise. Default is 0.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+
+    # Smooth gradients with some texture compress like photos
+    image = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    image += rng.normal(0, 12, image.shape)
+
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(
+        buffer, format="JPEG", quality=quality
+    )
+    return buffer.getvalue()
+
+
+def benchmark_backends(names=None, repeat=5, data=None):
+    """
+    Time the decoding of a sample JPEG with every backend.
+
+    Every backend decodes the sample at full scale in RGB, at 256x256 in RGB and at 64x64
+    in grayscale, the requests of the pipeline; its score is the sum of the best times.
+
+    Parameters:
+        names (list of str): The backends to time. Default is every available backend.
+        repeat (int): Number of timed decodes per request. Default is 5.
+        data (bytes): The encoded image. Default is sample_jpeg().
+
+    Returns:
+        dict: The seconds of every backend.
+    """
+    data = data or sample_jpeg()
+    requests = [
+        {},
+        {"size": (256, 256)},
+        {"size": (64, 64), "mode": "L"},
+    ]
+
+    seconds = {}
+    for name in names or available_backends():
+        backend = BACKENDS[name]()
+        total = 0.0
+        for request in requests:
+            # Warm up the decoder before timing it
+            backend.decode(data, min_size=request.get("size"), **request)
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                backend.decode(data, min_size=request.get("size"), **request)
+                best = min(best, time.perf_counter() - start)
+            total += best
+        seconds[name] = total
+
+    return seconds
+
+
+def select_backend(path=CHOICE_PATH, repeat=5, seconds=None):
+    """
+    Choose the fastest backend of this host with the micro-benchmark, and remember it.
+
+    Parameters:
+        path (str): The JSON file the choice is saved to. None to not save it. Default is ~/.cache/leon/decode_backend.json.
+        repeat (int): Number of timed decodes per request. Default is 5.
+        seconds (dict): The timings of benchmark_backends. Default is None (run it).
+
+    Returns:
+        str: The name of the backend.
+    """
+    if seconds is None:
+        seconds = benchmark_backends(repeat=repeat)
+    name = min(seconds, key=seconds.get)
+
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # A unique temporary file, as other processes may save their choice at the same time
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"host": platform.node(), "backend": name, "seconds": seconds}, f, indent=2)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    return name
+
+
+def load_choice(path=CHOICE_PATH):
+    """
+    Load the backend chosen for this host by select_backend.
+
+    Parameters:
+        path (str): The JSON file of the choice. Default is ~/.cache/leon/decode_backend.json.
+
+    Returns:
+        str: The name of the backend, or None if it was chosen on another host or is no longer available.
+    """
+    try:
+        with open(path) as f:
+            choice = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    name = choice.get("backend")
+    if choice.get("host") != platform.node() or name not in BACKENDS:
+        return None
+
+    return name if BACKENDS[name].available() else None
+
+
+def set_backend(name):
+    """
+    Use a backend in this process.
+
+    Parameters:
+        name (str): "turbojpeg", "opencv" or "pil".
+
+    Returns:
+        The backend.
+    """
+    global _backend
+
+    if name not in BACKENDS:
+        raise ValueError(f"Invalid decode backend. Use one of {', '.join(BACKENDS)}.")
+    if not BACKENDS[name].available():
+        raise ImportError(f"The {name} decode backend is not available on this host.")
+
+    _backend = BACKENDS[name]()
+    return _backend
+
+
+def get_backend():
+    """
+    Get the backend of this process.
+
+    The LEON_DECODE_BACKEND environment variable takes precedence, then the choice saved
+    for this host. Otherwise the micro-benchmark runs once and its choice is saved. Call it
+    before starting a process pool, so that the workers inherit or read the choice.
+
+    Returns:
+        The backend.
+    """
+    if _backend is None:
+        with _backend_lock:
+            # Another thread may have selected the backend while this one waited
+            if _backend is None:
+                name = os.environ.get("LEON_DECODE_BACKEND") or load_choice() or select_backend()
+                set_backend(name)
+
+    return _backend
+
+
+def decode_image(source, size=None, min_size=None, mode="RGB", return_size=False):
+    """
+    Decode an image as a uint8 array with the backend of this process.
+
+    Every backend returns the same layout: (height, width, 3) arrays in RGB or BGR order,
+    or (height, width) arrays in grayscale.
+
+    Parameters:
+        source (str or bytes): The image path, possibly inside a ZIP archive, or the encoded bytes.
+        size (tuple): The exact (width, height) of the array. Default is None (decoded size).
+        min_size (tuple): The minimum (width, height) of a reduced-scale decode; JPEG decoders then
+            skip the DCT scales that are not needed. Default is size (None decodes at full scale).
+        mode (str): "RGB", "BGR" or "L". Default is "RGB".
+        return_size (bool): Whether to also return the (width, height) of the original image. Default is False.
+
+    Returns:
+        np.ndarray: The array, or the array and the original size if return_size is True.
+    """
+    if mode not in MODES:
+        raise ValueError("Invalid mode. Use 'RGB', 'BGR' or 'L'.")
+
+    data = source if isinstance(source, (bytes, bytearray, memoryview)) else read_bytes(source)
+    if min_size is None:
+        min_size = size
+
+    array, original_size = get_backend().decode(bytes(data), size, min_size, mode)
+
+    return (array, original_size) if return_size else array
+
+
+def main(argv=None):
+    """Time the decode backends of this host and save the fastest one."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="Timed decodes per request")
+    parser.add_argument("--output", default=CHOICE_PATH, help="The JSON file the choice is saved to")
+    args = parser.parse_args(argv)
+
+    seconds = benchmark_backends(repeat=args.repeat)
+    for name, value in sorted(seconds.items(), key=lambda item: item[1]):
+        print(f">>> {name:<10} {value * 1000:8.2f} ms")
+
+    name = select_backend(args.output, seconds=seconds)
+    print(f">>> Selected: {name} (saved to {args.output})")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
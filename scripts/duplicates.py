@@ -0,0 +1,497 @@
+import os
+from math import comb
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from scripts import constants as const
+from scripts.decode import decode_image, get_backend
+from scripts.lazy import lazy_import
+from scripts.instrument import instrument
+from scripts.blob_store import map_unique
+
+imagehash = lazy_import("imagehash")
+metrics = lazy_import("skimage.metrics")
+
+# Hash functions of imagehash supported by the duplicate finder
+HASH_FUNCTIONS = {
+    "phash": "phash",
+    "dhash": "dhash",
+    "ahash": "average_hash",
+}
+
+# Narrowest band of the Hamming index: narrower bands fill their buckets with unrelated hashes
+MIN_BAND_BITS = 10
+
+# Widest band probed at a radius, through a dense table of bucket offsets
+DENSE_BAND_BITS = 24
+
+# Maximum number of candidate pairs expanded at once by the Hamming index
+CANDIDATE_CHUNK = 1 << 22
+
+# Number of set bits of every 16-bit value, for NumPy versions without bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+
+def popcount(values):
+    """
+    Count the set bits of every element of a uint64 array.
+
+    Parameters:
+        values (np.ndarray): The uint64 array.
+
+    Returns:
+        np.ndarray: The number of set bits of every element.
+    """
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+
+    # NumPy 2 counts the bits natively, an order of magnitude faster than the table
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+
+    counts = POPCOUNT_TABLE[values.view(np.uint16)].reshape(-1, 4)
+    return counts[:, 0] + counts[:, 1] + counts[:, 2] + counts[:, 3]
+
+
+def hash_image(img_path, hash_type="phash"):
+    """
+    Compute the 64-bit perceptual hash of an image as an integer.
+
+    Parameters:
+        img_path (str): The path to the image file.
+        hash_type (str): Type of hash to use ("phash", "dhash", or "ahash").
+
+    Returns:
+        int: The perceptual hash.
+    """
+    # The hashes are computed on 32x32 grayscale images at most
+    image = Image.fromarray(decode_image(img_path, min_size=(64, 64), mode="L"))
+    return int(str(getattr(imagehash, HASH_FUNCTIONS[hash_type])(image)), 16)
+
+
+def _hash_safe(task):
+    """Hash an image inside a worker process, returning the error instead of raising it."""
+    img_path, hash_type = task
+    try:
+        return hash_image(img_path, hash_type)
+    except Exception as e:
+        return e
+
+
+def load_ssim_array(img_path, size=64):
+    """
+    Decode an image as a small grayscale array for SSIM comparison.
+
+    Parameters:
+        img_path (str): The path to the image file.
+        size (int): Width and height of the array. Default is 64.
+
+    Returns:
+        np.ndarray: The grayscale uint8 array.
+    """
+    # Let the JPEG decoder produce a reduced grayscale image directly
+    return decode_image(img_path, size=(size, size), mode="L")
+
+
+def _load_ssim_safe(task):
+    """Load an SSIM array inside a worker process, returning the error instead of raising it."""
+    img_path, size = task
+    try:
+        return load_ssim_array(img_path, size)
+    except Exception as e:
+        return e
+
+
+def _ssim_scores(arrays):
+    """Compute the SSIM of a chunk of array pairs inside a worker process."""
+    return [metrics.structural_similarity(left, right, data_range=255) for left, right in arrays]
+
+
+def group_pairs(count, pairs):
+    """
+    Group the items paired with a representative.
+
+    Near-duplicate pairs are not transitive: A close to B and B close to C does not
+    make C close to A. Every group is therefore a star around its earliest item, and
+    only holds the items directly paired with it, so that every item but the first
+    can be removed as a duplicate of the first. An item paired with a member of a
+    group but not with its representative is left to later groups.
+
+    Parameters:
+        count (int): Number of items.
+        pairs (iterable of tuple): The (i, j) index pairs.
+
+    Returns:
+        list of list of int: The indices of every group with more than one member, representative first.
+    """
+    neighbours = [[] for _ in range(count)]
+    for i, j in pairs:
+        i, j = int(i), int(j)
+        if i != j:
+            neighbours[i].append(j)
+            neighbours[j].append(i)
+
+    grouped = [False] * count
+    groups = []
+
+    # The earliest ungrouped item becomes the representative of its ungrouped neighbours
+    for i in range(count):
+        if grouped[i]:
+            continue
+
+        members = sorted({j for j in neighbours[i] if not grouped[j]})
+        if not members:
+            continue
+
+        grouped[i] = True
+        for j in members:
+            grouped[j] = True
+        groups.append([i] + members)
+
+    return groups
+
+
+class HammingIndex:
+    def __init__(self, hashes, max_distance=0, bits=64, min_band_bits=MIN_BAND_BITS):
+        """
+        Multi-index hashing over 64-bit perceptual hashes.
+
+        The hashes are split into m bands. Two hashes within max_distance bits of each other
+        differ by at most max_distance // m bits (the radius) on at least one band, so only
+        hashes whose band values are that close are compared. Up to max_distance + 1 bands of
+        at least min_band_bits bits are considered, and the count with the fewest estimated
+        lookups and candidates is used (see band_count). The radius then stays at 0 to 2 bits
+        up to a max_distance of 11, instead of the thousands of probes of wide bands.
+
+        Parameters:
+            hashes (list of int): The perceptual hashes.
+            max_distance (int): Maximum Hamming distance between two near-duplicates. Default is 0.
+            bits (int): Number of bits in a hash. Default is 64.
+            min_band_bits (int): Minimum width of a band. Default is 10.
+        """
+        if not 0 <= max_distance < bits:
+            raise ValueError(f"max_distance must be between 0 and {bits - 1}")
+
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.max_distance = max_distance
+
+        bands = self.band_count(len(self.hashes), max_distance, bits, min_band_bits)
+        self.radius = max_distance // bands
+
+        # Split the bits into bands as evenly as possible
+        widths = [bits // bands + (1 if i < bits % bands else 0) for i in range(bands)]
+        self.bands = []
+        shift = 0
+        for width in widths:
+            self.bands.append((shift, width))
+            shift += width
+
+        # Number of lookups of every hash into a band, reported by pairs
+        self.probes = 0
+
+    @staticmethod
+    def band_count(count, max_distance, bits=64, min_band_bits=MIN_BAND_BITS):
+        """
+        Pick the number of bands with the least estimated work.
+
+        Every hash is looked up once per flip mask of its band, and meets the hashes of the
+        bucket it lands in: count / 2^width of them for well-spread hashes. Wide bands have
+        small buckets but many masks, narrow bands the opposite.
+
+        Parameters:
+            count (int): Number of hashes.
+            max_distance (int): Maximum Hamming distance between two near-duplicates.
+            bits (int): Number of bits in a hash. Default is 64.
+            min_band_bits (int): Minimum width of a band. Default is 10.
+
+        Returns:
+            int: The number of bands.
+        """
+        best_cost, best_bands = None, 1
+
+        for bands in range(1, max(1, min(max_distance + 1, bits // min_band_bits)) + 1):
+            width = -(-bits // bands)
+            radius = max_distance // bands
+
+            # Bands probed at a radius need a dense table
+            if radius > 0 and width > DENSE_BAND_BITS:
+                continue
+
+            probes = sum(comb(width, k) for k in range(radius + 1))
+            cost = bands * probes * count * (1 + count / 2 ** (bits // bands))
+            if best_cost is None or cost < best_cost:
+                best_cost, best_bands = cost, bands
+
+        return best_bands
+
+    @staticmethod
+    def flip_masks(width, radius):
+        """
+        Enumerate every mask of at most radius set bits within a band.
+
+        Parameters:
+            width (int): Number of bits in the band.
+            radius (int): Maximum number of set bits.
+
+        Returns:
+            list of int: The masks, starting with 0.
+        """
+        masks = []
+        for count in range(radius + 1):
+            for positions in combinations(range(width), count):
+                masks.append(sum(1 << position for position in positions))
+        return masks
+
+    def candidates(self, order, lows, sizes, ordered=False):
+        """
+        Verify every hash against the members of the bucket it was looked up in.
+
+        Parameters:
+            order (np.ndarray): The indices of the hashes sorted by band value.
+            lows (np.ndarray): The position in order of the bucket of every hash.
+            sizes (np.ndarray): The size of the bucket of every hash.
+            ordered (bool): Whether every pair shows up in both directions, so only i < j is kept. Default is False.
+
+        Returns:
+            list of np.ndarray: The (i, j) pairs within max_distance bits, in chunks.
+        """
+        found = []
+        ends = np.cumsum(sizes)
+
+        # Expand a bounded number of candidates at a time
+        start = 0
+        while start < len(sizes):
+            stop = int(np.searchsorted(ends, ends[start] - sizes[start] + CANDIDATE_CHUNK, side="right"))
+            stop = max(stop, start + 1)
+            chunk_sizes = sizes[start:stop]
+
+            if chunk_sizes.any():
+                # One candidate per bucket member
+                left = np.repeat(np.arange(start, stop), chunk_sizes)
+                offsets = np.arange(len(left)) - np.repeat(np.cumsum(chunk_sizes) - chunk_sizes, chunk_sizes)
+                right = order[np.repeat(lows[start:stop], chunk_sizes) + offsets]
+
+                keep = left < right if ordered else left != right
+                left, right = left[keep], right[keep]
+
+                # Verify the exact distance of the candidates
+                close = popcount(self.hashes[left] ^ self.hashes[right]) <= self.max_distance
+                left, right = left[close], right[close]
+                found.append(np.stack([np.minimum(left, right), np.maximum(left, right)], axis=1))
+
+            start = stop
+
+        return found
+
+    def pairs(self):
+        """
+        Find every pair of hashes within max_distance bits of each other.
+
+        Returns:
+            np.ndarray: The (i, j) index pairs with i < j, one per row.
+        """
+        found = [np.empty((0, 2), dtype=np.int64)]
+        self.probes = 0
+
+        for shift, width in self.bands:
+            keys = (self.hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+
+            # Sort by band value so colliding hashes are contiguous
+            order = np.argsort(keys, kind="stable")
+
+            if self.radius == 0:
+                # Group the hashes by exact band value: every hash meets its own bucket only
+                sorted_keys = keys[order]
+                starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+                run_sizes = np.diff(np.r_[starts, len(keys)])
+
+                lows = np.empty(len(keys), dtype=np.int64)
+                sizes = np.empty(len(keys), dtype=np.int64)
+                lows[order] = np.repeat(starts, run_sizes)
+                sizes[order] = np.repeat(run_sizes, run_sizes)
+
+                self.probes += 1
+                found.extend(self.candidates(order, lows, sizes, ordered=True))
+                continue
+
+            # Bands probed at a radius are narrow: a dense table of bucket offsets
+            counts = np.bincount(keys.astype(np.int64), minlength=1 << width)
+            offsets = np.cumsum(counts) - counts
+
+            for mask in self.flip_masks(width, self.radius):
+                probes = (keys ^ np.uint64(mask)).astype(np.int64)
+                self.probes += 1
+                found.extend(
+                    self.candidates(order, offsets[probes], counts[probes], ordered=mask == 0)
+                )
+
+        # The same pair can collide on several bands and probes
+        return np.unique(np.concatenate(found), axis=0)
+
+    def groups(self):
+        """
+        Group the hashes around the representatives they are near duplicates of.
+
+        Returns:
+            list of list of int: The indices of every group with more than one member.
+        """
+        return group_pairs(len(self.hashes), self.pairs())
+
+
+class DuplicateFinder:
+    def __init__(
+        self,
+        hash_type="phash",
+        max_distance=0,
+        workers=None,
+        chunk_size=const.MANIFEST_CHUNK_SIZE,
+        ssim_threshold=0.9,
+        ssim_size=64,
+        candidate_distance=8,
+    ):
+        """
+        Finds exact and near-duplicate images by the Hamming distance of their perceptual hashes.
+
+        With hash_type "ssim", the perceptual hashes only propose candidate pairs within
+        candidate_distance bits, and a pair is a duplicate if the SSIM of the downscaled
+        grayscale images reaches ssim_threshold.
+
+        The cost of proposing the candidates grows quickly with candidate_distance. On
+        well-spread 64-bit hashes and one CPU, it takes about 1s, 6s and 7s for 100k images
+        at distances 6, 8 and 10, and 23s, 36s and 150s for 500k images.
+
+        Parameters:
+            hash_type (str): Type of hash to use ("phash", "dhash", "ahash" or "ssim").
+            max_distance (int): Maximum Hamming distance between two near-duplicates. Default is 0.
+            workers (int): Number of worker processes. Default is the number of CPUs.
+            chunk_size (int): Number of images submitted to a worker at once. Default is 64.
+            ssim_threshold (float): Minimum SSIM of two duplicates in "ssim" mode. Default is 0.9.
+            ssim_size (int): Width and height of the arrays compared in "ssim" mode. Default is 64.
+            candidate_distance (int): Maximum Hamming distance of a candidate pair in "ssim" mode. Default is 8.
+        """
+        if hash_type not in HASH_FUNCTIONS and hash_type != "ssim":
+            raise ValueError(
+                "Invalid hash type. Use 'phash', 'dhash', 'ahash' or 'ssim'."
+            )
+
+        self.hash_type = hash_type
+        self.max_distance = max_distance
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.ssim_threshold = ssim_threshold
+        self.ssim_size = ssim_size
+        self.candidate_distance = candidate_distance
+
+    def map(self, function, tasks):
+        """
+        Apply a function to the tasks, in a process pool if the job is large enough.
+
+        Parameters:
+            function (callable): A picklable module-level function.
+            tasks (list): The arguments of every call.
+
+        Returns:
+            list: The results, in task order.
+        """
+        # Small jobs are not worth the cost of starting the pool
+        if self.workers <= 1 or len(tasks) <= self.chunk_size:
+            return [function(task) for task in tasks]
+
+        # The workers inherit or read the decode backend of this host
+        get_backend()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(function, tasks, chunksize=self.chunk_size))
+
+    def hash_images(self, img_paths):
+        """
+        Hash the images in a process pool, once per file for hard-linked copies.
+
+        Parameters:
+            img_paths (list of str): The image paths.
+
+        Returns:
+            list: The hash of every image, or the exception raised for it.
+        """
+        # SSIM mode proposes its candidates with the perceptual hash
+        hash_type = "phash" if self.hash_type == "ssim" else self.hash_type
+
+        return map_unique(
+            list(img_paths),
+            lambda paths: self.map(_hash_safe, [(path, hash_type) for path in paths]),
+        )
+
+    def verify_ssim(self, img_paths, pairs):
+        """
+        Keep the candidate pairs whose SSIM reaches the threshold.
+
+        Parameters:
+            img_paths (list of str): The image paths.
+            pairs (np.ndarray): The candidate (i, j) index pairs.
+
+        Returns:
+            list of tuple: The verified (i, j) index pairs.
+        """
+        # Decode every image involved in a candidate pair once
+        candidates = sorted(set(np.asarray(pairs).ravel().tolist()))
+        loaded = self.map(
+            _load_ssim_safe,
+            [(img_paths[i], self.ssim_size) for i in candidates],
+        )
+        arrays = {
+            i: array
+            for i, array in zip(candidates, loaded)
+            if not isinstance(array, Exception)
+        }
+
+        pairs = [(int(i), int(j)) for i, j in pairs if i in arrays and j in arrays]
+
+        # Send the pairs to the workers in chunks to amortize the transfer
+        chunks = [
+            [(arrays[i], arrays[j]) for i, j in pairs[start : start + self.chunk_size]]
+            for start in range(0, len(pairs), self.chunk_size)
+        ]
+        scores = [score for chunk in self.map(_ssim_scores, chunks) for score in chunk]
+
+        return [pair for pair, score in zip(pairs, scores) if score >= self.ssim_threshold]
+
+    def find(self, img_paths, hashes=None):
+        """
+        Find the groups of duplicate images.
+
+        Parameters:
+            img_paths (list of str): The image paths.
+            hashes (list): The precomputed result of hash_images for every path, such as from a BlobStore. Default is None (hash the images).
+
+        Returns:
+            list of list of str: The paths of every duplicate group, in input order.
+        """
+        if hashes is None:
+            with instrument.stage("detect_duplicates.hash"):
+                hashes = self.hash_images(img_paths)
+
+        valid_hashes = []
+        hashed_paths = []
+
+        for img_path, result in zip(img_paths, hashes):
+            if isinstance(result, Exception):
+                print(f"Error hashing image '{img_path}': {result}")
+                instrument.count("decode_failures")
+                continue
+
+            valid_hashes.append(result)
+            hashed_paths.append(img_path)
+
+        instrument.count("files_processed", len(hashed_paths))
+        instrument.count_bytes(img_paths)
+
+        if self.hash_type == "ssim":
+            # Only the pairs proposed by the hashes are compared with SSIM
+            with instrument.stage("detect_duplicates.index"):
+                pairs = HammingIndex(valid_hashes, self.candidate_distance).pairs()
+            with instrument.stage("detect_duplicates.verify_ssim"):
+                groups = group_pairs(len(hashed_paths), self.verify_ssim(hashed_paths, pairs))
+        else:
+            with instrument.stage("detect_duplicates.index"):
+                groups = HammingIndex(valid_hashes, self.max_distance).groups()
+
+        return [[hashed_paths[i] for i in group] for group in groups]
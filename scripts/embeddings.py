@@ -0,0 +1,261 @@
+import os
+import numpy as np
+from scripts.stream import ImageStream
+from scripts.recommender import RecommenderIndex
+from scripts.lazy import lazy_import
+from scripts.instrument import instrument
+from scripts.blob_store import unique_files
+
+pd = lazy_import("pandas")
+
+# Files of a feature store directory
+VECTORS_FILE = "vectors.npy"
+INDEX_FILE = "index.csv"
+
+
+def predict(model, batch):
+    """
+    Run a feature extractor on a batch of images.
+
+    Parameters:
+        model (tf.keras.Model or callable): The feature extractor.
+        batch (np.ndarray): The float32 batch of images in [0, 1].
+
+    Returns:
+        np.ndarray: The feature vectors, one per row.
+    """
+    if hasattr(model, "predict"):
+        return np.asarray(model.predict(batch, verbose=0))
+
+    return np.asarray(model(batch))
+
+
+class FeatureStore:
+    def __init__(self, store_dir):
+        """
+        Binary store of feature vectors: a memory-mapped .npy matrix and a path/category index.
+
+        Parameters:
+            store_dir (str): The directory of the store.
+        """
+        self.store_dir = store_dir
+        self.vectors_path = os.path.join(store_dir, VECTORS_FILE)
+        self.index_path = os.path.join(store_dir, INDEX_FILE)
+
+    def exists(self):
+        """Check whether the store has been written."""
+        return os.path.exists(self.vectors_path) and os.path.exists(self.index_path)
+
+    def load(self):
+        """
+        Load the index and memory-map the vectors.
+
+        Returns:
+            tuple: The index DataFrame and the read-only vector matrix.
+        """
+        if not self.exists():
+            raise FileNotFoundError(f"Feature store not found: {self.store_dir}")
+
+        index = pd.read_csv(self.index_path)
+        vectors = np.load(self.vectors_path, mmap_mode="r")
+
+        return index, vectors
+
+    def write(self, index, parts, dim, dtype, chunk_size=65536):
+        """
+        Write the store from blocks of vectors, replacing the previous files atomically.
+
+        Parameters:
+            index (pd.DataFrame): The index rows, in the order of the vectors.
+            parts (list of tuple): The source matrix and the rows to copy from it, in order.
+            dim (int): The dimension of the vectors.
+            dtype (str): The dtype of the stored vectors.
+            chunk_size (int): Number of rows copied at once. Default is 65536.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        temp_vectors = self.vectors_path + ".tmp.npy"
+        temp_index = self.index_path + ".tmp"
+
+        vectors = np.lib.format.open_memmap(
+            temp_vectors, mode="w+", dtype=dtype, shape=(len(index), dim)
+        )
+
+        # Copy in chunks so that no matrix is ever fully loaded in memory
+        start = 0
+        for source, rows in parts:
+            for chunk in range(0, len(rows), chunk_size):
+                chunk_rows = rows[chunk : chunk + chunk_size]
+                vectors[start : start + len(chunk_rows)] = source[chunk_rows]
+                start += len(chunk_rows)
+        vectors.flush()
+        del vectors
+
+        index.to_csv(temp_index, index=False)
+
+        os.replace(temp_vectors, self.vectors_path)
+        os.replace(temp_index, self.index_path)
+
+    def to_recommender(self, n_clusters=None, seed=42):
+        """
+        Build a recommender index from the stored vectors.
+
+        Parameters:
+            n_clusters (int): Number of partitions per category. Default is None (exhaustive search).
+            seed (int): The seed of the KMeans partitioning. Default is 42.
+
+        Returns:
+            RecommenderIndex: The index.
+        """
+        index, vectors = self.load()
+        return RecommenderIndex(n_clusters, seed).build(
+            vectors, index["Path"], index["Category"]
+        )
+
+
+class EmbeddingJob:
+    def __init__(
+        self,
+        model,
+        store_dir,
+        size=(256, 256),
+        batch_size=256,
+        dtype="float32",
+        prefetch=512,
+        workers=4,
+    ):
+        """
+        Batched, incremental feature extraction into a FeatureStore.
+
+        Parameters:
+            model (tf.keras.Model or callable): The feature extractor.
+            store_dir (str): The directory of the feature store.
+            size (tuple): The (width, height) images are resized to. Default is (256, 256).
+            batch_size (int): Number of images per inference batch. Default is 256.
+            dtype (str): The dtype of the stored vectors, "float32" or "float16". Default is "float32".
+            prefetch (int): Maximum number of decodes in flight. Default is 512.
+            workers (int): Number of decoding threads. Default is 4.
+        """
+        self.model = model
+        self.store = FeatureStore(store_dir)
+        self.staging_path = os.path.join(store_dir, "vectors.new.npy")
+        self.size = tuple(size)
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
+        self.prefetch = prefetch
+        self.workers = workers
+
+    @instrument.timed("extract_features")
+    def run(self, df):
+        """
+        Embed the images of a manifest, reusing the vectors already in the store.
+
+        Only the paths missing from the store are embedded, and the paths no longer in
+        the manifest are dropped. Hard links to the same file are embedded once.
+
+        Parameters:
+            df (pd.DataFrame): The manifest, with at least the Path and Category columns.
+
+        Returns:
+            FeatureStore: The updated store.
+        """
+        df = df.drop_duplicates("Path")
+        columns = [c for c in ["Path", "Category", "Style"] if c in df]
+
+        # Keep the stored vectors whose path is still in the manifest
+        parts = []
+        if self.store.exists():
+            old_index, old_vectors = self.store.load()
+            keep = old_index["Path"].isin(df["Path"]).to_numpy()
+            kept_index = df.set_index("Path").loc[old_index["Path"][keep]].reset_index()
+            parts.append((old_vectors, np.flatnonzero(keep)))
+        else:
+            kept_index = df.iloc[:0]
+
+        new_df = df[~df["Path"].isin(kept_index["Path"])]
+        print(f">>> {len(kept_index)} vectors reused, {len(new_df)} images to embed")
+
+        # Nothing to embed nor to drop: the store is already up to date
+        if parts and new_df.empty and keep.all():
+            return self.store
+
+        # Embed one link per file, then give every link the vector of its file
+        paths = list(new_df["Path"])
+        representatives, inverse = unique_files(paths)
+        done_paths, new_vectors = self.embed([paths[i] for i in representatives])
+
+        rows_of = {path: row for row, path in enumerate(done_paths)}
+        new_paths = []
+        new_rows = []
+        for path, position in zip(paths, inverse):
+            row = rows_of.get(paths[representatives[position]])
+            if row is not None:
+                new_paths.append(path)
+                new_rows.append(row)
+
+        new_index = new_df.set_index("Path").loc[new_paths].reset_index()
+        if new_vectors is not None:
+            parts.append((new_vectors, np.asarray(new_rows, dtype=np.int64)))
+
+        if not parts:
+            return self.store
+
+        self.store.write(
+            pd.concat([kept_index[columns], new_index[columns]], ignore_index=True),
+            parts,
+            parts[0][0].shape[1],
+            self.dtype,
+        )
+
+        # The vectors of this run were staged in a temporary file
+        if os.path.exists(self.staging_path):
+            os.remove(self.staging_path)
+
+        return self.store
+
+    def embed(self, paths):
+        """
+        Embed images in large batches while the next batches are decoded.
+
+        The vectors are staged in a memory-mapped file next to the store.
+
+        Parameters:
+            paths (list of str): The image paths.
+
+        Returns:
+            tuple: The paths that could be decoded and the memory-mapped matrix of their vectors.
+        """
+        stream = ImageStream(
+            paths,
+            size=self.size,
+            batch_size=self.batch_size,
+            prefetch=self.prefetch,
+            workers=self.workers,
+        )
+
+        done_paths = []
+        vectors = None
+        batches = instrument.progress(
+            stream, "extract_features", total=len(paths), weight=lambda item: len(item[0])
+        )
+        for batch_paths, batch in batches:
+            # Scale to [0, 1] as the notebooks do
+            with instrument.stage("extract_features.predict"):
+                batch_vectors = predict(self.model, batch.astype(np.float32) / 255.0)
+
+            # The dimension is only known after the first batch
+            if vectors is None:
+                os.makedirs(self.store.store_dir, exist_ok=True)
+                vectors = np.lib.format.open_memmap(
+                    self.staging_path,
+                    mode="w+",
+                    dtype=self.dtype,
+                    shape=(len(paths), batch_vectors.shape[1]),
+                )
+
+            vectors[len(done_paths) : len(done_paths) + len(batch_paths)] = batch_vectors
+            done_paths.extend(batch_paths)
+
+        if vectors is None:
+            return done_paths, None
+
+        return done_paths, vectors[: len(done_paths)]
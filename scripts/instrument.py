@@ -0,0 +1,418 @@
+import os
+import sys
+import json
+import time
+import threading
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # Unix only, the RSS is then reported as 0
+    resource = None
+
+
+def rss_bytes():
+    """
+    Get the current resident set size of the process.
+
+    Returns:
+        int: The RSS in bytes, the peak RSS where the current one is not available, or 0 where neither is.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return 0
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KiB elsewhere
+        return usage if sys.platform == "darwin" else usage * 1024
+
+
+class NullStage:
+    """Stage context used while instrumentation is disabled: does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    def __init__(self, instrumentation, name):
+        """
+        Context measuring one call of a stage.
+
+        Parameters:
+            instrumentation (Instrumentation): The instrumentation recording the call.
+            name (str): The name of the stage.
+        """
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.instrumentation.push(self.name)
+        self.rss = rss_bytes() if self.instrumentation.memory else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        rss_delta = rss_bytes() - self.rss if self.rss is not None else None
+        self.instrumentation.pop()
+        self.instrumentation.record(self.name, seconds, rss_delta, failed=exc[0] is not None)
+        return False
+
+
+class Instrumentation:
+    def __init__(self, enabled=False, memory=False, log_path=None, progress_interval=5.0):
+        """
+        Stage timers, counters and progress events of the Leon pipeline.
+
+        While disabled, stage returns a shared no-op context and count returns at once,
+        so the hooks can stay in the hot paths.
+
+        Counters are labelled with the innermost stage of the calling thread. Stages run
+        in worker processes are timed as a whole by the parent; the workers do not report.
+
+        Parameters:
+            enabled (bool): Whether to record anything. Default is False.
+            memory (bool): Whether to sample the RSS before and after every stage call. Default is False.
+            log_path (str): A JSON lines file every stage call and progress event is appended to. Default is None.
+            progress_interval (float): Minimum seconds between two progress events of a loop. Default is 5.
+        """
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.enabled = enabled
+        self.memory = memory
+        self.log_path = log_path
+        self.progress_interval = progress_interval
+        self.reset()
+
+    def configure(self, enabled=None, memory=None, log_path=None, progress_interval=None):
+        """
+        Change the settings. Arguments left to None are unchanged.
+
+        Parameters:
+            enabled (bool): Whether to record anything.
+            memory (bool): Whether to sample the RSS of every stage call.
+            log_path (str): The JSON lines file of the events.
+            progress_interval (float): Minimum seconds between two progress events of a loop.
+        """
+        if enabled is not None:
+            self.enabled = enabled
+        if memory is not None:
+            self.memory = memory
+        if log_path is not None:
+            self.log_path = log_path
+        if progress_interval is not None:
+            self.progress_interval = progress_interval
+
+    def reset(self):
+        """Clear the recorded timers and counters."""
+        with self.lock:
+            # Stage name -> [calls, failures, seconds, max seconds, max RSS delta]
+            self.stages = {}
+            # (counter name, stage name) -> value
+            self.counters = {}
+
+    def push(self, name):
+        """Enter a stage on the calling thread."""
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        self.local.stack.append(name)
+
+    def pop(self):
+        """Leave the innermost stage of the calling thread."""
+        self.local.stack.pop()
+
+    def current_stage(self):
+        """Get the innermost stage of the calling thread, or "" outside of any stage."""
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else ""
+
+    def stage(self, name):
+        """
+        Time a block of code as a call of a stage.
+
+        Parameters:
+            name (str): The name of the stage, such as "load_data_frame".
+
+        Returns:
+            context manager: The stage context.
+
+        Example:
+            with instrument.stage("detect_duplicates.hash"):
+                hashes = finder.hash_images(paths)
+        """
+        if not self.enabled:
+            return NULL_STAGE
+
+        return Stage(self, name)
+
+    def timed(self, name=None):
+        """
+        Decorate a function so that every call is timed as a stage.
+
+        Parameters:
+            name (str): The name of the stage. Default is the name of the function.
+
+        Returns:
+            function: The decorator.
+        """
+
+        def decorator(function):
+            stage_name = name or function.__name__
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Stage(self, stage_name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, name, seconds, rss_delta=None, failed=False):
+        """Record one call of a stage."""
+        with self.lock:
+            entry = self.stages.setdefault(name, [0, 0, 0.0, 0.0, None])
+            entry[0] += 1
+            entry[1] += int(failed)
+            entry[2] += seconds
+            entry[3] = max(entry[3], seconds)
+            if rss_delta is not None:
+                entry[4] = rss_delta if entry[4] is None else max(entry[4], rss_delta)
+
+        if self.log_path:
+            event = {"event": "stage", "stage": name, "seconds": seconds, "failed": failed}
+            if rss_delta is not None:
+                event["rss_delta_bytes"] = rss_delta
+            self.emit(event)
+
+    def count(self, name, value=1, stage=None):
+        """
+        Add to a counter, such as "files_processed", "bytes_read" or "decode_failures".
+
+        Parameters:
+            name (str): The name of the counter.
+            value (int): The amount to add. Default is 1.
+            stage (str): The stage label. Default is the innermost stage of the calling thread.
+        """
+        if not self.enabled:
+            return
+
+        key = (name, self.current_stage() if stage is None else stage)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def count_bytes(self, paths, stage=None):
+        """
+        Add the size of files to the "bytes_read" counter.
+
+        Parameters:
+            paths (iterable of str): The file paths, possibly inside ZIP archives.
+            stage (str): The stage label. Default is the innermost stage of the calling thread.
+        """
+        if not self.enabled:
+            return
+
+        from scripts.zip_source import file_signature
+
+        total = 0
+        for path in paths:
+            try:
+                total += file_signature(path)[0]
+            except (OSError, KeyError):
+                continue
+
+        self.count("bytes_read", total, stage)
+
+    def progress(self, iterable, name, total=None, weight=None):
+        """
+        Report the progress of a loop at most every progress_interval seconds.
+
+        Events go to the JSON lines log if set, to the console otherwise.
+
+        Parameters:
+            iterable (iterable): The loop.
+            name (str): The name of the loop.
+            total (int): The expected number of items, to estimate the remaining time. Default is None.
+            weight (function): Number of items of an element, such as len for batches. Default is 1 per element.
+
+        Returns:
+            iterable: The loop itself while disabled, a generator reporting its progress otherwise.
+        """
+        if not self.enabled:
+            return iterable
+
+        return self.track(iterable, name, total, weight)
+
+    def track(self, iterable, name, total, weight):
+        """Yield the elements of a loop, emitting progress events."""
+        start = last = time.perf_counter()
+        done = 0
+
+        for element in iterable:
+            yield element
+            done += weight(element) if weight else 1
+
+            now = time.perf_counter()
+            if now - last >= self.progress_interval:
+                last = now
+                self.report_progress(name, done, total, now - start)
+
+        self.report_progress(name, done, total, time.perf_counter() - start)
+
+    def report_progress(self, name, done, total, elapsed):
+        """Emit a progress event."""
+        rate = done / elapsed if elapsed > 0 else 0.0
+        event = {"event": "progress", "stage": name, "done": done, "total": total, "rate": rate}
+        if total:
+            event["eta_seconds"] = (total - done) / rate if rate else None
+
+        if self.log_path:
+            self.emit(event)
+            return
+
+        percent = f" ({100 * done / total:.1f}%)" if total else ""
+        print(f">>> {name}: {done}/{total or '?'}{percent} at {rate:.1f} items/s")
+
+    def emit(self, event):
+        """Append an event to the JSON lines log."""
+        event = {"time": time.time(), "pid": os.getpid(), **event}
+        line = json.dumps(event) + "\n"
+        with self.lock:
+            with open(self.log_path, "a") as f:
+                f.write(line)
+
+    def snapshot(self):
+        """
+        Get the recorded timers and counters.
+
+        Returns:
+            dict: The calls, failures, seconds, max seconds and max RSS delta of every stage, and the value of every counter.
+        """
+        with self.lock:
+            stages = {
+                name: {
+                    "calls": calls,
+                    "failures": failures,
+                    "seconds": seconds,
+                    "max_seconds": max_seconds,
+                    "max_rss_delta_bytes": rss_delta,
+                }
+                for name, (calls, failures, seconds, max_seconds, rss_delta) in self.stages.items()
+            }
+            counters = [
+                {"counter": name, "stage": stage, "value": value}
+                for (name, stage), value in self.counters.items()
+            ]
+
+        return {"stages": stages, "counters": counters}
+
+    def write_jsonl(self, path):
+        """
+        Append the recorded timers and counters to a JSON lines file, one line per stage and counter.
+
+        Parameters:
+            path (str): The path to the file.
+        """
+        snapshot = self.snapshot()
+        now = time.time()
+
+        with open(path, "a") as f:
+            for name, stage in snapshot["stages"].items():
+                f.write(json.dumps({"time": now, "type": "stage", "stage": name, **stage}) + "\n")
+            for counter in snapshot["counters"]:
+                f.write(json.dumps({"time": now, "type": "counter", **counter}) + "\n")
+
+    def prometheus(self, prefix="leon"):
+        """
+        Format the recorded timers and counters in the Prometheus text exposition format.
+
+        Parameters:
+            prefix (str): The prefix of the metric names. Default is "leon".
+
+        Returns:
+            str: The metrics.
+        """
+        snapshot = self.snapshot()
+        stages = snapshot["stages"]
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}")
+
+        metric(
+            "stage_calls_total",
+            "counter",
+            "Number of calls of a stage.",
+            [({"stage": name}, stage["calls"]) for name, stage in stages.items()],
+        )
+        metric(
+            "stage_failures_total",
+            "counter",
+            "Number of calls of a stage that raised.",
+            [({"stage": name}, stage["failures"]) for name, stage in stages.items()],
+        )
+        metric(
+            "stage_seconds_total",
+            "counter",
+            "Time spent in a stage.",
+            [({"stage": name}, stage["seconds"]) for name, stage in stages.items()],
+        )
+        metric(
+            "stage_seconds_max",
+            "gauge",
+            "Longest call of a stage.",
+            [({"stage": name}, stage["max_seconds"]) for name, stage in stages.items()],
+        )
+
+        memory = [
+            ({"stage": name}, stage["max_rss_delta_bytes"])
+            for name, stage in stages.items()
+            if stage["max_rss_delta_bytes"] is not None
+        ]
+        if memory:
+            metric(
+                "stage_rss_delta_bytes_max",
+                "gauge",
+                "Largest RSS growth over a call of a stage.",
+                memory,
+            )
+
+        # One metric per counter name, labelled by stage
+        names = sorted({counter["counter"] for counter in snapshot["counters"]})
+        for name in names:
+            metric(
+                f"{name}_total",
+                "counter",
+                f"Total {name.replace('_', ' ')}.",
+                [
+                    ({"stage": counter["stage"]}, counter["value"])
+                    for counter in snapshot["counters"]
+                    if counter["counter"] == name
+                ],
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+# Shared instrumentation of the pipeline, configured from the environment
+instrument = Instrumentation(
+    enabled=os.environ.get("LEON_INSTRUMENT") == "1",
+    memory=os.environ.get("LEON_INSTRUMENT_MEMORY") == "1",
+    log_path=os.environ.get("LEON_INSTRUMENT_LOG"),
+)
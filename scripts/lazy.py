@@ -0,0 +1,164 @@
+import re
+import sys
+import types
+import argparse
+import importlib
+import subprocess
+from collections import defaultdict
+
+# Line of the -X importtime report: self and cumulative microseconds, then the indented name
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name):
+        """
+        Module placeholder that imports the real module on first attribute access.
+
+        Parameters:
+            name (str): The full name of the module, such as "matplotlib.pyplot".
+        """
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        """Import the real module, once."""
+        if self._module is None:
+            module = importlib.import_module(self.__name__)
+            # Later accesses find the attributes directly, without going through __getattr__
+            self.__dict__.update(module.__dict__)
+            self.__dict__["_module"] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_import(name):
+    """
+    Import a module lazily.
+
+    If the module is already imported, it is returned as is, so a lazy import never
+    costs more than a regular one.
+
+    Parameters:
+        name (str): The full name of the module.
+
+    Returns:
+        module: The module, or a LazyModule that imports it on first attribute access.
+
+    Example:
+        plt = lazy_import("matplotlib.pyplot")
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    return LazyModule(name)
+
+
+def is_loaded(module):
+    """Check whether a module returned by lazy_import has been imported."""
+    return not isinstance(module, LazyModule) or module._module is not None
+
+
+def import_times(statement):
+    """
+    Measure the import time of every module imported by a statement.
+
+    The statement runs in a fresh interpreter with -X importtime, so modules already
+    imported by the caller do not hide their cost.
+
+    Parameters:
+        statement (str): The Python statement to run, such as "import scripts.leon".
+
+    Returns:
+        list of tuple: The name, depth, self and cumulative microseconds of every import, in report order.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Statement failed: {statement}\n{result.stderr}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            # Every nesting level is indented by two spaces
+            depth = (len(indent) - 1) // 2
+            imports.append((name, depth, int(self_us), int(cumulative_us)))
+
+    return imports
+
+
+def import_report(statement="import scripts.leon", top=20):
+    """
+    Aggregate the import time of a statement per top-level package.
+
+    Parameters:
+        statement (str): The Python statement to run. Default is "import scripts.leon".
+        top (int): Number of packages to report. Default is 20.
+
+    Returns:
+        dict: The total milliseconds, and the packages sorted by milliseconds with their module counts.
+    """
+    imports = import_times(statement)
+
+    packages = defaultdict(lambda: [0, 0])
+    for name, _, self_us, _ in imports:
+        package = packages[name.split(".")[0]]
+        package[0] += self_us
+        package[1] += 1
+
+    ranked = sorted(packages.items(), key=lambda item: item[1][0], reverse=True)
+
+    return {
+        "total_ms": sum(self_us for _, _, self_us, _ in imports) / 1000,
+        "packages": [
+            {"package": name, "ms": self_us / 1000, "modules": count}
+            for name, (self_us, count) in ranked[:top]
+        ],
+    }
+
+
+def main():
+    """Print the import time report of a statement."""
+    parser = argparse.ArgumentParser(description="Report import time per top-level package.")
+    parser.add_argument(
+        "statement",
+        nargs="?",
+        default="import scripts.leon",
+        help="The statement to profile. Default is 'import scripts.leon'.",
+    )
+    parser.add_argument("--top", type=int, default=20, help="Number of packages to report.")
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Exit with status 1 if the total import time exceeds this budget.",
+    )
+    args = parser.parse_args()
+
+    report = import_report(args.statement, args.top)
+
+    print(f">>> {args.statement}: {report['total_ms']:.1f} ms")
+    for entry in report["packages"]:
+        print(f"    {entry['package']:<24} {entry['ms']:>9.1f} ms  ({entry['modules']} modules)")
+
+    if args.max_ms is not None and report["total_ms"] > args.max_ms:
+        print(f">>> Import time exceeds the budget of {args.max_ms:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
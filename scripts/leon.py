@@ -1,35 +1,55 @@
 import os
+import time
+from itertools import islice
 import zipfile
 import shutil
-from PIL import Image
-from skimage.metrics import structural_similarity as ssim
 import numpy as np
-import pandas as pd
-import imagehash
-import cv2
-# from keras import layers
-# from keras.models import Sequential  # type: ignore
-import matplotlib.pyplot as plt
 from scripts.styler import Styler
+from scripts.manifest import ManifestBuilder
+from scripts.manifest_cache import ManifestCache
+from scripts.duplicates import DuplicateFinder
+from scripts.augment import Augmenter
+from scripts.resize import Resizer, resize_file
+from scripts.zip_source import ZipImageSource
+from scripts.stream import ImageStream
+from scripts.shards import ShardWriter, ShardReader
+from scripts.normalize import DatasetStats, normalize_minmax, normalize_standard
+from scripts.sampling import stratified_split, oversampling_plan
+from scripts.blob_store import BlobStore, link_replace
+from scripts.scanner import Scanner, is_generated
+from scripts.decode import decode_image, get_backend
+from scripts import constants as const
+from scripts.lazy import lazy_import
+from scripts.instrument import instrument
+
+# Heavy dependencies are only imported when a method needs them
+pd = lazy_import("pandas")
+cv2 = lazy_import("cv2")
+plt = lazy_import("matplotlib.pyplot")
 
 styler = Styler()
 
 
 class Leon:
-    def read_zip(self, path):
+    def read_zip(self, path, extract=True):
         """
         Extracts a ZIP file, reads the image files contained within it, and deletes the ZIP file afterwards.
 
         Parameters:
             path (str): The path to the ZIP file.
+            extract (bool): Whether to extract and delete the archive. If False, the archive is
+                kept and read in place through a ZipImageSource. Default is True.
 
         Returns:
-            list of PIL.Image.Image: List of Image objects containing the images from the ZIP file.
+            ZipImageSource: The image source of the archive, if extract is False.
         """
         if not os.path.exists(path):
             print(f"File not found: {path} or has been unzipped.")
             return
 
+        if not extract:
+            return self.open_zip(path)
+
         # Get the directory where the ZIP file will be extracted
         extract_dir = os.path.splitext(path)[0]
 
@@ -53,136 +73,177 @@ class Leon:
         # Delete the ZIP file
         os.remove(path)
 
+    def open_zip(self, path):
+        """
+        Opens a ZIP file as an image source without extracting it.
+
+        The paths of the source, such as data_1.zip/raw/beds/Modern/1.jpg, can be passed to
+        load_data_frame, detect_duplicates and augment_images like paths on disk.
+
+        Parameters:
+            path (str): The path to the ZIP file.
+
+        Returns:
+            ZipImageSource: The image source indexing the members of the archive.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File not found: {path}")
+
+        return ZipImageSource(path)
+
+    def iter_images(
+        self, path, limit=-1, size=None, batch_size=None, prefetch=16, workers=4
+    ):
+        """
+        Streams the images of a directory while a thread pool prefetches the next decodes.
+
+        Memory stays bounded by the prefetch window, so arbitrarily large directories can be
+        processed in constant memory.
+
+        Parameters:
+            path (str): The directory or ZIP file containing the image files.
+            limit (int): Maximum number of images to read. Default is -1 (all images).
+            size (tuple): The (width, height) images are resized to, as RGB. Required for batches. Default is None.
+            batch_size (int): If set, yield (paths, uint8 array) batches instead of single images. Default is None.
+            prefetch (int): Maximum number of decodes in flight. Default is 16.
+            workers (int): Number of decoding threads. Default is 4.
+
+        Returns:
+            ImageStream: An iterable of (path, image) pairs, or of (paths, batch) pairs if batch_size is set.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Directory not found: {path}")
+
+        image_paths = self._image_paths(path)
+        if limit != -1:
+            image_paths = islice(image_paths, limit)
+
+        return ImageStream(
+            image_paths,
+            size=size,
+            batch_size=batch_size,
+            prefetch=prefetch,
+            workers=workers,
+        )
+
     def read_images(self, path, limit=10, show=True):
         """
         Reads image files contained within the directory.
 
         Parameters:
-            extract_dir (str): The directory containing the image files.
+            path (str): The directory or ZIP file containing the image files.
             limit (int): Maximum number of images to read. Default is 10.
             show (bool): Whether to display the images. Default is True.
         Returns:
             list of PIL.Image.Image: List of Image objects containing the images.
         """
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"Directory not found: {path}")
-
         images = []
-        count = 0
-
-        # Read the images from the directory
-        for root, _, files in os.walk(path):
-            for file in files:
-                if file.endswith((".png", ".jpg", ".jpeg")):
-                    # Open the image file
-                    image_path = os.path.join(root, file)
-
-                    # Read the image and close the file  afterwards
-                    with open(image_path, "rb") as f:
-                        image = Image.open(f)
-
-                        # Display the image
-                        if show:
-                            plt.imshow(image)
-                            plt.axis("off")
-                            plt.show()
-                        images.append(image)
-
-                        count += 1
-                        if limit != -1 and count >= limit:
-                            return images
+
+        # The images are fully decoded, so they do not depend on closed file handles
+        for _, image in self.iter_images(path, limit=limit):
+            # Display the image
+            if show:
+                plt.imshow(image)
+                plt.axis("off")
+                plt.show()
+            images.append(image)
 
         # Empty directory
-        if count == 0:
+        if not images:
             print("No images found in the directory.")
 
         return images
 
-    def detect_duplicates(self, path, hash_type="phash", limit=10, is_delete=False):
+    def _image_paths(self, path):
         """
-        Computes the perceptual hash of the images. And return a list of duplicate images.
+        Lazily list the image files of a directory or ZIP file.
 
         Parameters:
-            path (str): The path to the directory containing the images.
-            hash_type (str): Type of hash to use ("phash", "dhash", or "ahash").
-            limit (int): Maximum number of duplicate images to display.
-            is_delete (bool): Whether to delete the duplicate images.
+            path (str): The directory or ZIP file containing the image files.
+
+        Yields:
+            str: The image paths.
+        """
+        for entry in Scanner(stat=False).scan(path):
+            yield entry.path
+
+    @instrument.timed("detect_duplicates")
+    def detect_duplicates(
+        self,
+        path,
+        hash_type="phash",
+        limit=10,
+        is_delete=False,
+        max_distance=0,
+        workers=None,
+        ssim_threshold=0.9,
+        candidate_distance=8,
+        store=None,
+    ):
+        """
+        Computes the perceptual hash of the images. And return the groups of duplicate images.
+
+        With hash_type "ssim", the perceptual hashes propose candidate pairs and only those
+        pairs are compared with SSIM on downscaled grayscale images.
+
+        Parameters:
+            path (str): The path to the directory or ZIP file containing the images.
+            hash_type (str): Type of hash to use ("phash", "dhash", "ahash" or "ssim").
+            limit (int): Maximum number of images to hash. Use -1 to hash every image.
+            is_delete (bool): Whether to delete the duplicate images, keeping the first image of each group. Every other member is a direct duplicate of it.
+            max_distance (int): Maximum Hamming distance between two near-duplicate hashes. Default is 0 (exact match).
+            workers (int): Number of worker processes used for hashing. Default is the number of CPUs.
+            ssim_threshold (float): Minimum SSIM of two duplicates in "ssim" mode. Default is 0.9.
+            candidate_distance (int): Maximum Hamming distance of a candidate pair in "ssim" mode, whose cost grows quickly with it. Default is 8.
+            store (BlobStore): Store reusing the hashes of images with the same content, as from dedupe_datasets. Default is None.
 
         Returns:
-            list of str: List of perceptual hash strings.
-            list of PIL.Image.Image: List of duplicate images.
+            list of list of str: The image paths of every duplicate group.
         """
         if not os.path.exists(path):
             raise FileNotFoundError(f"Directory not found: {path}")
 
-        # Dictionary to store the hashes of the images
-        hashes = {}
-        duplicate_images = []
-        duplicate_images_dict = {}
-        count = 0
-
-        # Hash function based on the hash_type
-        if hash_type == "phash":
-            hash_function = imagehash.phash
-        elif hash_type == "dhash":
-            hash_function = imagehash.dhash
-        elif hash_type == "ahash":
-            hash_function = imagehash.average_hash
-        else:
-            raise ValueError(
-                "Invalid hash type. Use 'phash', 'dhash', 'ahash' or 'ssim'."
+        finder = DuplicateFinder(
+            hash_type=hash_type,
+            max_distance=max_distance,
+            workers=workers,
+            ssim_threshold=ssim_threshold,
+            candidate_distance=candidate_distance,
+        )
+
+        # Collect the images from the archive or the directory
+        image_paths = list(islice(self._image_paths(path), None if limit == -1 else limit))
+
+        # Hash every content once across the dataset copies. Decoders round differently,
+        # so the hashes of different backends are kept apart.
+        hashes = None
+        if store is not None:
+            hash_type_key = "phash" if hash_type == "ssim" else hash_type
+            hashes = store.cached(
+                f"hash_{hash_type_key}_{get_backend().name}", image_paths, finder.hash_images
             )
 
-        # Read the images from the directory
-        for root, _, files in os.walk(path):
-            for file in files:
-                if file.endswith((".png", ".jpg", ".jpeg")):
-                    # Open the image file
-                    image_path = os.path.join(root, file)
-                    image = Image.open(image_path)
-
-                    # Compute the hash of the image
-                    hash = hash_function(image)
-
-                    # Check if the hash already exists in the dictionary
-                    if hash in hashes:
-                        # Add the duplicate image to the list
-                        hashes[hash].append(image_path)
-                        duplicate_images_dict[hash].append(image)
-                    else:
-                        # Add the hash to the dictionary
-                        hashes[hash] = [image_path]
-                        duplicate_images_dict[hash] = [image]
-                    # Increment the count
-                    count += 1
-                    if limit != -1 and count >= limit:
-                        break
-
-        # Display the duplicate images path
-        for hash, image_paths in hashes.items():
-            if len(image_paths) > 1:
-                counter = len(image_paths)
-                for path in image_paths:
-                    # Delete the duplicate images
-                    if is_delete:
-                        if counter > 1:
-                            os.remove(path)
-                            counter -= 1
-
-        for hash, images in duplicate_images_dict.items():
-            if len(images) > 1:
-                for image in images:
-                    duplicate_images.append(image)
-                    break
+        groups = finder.find(image_paths, hashes=hashes)
+
+        # Delete the duplicate images
+        if is_delete:
+            for group in groups:
+                for duplicate_path in group[1:]:
+                    os.remove(duplicate_path)
+
+        return groups
 
+    @instrument.timed("augment_image")
     def augment_image(
         self,
         image_path,
         output_dir,
         df_train,
         num_images=5,
-        rotation=0.5,
-        contrast=0.5,
+        rotation=0.4,
+        contrast=0.2,
+        seed=None,
+        index=0,
     ):
         """
         Augments an image by applying random transformations.
@@ -192,89 +253,148 @@ class Leon:
             output_dir (str): The directory to save the augmented images.
             num_images (int): The number of augmented images to generate. Default is 5.
             df_train (pd.DataFrame): The DataFrame to store the augmented image paths, classes, styles, widths, and heights.
-            flip_direction (str): The direction to flip the image ("horizontal" or "vertical"). Default is "vertical".
-            rotation (float): The maximum rotation angle in degrees. Default is 0.5.
-            contrast (float): The maximum contrast factor. Default is 0.5.
+            rotation (float): The maximum rotation as a fraction of a full turn. Default is 0.4.
+            contrast (float): The maximum contrast factor. Default is 0.2.
+            seed (int): The seed making the augmentations reproducible. Default is None (a new seed on every call).
+            index (int): The position of the image, drawing its own transformations for a given seed. Default is 0.
         """
         # Error handling
         if not os.path.exists(image_path):
             raise FileNotFoundError(f"File not found: {image_path}")
 
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
         if df_train is None:
             raise ValueError("df_train is required.")
 
-        # Data augmentation transformations
-        data_augmentation = Sequential(
-            [
-                layers.RandomFlip("horizontal_and_vertical"),
-                layers.RandomRotation(0.4),
-                layers.RandomCrop(0.8, 0.8),
-                layers.RandomContrast(0.2),
-                layers.RandomZoom(0.3),
-                layers.RandomTranslation(0.2, 0.2),
-                layers.RandomSheer(0.1),
-            ]
-        )
+        # Without a seed, every call draws its own transformations
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
 
-        # Read the image
-        img = cv2.imread(image_path)
-
-        # Convert the image to a numpy array and add a batch dimension
-        img_array = np.expand_dims(img, axis=0)
-
-        image_filename = os.path.basename(image_path).split(".")[0]
-
-        path_parts = image_path.split(os.path.sep)
-
-        # Extract the category and style from the image path
-        category = path_parts[-3]
-        style = path_parts[-2]
-
-        # Apply data augmentation transformations
-        for i in range(num_images):
-            augmented_img = data_augmentation(img_array)
-            augmented_img = (
-                augmented_img.numpy()
-            )  # Convert from TensorFlow tensor to numpy array
-            augmented_img = augmented_img[0]
-
-            # Convert image to correct data type and range for OpenCV
-            augmented_img = np.clip(augmented_img, 0, 255).astype(np.uint8)
-
-            # Save the augmented image
-            filename = f"aug_{image_filename}_{i}.jpg"
-
-            output_path = os.path.join(output_dir, filename)
-            cv2.imwrite(output_path, augmented_img)
-
-            # Add the augmented image to the dataframe
-            new_row = pd.DataFrame(
-                {
-                    "Path": [output_path],
-                    "Category": [category],
-                    "Style": [style],
-                    "Width": [augmented_img.shape[1]],
-                    "Height": [augmented_img.shape[0]],
-                    "MinValue": [np.min(augmented_img)],
-                    "MaxValue": [np.max(augmented_img)],
-                    "StdDev": [np.std(augmented_img)],
-                }
-            )
+        augmenter = Augmenter(rotation=rotation, contrast=contrast, seed=seed, workers=1)
+        new_rows = augmenter.augment_many([image_path], [num_images], output_dir, offset=index)
+
+        return pd.concat([df_train, new_rows], ignore_index=True)
+
+    @instrument.timed("augment_images")
+    def augment_images(
+        self,
+        image_paths,
+        counts,
+        df_train=None,
+        output_dir=None,
+        quality=95,
+        seed=42,
+        workers=None,
+    ):
+        """
+        Augments many images in parallel, following an oversampling plan.
+
+        Parameters:
+            image_paths (list of str): The paths to the image files.
+            counts (list of int): The number of augmented images to generate per path.
+            df_train (pd.DataFrame): The DataFrame the augmented rows are appended to. Default is None.
+            output_dir (str): The directory to save the augmented images. Default is the directory of each image.
+            quality (int): The JPEG quality of the augmented images. Default is 95.
+            seed (int): The seed making the augmentations reproducible. Default is 42.
+            workers (int): Number of worker processes. Default is the number of CPUs.
+
+        Returns:
+            pd.DataFrame: The augmented rows, appended to df_train if provided.
+        """
+        augmenter = Augmenter(quality=quality, seed=seed, workers=workers)
+        new_rows = augmenter.augment_many(image_paths, counts, output_dir)
+
+        if df_train is None:
+            return new_rows
 
-            df_train = pd.concat([df_train, new_row], ignore_index=True)
+        return pd.concat([df_train, new_rows], ignore_index=True)
 
-        return df_train
+    @instrument.timed("split_data_frame")
+    def split_data_frame(self, df, test_size=0.2, seed=42):
+        """
+        Splits the manifest into train and test sets, stratified by category and style.
+
+        Parameters:
+            df (pd.DataFrame): The manifest produced by load_data_frame.
+            test_size (float): Fraction of every category and style in the test set. Default is 0.2.
+            seed (int): The seed of the split. Default is 42.
+
+        Returns:
+            tuple: The train and test DataFrames.
+        """
+        return stratified_split(df, test_size=test_size, seed=seed)
+
+    @instrument.timed("plan_oversampling")
+    def plan_oversampling(self, df, growth=1.3, seed=42):
+        """
+        Computes how many augmented images to generate from every image, so that the
+        styles of every category are balanced.
+
+        The plan can be passed to augment_images: leon.augment_images(plan["Path"], plan["Count"]).
+
+        Parameters:
+            df (pd.DataFrame): The manifest of the training set.
+            growth (float): The minimum growth factor of every style. Default is 1.3.
+            seed (int): The seed of the assignment of the remaining images. Default is 42.
+
+        Returns:
+            pd.DataFrame: The Path, Category, Style and Count of every image to augment.
+        """
+        return oversampling_plan(df, growth=growth, seed=seed)
+
+    @instrument.timed("dedupe_datasets")
+    def dedupe_datasets(self, dirs, store_dir, link=True):
+        """
+        Store the images of the dataset copies once, turning every copy into hard links to the same files.
+
+        Parameters:
+            dirs (list of str): The dataset directories, such as ["data_1/raw", "data_2/raw"].
+            store_dir (str): The directory of the blob store, on the same file system as the datasets.
+            link (bool): Whether to replace the copies by hard links. If False, only the content
+                index is shared. Default is True.
 
-    def load_data_frame(self, dir: str) -> pd.DataFrame:
+        Returns:
+            BlobStore: The store, to pass to load_data_frame, detect_duplicates and resize_many.
+        """
+        store = BlobStore(store_dir)
+
+        for dir in dirs:
+            if not os.path.exists(dir):
+                raise FileNotFoundError(f"Directory not found: {dir}")
+
+            report = store.add(dir, link=link)
+            print(
+                f">>> {dir}: {report['files']} files, {report['new_blobs']} new blobs, "
+                f"{report['linked']} linked ({report['bytes_saved'] / 1e6:.1f} MB saved)"
+            )
+
+        return store
+
+    @instrument.timed("load_data_frame")
+    def load_data_frame(
+        self,
+        dir: str,
+        workers: int = None,
+        chunk_size: int = const.MANIFEST_CHUNK_SIZE,
+        reduce: int = 1,
+        cache=False,
+        store=None,
+        mp_context=None,
+    ) -> "pd.DataFrame":
         """
         Load the images from the directory into a pandas DataFrame.
 
         Parameters:
 
-            dir (str): The directory containing the images.
+            dir (str): The directory or ZIP file containing the images.
+            workers (int): Number of worker processes. Default is the number of CPUs.
+            chunk_size (int): Number of images submitted to a worker at once. Default is 64.
+            reduce (int): Downscaling factor used to compute the pixel statistics. Default is 1 (full resolution).
+            cache (bool or str): Whether to reuse the rows of unchanged files from the manifest cache.
+                A string is used as the path to the cache file. Default is False.
+            store (BlobStore): Store reusing the statistics of images with the same content, as from
+                dedupe_datasets. It takes precedence over cache. Default is None.
+            mp_context (multiprocessing.context.BaseContext): The start method of the worker processes.
+                Default is None (the platform default).
 
         Returns:
 
@@ -283,75 +403,64 @@ class Leon:
         if not os.path.exists(dir):
             raise FileNotFoundError(f"Directory not found: {dir}")
 
-        # Initialize the dictionary to store the data
-        data_dict = {
-            "Path": [],
-            "Category": [],
-            "Style": [],
-            "Width": [],
-            "Height": [],
-            "MinValue": [],
-            "MaxValue": [],
-            "StdDev": [],
-        }
-
-        data_dir = os.path.relpath(dir)
-
-        # Get the categories and styles
-        categories = [
-            folder
-            for folder in os.listdir(data_dir)
-            if os.path.isdir(os.path.join(data_dir, folder))
-        ]
-
-        for category in categories:
-            # Get the styles for each category
-            category_dir = os.path.join(data_dir, category)
-            styles = [
-                folder
-                for folder in os.listdir(category_dir)
-                if os.path.isdir(os.path.join(category_dir, folder))
-            ]
-
-            # Iterate over the styles
-            for style in styles:
-                style_dir = os.path.join(category_dir, style)
-
-                # Iterate over the images in the style directory
-                for file in os.listdir(style_dir):
-                    img_path = os.path.join(style_dir, file)
-                    data_dict["Path"].append(img_path)
-                    data_dict["Category"].append(category)
-                    data_dict["Style"].append(style)
-
-                    # Get width and height of the image
-                    try:
-                        with Image.open(img_path) as img:
-                            width, height = img.size
-                            data_dict["Width"].append(width)
-                            data_dict["Height"].append(height)
+        # Read the headers and statistics of every image in parallel
+        builder = ManifestBuilder(
+            workers=workers, chunk_size=chunk_size, reduce=reduce, mp_context=mp_context
+        )
+
+        # Describe every content once across the dataset copies
+        if store is not None:
+            entries = builder.collect(dir)
+            results = store.cached(
+                f"describe_{reduce}_{builder.decoder}", [img_path for img_path, _, _ in entries], builder.describe
+            )
+            return builder.to_frame(entries, results)
 
-                            # Convert image to numpy array
-                            img_array = np.array(img)
+        if not cache:
+            return builder.build(dir)
 
-                            # Compute statistics
-                            min_val = np.min(img_array)
-                            max_val = np.max(img_array)
-                            std_dev = np.std(img_array)
+        # Only describe the files that changed since the last run
+        cache_path = cache if isinstance(cache, str) else ManifestCache.default_path(dir)
+        manifest_cache = ManifestCache(cache_path)
 
-                            # Add statistics to the dictionary
-                            data_dict["MinValue"].append(min_val)
-                            data_dict["MaxValue"].append(max_val)
-                            data_dict["StdDev"].append(std_dev)
-                    except Exception as e:
-                        print(f"Error processing image '{img_path}': {e}")
+        try:
+            df = manifest_cache.refresh(dir, builder)
+            stats = manifest_cache.stats()
+            print(
+                f">>> Manifest cache: {stats['hits']} hits, {stats['misses']} misses, {stats['removed']} removed"
+            )
+        finally:
+            manifest_cache.close()
+
+        return df
+
+    @instrument.timed("export_shards")
+    def export_shards(self, df, output_dir, size=(256, 256), shard_size=4096, workers=4):
+        """
+        Exports the images of a manifest into memory-mappable uint8 shards.
+
+        Parameters:
+            df (pd.DataFrame): The manifest produced by load_data_frame.
+            output_dir (str): The directory to write the shards to.
+            size (tuple): The (width, height) every image is resized to. Default is (256, 256).
+            shard_size (int): Number of images per shard. Default is 4096.
+            workers (int): Number of decoding threads. Default is 4.
 
-        return pd.DataFrame(data_dict)
+        Returns:
+            ShardReader: The reader of the exported shards.
+        """
+        writer = ShardWriter(output_dir, size=size, shard_size=shard_size, workers=workers)
+        writer.write(df)
 
+        return ShardReader(output_dir)
+
+    @instrument.timed("resize_image")
     def resize_image(self, path, width, height):
         """
         Resizes the image to the specified width and height.
 
+        The image is written through a temporary file, and left untouched if it already has the target size.
+
         Parameters:
             path (str): The path to the image file.
             width (int): The width of the resized image.
@@ -360,17 +469,101 @@ class Leon:
         if not os.path.exists(path):
             raise FileNotFoundError(f"File not found: {path}")
 
-        # Open the image file
-        with open(path, "rb") as f:
-            image = Image.open(f)
+        # Count the bytes before the file is replaced
+        instrument.count_bytes([path])
+        resize_file(path, width, height)
+        instrument.count("files_processed")
 
-            # Resize the image
-            resized_image = image.resize((width, height))
+    @instrument.timed("resize_many")
+    def resize_many(
+        self, paths, width, height, workers=None, use_processes=False, store=None
+    ):
+        """
+        Resizes many images to the specified width and height in parallel.
+
+        Parameters:
+            paths (list of str): The paths to the image files.
+            width (int): The width of the resized images.
+            height (int): The height of the resized images.
+            workers (int): Number of workers. Default is the number of CPUs.
+            use_processes (bool): Whether to use processes instead of threads. Default is False.
+            store (BlobStore): Store keeping the resized file of every content, so that the other
+                dataset copies are linked to it instead of being resized again. Default is None.
+
+        Returns:
+            dict: The number of resized, linked, skipped and failed images, the elapsed seconds and the images per second.
+        """
+        paths = list(paths)
+        resizer = Resizer(width, height, workers=workers, use_processes=use_processes)
+
+        if store is None:
+            report = resizer.resize_many(paths)
+            report["linked"] = 0
+        else:
+            report = self._resize_with_store(resizer, paths, store)
+
+        print(
+            f">>> Resized {report['resized']}, linked {report['linked']}, skipped {report['skipped']}, "
+            f"failed {report['failed']} in {report['seconds']:.2f}s ({report['images_per_second']:.1f} images/s)"
+        )
+
+        return report
+
+    def _resize_with_store(self, resizer, paths, store):
+        """
+        Resize the images whose content has no resized file in the store yet, and link the others to it.
+
+        Parameters:
+            resizer (Resizer): The resizer.
+            paths (list of str): The paths to the image files.
+            store (BlobStore): The store of the resized files.
+
+        Returns:
+            dict: The report of Resizer.resize_many, with the linked images.
+        """
+        kind = f"resized_{resizer.width}x{resizer.height}"
+        start = time.perf_counter()
+        digests = store.digests(paths)
+
+        pending = []
+        linked = 0
+        for path, digest in zip(paths, digests):
+            derived = None
+            if digest is not None:
+                derived = store.derived_path(kind, digest, os.path.splitext(path)[1].lower())
+                if os.path.exists(derived):
+                    try:
+                        link_replace(derived, path)
+                        linked += 1
+                        continue
+                    except OSError:
+                        # The store is on another file system
+                        pass
+            pending.append((path, digest, derived))
+
+        report = resizer.resize_many([path for path, _, _ in pending])
+        report["linked"] = linked
+
+        # Keep the files that were actually resized for the other copies
+        new_digests = store.digests([path for path, _, _ in pending])
+        for (path, digest, derived), new_digest in zip(pending, new_digests):
+            if derived is None or new_digest in (None, digest) or os.path.exists(derived):
+                continue
+            os.makedirs(os.path.dirname(derived), exist_ok=True)
+            try:
+                os.link(path, derived)
+            except OSError:
+                shutil.copy2(path, derived)
+
+        report["seconds"] = time.perf_counter() - start
+        report["images_per_second"] = (
+            len(paths) / report["seconds"] if report["seconds"] > 0 else 0.0
+        )
 
-            # Save the resized image
-            resized_image.save(path)
+        return report
 
-    def normalize_image(self, image_path, min_value=0, max_value=1):
+    @instrument.timed("normalize_image")
+    def normalize_image(self, image_path, min_value=0, max_value=1, out=None, verbose=True):
         """
         Normalize the pixel values of an image to the range [0, 1].
 
@@ -378,9 +571,11 @@ class Leon:
             image_path (str): The path to the image file.
             min_value (float): The minimum value of the normalized range. Default is 0.
             max_value (float): The maximum value of the normalized range. Default is 1.
+            out (np.ndarray): A preallocated float32 array of the image shape to write to. Default is None.
+            verbose (bool): Whether to print the progress. Default is True.
 
         Returns:
-            str: The path to the normalized image.
+            np.ndarray: The normalized image.
         """
         if not os.path.exists(image_path):
             raise FileNotFoundError(f"File not found: {image_path}")
@@ -393,96 +588,149 @@ class Leon:
         if min_value >= max_value:
             raise ValueError("min_value must be less than max_value")
 
-        styler.boxify(f"Normalizing image: {image_path}")
-        # Open the image
-        image = cv2.imread(image_path)
+        if verbose:
+            styler.boxify(f"Normalizing image: {image_path}")
+        # Decode the image as RGB, as every other method does
+        image = decode_image(image_path)
 
         # Normalize the pixel values to the range [0, 1]
         normalized_image = cv2.normalize(
-            image, None, min_value, max_value, cv2.NORM_MINMAX, dtype=cv2.CV_32F
+            image, out, min_value, max_value, cv2.NORM_MINMAX, dtype=cv2.CV_32F
         )
 
-        print(">>> Processed successfully")
+        if verbose:
+            print(">>> Processed successfully")
 
         return normalized_image
 
-    def remove_folder(self, path):
+    def normalize_images(
+        self, images, out=None, mode="minmax", stats=None, min_value=0, max_value=1
+    ):
+        """
+        Normalize a batch of images into a preallocated float32 array.
+
+        The batch can stay in uint8 storage (e.g. a shard view); only the output is float32.
+
+        Parameters:
+            images (np.ndarray): The batch of shape (N, H, W, C).
+            out (np.ndarray): A preallocated float32 array of the same shape to write to. Default is None (allocated).
+            mode (str): "minmax" to scale each image to [min_value, max_value], or "standard" to use the dataset statistics.
+            stats (DatasetStats or str): The dataset statistics, or the path to their JSON file. Required for "standard".
+            min_value (float): The minimum value of the "minmax" range. Default is 0.
+            max_value (float): The maximum value of the "minmax" range. Default is 1.
+
+        Returns:
+            np.ndarray: The normalized batch.
+        """
+        if out is None:
+            out = np.empty(images.shape, dtype=np.float32)
+
+        if out.shape != images.shape or out.dtype != np.float32:
+            raise ValueError("out must be a float32 array of the same shape as images")
+
+        if mode == "minmax":
+            if min_value >= max_value:
+                raise ValueError("min_value must be less than max_value")
+            return normalize_minmax(images, out, min_value, max_value)
+
+        if mode == "standard":
+            if stats is None:
+                raise ValueError("stats is required for standard normalization.")
+            if isinstance(stats, str):
+                stats = DatasetStats.load(stats)
+            return normalize_standard(images, out, stats.mean, stats.std)
+
+        raise ValueError("Invalid mode. Use 'minmax' or 'standard'.")
+
+    @instrument.timed("dataset_stats")
+    def dataset_stats(self, df, path=None, size=(256, 256), batch_size=256, workers=4):
+        """
+        Compute the per-channel mean and standard deviation of a dataset in one streaming pass.
+
+        Parameters:
+            df (pd.DataFrame): The manifest produced by load_data_frame.
+            path (str): The JSON file to persist the statistics to. Default is None.
+            size (tuple): The (width, height) images are resized to. Default is (256, 256).
+            batch_size (int): Number of images per chunk. Default is 256.
+            workers (int): Number of decoding threads. Default is 4.
+
+        Returns:
+            DatasetStats: The statistics, in RGB channel order and the uint8 [0, 255] scale.
+        """
+        stats = DatasetStats.compute(
+            df["Path"], size=size, batch_size=batch_size, workers=workers
+        )
+
+        if path:
+            stats.save(path)
+
+        return stats
+
+    def remove_folder(self, path, confirm=True):
         """
         Removes a folder and its contents.
 
         Parameters:
             path (str): The path to the folder to remove.
+            confirm (bool): Whether to ask for a confirmation first. Pass False in unattended runs. Default is True.
         """
         if not os.path.exists(path):
             raise FileNotFoundError(f"Folder not found: {path}")
 
-        print(
-            "This is a destructive operation as folder will be deleted permanently. Are you sure you want to continue? (y/n)"
-        )
+        if confirm:
+            print(
+                "This is a destructive operation as folder will be deleted permanently. Are you sure you want to continue? (y/n)"
+            )
 
-        response = input()
+            response = input()
 
-        if response.lower() != "y" and response.lower() != "yes":
-            print("Operation cancelled.")
-            return
+            if response.lower() != "y" and response.lower() != "yes":
+                print("Operation cancelled.")
+                return
 
         shutil.rmtree(path)
 
     # Remove output folders and files generated by the previous run
 
-    def remove_nonraw_files(self, img_paths=[]):
+    def remove_nonraw_files(self, img_paths=[], confirm=True):
         """
         Removes output folders and files generated by the previous run.
 
         Parameters:
             img_paths (list[str]): List of image paths in the training set.
+            confirm (bool): Whether to ask for a confirmation first. Pass False in unattended runs. Default is True.
         """
         # Check if img_paths is provided
         if not img_paths:
             raise ValueError("img_paths is required.")
 
         # Confirm with the user before proceeding
-        print(
-            "This is a destructive operation as files will be deleted permanently. Are you sure you want to continue? (y/n)"
-        )
+        if confirm:
+            print(
+                "This is a destructive operation as files will be deleted permanently. Are you sure you want to continue? (y/n)"
+            )
 
-        response = input()
+            response = input()
 
-        if response.lower() != "y" and response.lower() != "yes":
-            print("Operation cancelled.")
-            return
+            if response.lower() != "y" and response.lower() != "yes":
+                print("Operation cancelled.")
+                return
 
         print("\nPlease wait and do not interrupt the process.\n")
         print("Removing non-raw files...\n")
 
-        # Initialize set to store processed directories
-        processed_directories = set()
-
-        # Get all image path in the training set
-        for img_path in img_paths:
-            # Extract directory name
-            directory = os.path.dirname(img_path)
+        # Scan every directory of the training set once, in parallel
+        directories = sorted({os.path.dirname(img_path) for img_path in img_paths})
+        scanner = Scanner(stat=False)
 
-            # Check if directory has already been processed
-            if directory in processed_directories:
-                continue
-
-            # Add directory to the set of processed directories
-            processed_directories.add(directory)
-
-            # Remove files starting with "augmented_" if they exist
-            files_in_directory = os.listdir(directory)
-            for file_name in files_in_directory:
-                # Check if file name starts with "aug_"
-                if file_name.startswith("aug_") or file_name.endswith("_norm.jpg"):
-                    # Construct file path
-                    file_path = os.path.join(directory, file_name)
-
-                    # Remove file
-                    try:
-                        os.remove(file_path)
-                    except OSError as e:
-                        print(f"Error removing file: {file_path}, {e}")
+        for entry in scanner.scan(directories, depth=0):
+            # Augmented ("aug_") and normalized ("_norm.jpg") files
+            if is_generated(os.path.basename(entry.path)):
+                # Remove file
+                try:
+                    os.remove(entry.path)
+                except OSError as e:
+                    print(f"Error removing file: {entry.path}, {e}")
 
     def get_image_paths(self, directory):
         """
@@ -497,15 +745,5 @@ class Leon:
         if not os.path.exists(directory):
             raise FileNotFoundError(f"Directory not found: {directory}")
 
-        image_paths = []
-        # Walk through the directory and its subdirectories
-        for root, dirs, files in os.walk(directory):
-            # Iterate over the files in the current directory
-            for file in files:
-                # Check if the file is an image (you can modify this condition as needed)
-                if file.endswith((".jpg")):
-                    # Construct the full path to the image file
-                    image_path = os.path.join(root, file)
-                    # Add the image path to the list
-                    image_paths.append(image_path)
-        return image_paths
+        # Walk through the directory and its subdirectories in parallel
+        return Scanner(stat=False).paths(directory)
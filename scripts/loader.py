@@ -0,0 +1,215 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scripts.augment import Augmenter, augment_batch
+from scripts.stream import load_array
+from scripts.instrument import instrument
+from scripts.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+
+class AugmentingLoader:
+    def __init__(
+        self,
+        df,
+        plan=None,
+        y_col="Style",
+        class_mode="categorical",
+        classes=None,
+        size=(256, 256),
+        batch_size=32,
+        augmenter=None,
+        shuffle=True,
+        seed=42,
+        workers=4,
+        prefetch=8,
+        rescale=1.0 / 255,
+    ):
+        """
+        Training data loader that augments the oversampled images in memory.
+
+        An epoch holds every image of the manifest once, plus the augmented samples of
+        the oversampling plan, generated on the fly instead of being written as aug_ files.
+        Batches are decoded and augmented by a thread pool while the model trains on the
+        previous ones.
+
+        Parameters:
+            df (pd.DataFrame): The manifest of the training set, with the Path column and y_col.
+            plan (pd.DataFrame): The Path and Count of the augmented samples, as from oversampling_plan. Default is None (no oversampling).
+            y_col (str): The label column. Default is "Style".
+            class_mode (str): "categorical" for one-hot labels, "sparse" for class indices, or None for images only. Default is "categorical".
+            classes (list of str): The class names in index order. Default is the sorted labels of df.
+            size (tuple): The (width, height) of the images. Default is (256, 256).
+            batch_size (int): Number of samples per batch. Default is 32.
+            augmenter (Augmenter): The augmentation parameters. Default is Augmenter().
+            shuffle (bool): Whether to shuffle the samples at every epoch. Default is True.
+            seed (int): The seed of the order and the augmentations. Default is 42.
+            workers (int): Number of decoding threads. Default is 4.
+            prefetch (int): Number of batches prepared ahead. Default is 8.
+            rescale (float): Factor applied to the uint8 pixels. Default is 1/255.
+        """
+        if class_mode not in ("categorical", "sparse", None):
+            raise ValueError("class_mode must be 'categorical', 'sparse' or None")
+
+        self.size = tuple(size)
+        self.batch_size = batch_size
+        self.class_mode = class_mode
+        self.params = (augmenter or Augmenter()).params
+        self.shuffle = shuffle
+        self.seed = seed
+        self.workers = workers or os.cpu_count() or 1
+        self.prefetch = max(prefetch, 1)
+        self.rescale = rescale
+        self.epoch = 0
+
+        # Class indices in sorted order, as flow_from_dataframe assigns them
+        self.classes = list(classes) if classes is not None else sorted(df[y_col].unique())
+        self.class_indices = {name: i for i, name in enumerate(self.classes)}
+
+        # Originals first, then the augmented samples of the plan
+        paths = df["Path"].to_numpy()
+        labels = df[y_col].map(self.class_indices).to_numpy()
+        augmented = np.zeros(len(paths), dtype=bool)
+
+        if plan is not None and len(plan):
+            plan_rows = pd.Index(df["Path"]).get_indexer(plan["Path"])
+            if (plan_rows < 0).any():
+                raise ValueError("Some paths of the plan are not in the manifest.")
+            repeats = plan["Count"].to_numpy()
+
+            paths = np.concatenate([paths, np.repeat(paths[plan_rows], repeats)])
+            labels = np.concatenate([labels, np.repeat(labels[plan_rows], repeats)])
+            augmented = np.concatenate([augmented, np.ones(repeats.sum(), dtype=bool)])
+
+        if np.isnan(labels.astype(np.float64)).any():
+            raise ValueError(f"Some labels of {y_col} are not in classes.")
+
+        self.paths = paths
+        self.labels = labels.astype(np.int64)
+        self.augmented = augmented
+
+    def __len__(self):
+        """Number of batches per epoch."""
+        return -(-len(self.paths) // self.batch_size)
+
+    @property
+    def samples(self):
+        """Number of samples per epoch."""
+        return len(self.paths)
+
+    def order(self, epoch):
+        """Get the sample order of an epoch."""
+        if not self.shuffle:
+            return np.arange(len(self.paths))
+        return np.random.default_rng([self.seed, epoch]).permutation(len(self.paths))
+
+    def load_batch(self, rows, epoch, index):
+        """
+        Decode, augment and scale the samples of a batch.
+
+        Parameters:
+            rows (np.ndarray): The samples of the batch.
+            epoch (int): The epoch, part of the seed of the augmentations.
+            index (int): The batch index, part of the seed of the augmentations.
+
+        Returns:
+            tuple: The float32 images of shape (N, height, width, 3), and their labels unless class_mode is None.
+        """
+        width, height = self.size
+        images = np.empty((len(rows), height, width, 3), dtype=np.uint8)
+
+        for i, row in enumerate(rows):
+            images[i] = load_array(self.paths[row], self.size)
+
+        # The same batch gets the same augmentations whatever the thread scheduling
+        augmented = np.flatnonzero(self.augmented[rows])
+        if len(augmented):
+            rng = np.random.default_rng([self.seed, epoch, index])
+            images[augmented] = augment_batch(images[augmented], rng, self.params)
+
+        x = np.multiply(images, np.float32(self.rescale), dtype=np.float32)
+
+        if self.class_mode is None:
+            return x
+
+        labels = self.labels[rows]
+        if self.class_mode == "sparse":
+            return x, labels
+
+        y = np.zeros((len(rows), len(self.classes)), dtype=np.float32)
+        y[np.arange(len(rows)), labels] = 1.0
+        return x, y
+
+    def batches(self, epoch=None):
+        """
+        Yield the batches of one epoch while the next ones are prepared.
+
+        Parameters:
+            epoch (int): The epoch to generate. Default is the next epoch.
+
+        Yields:
+            tuple: The images and labels of every batch, or the images only if class_mode is None.
+        """
+        if epoch is None:
+            epoch = self.epoch
+            self.epoch += 1
+
+        order = self.order(epoch)
+        tasks = iter(range(len(self)))
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def submit():
+                # Keep the window of prepared batches full
+                for index in tasks:
+                    rows = order[index * self.batch_size : (index + 1) * self.batch_size]
+                    pending.append(executor.submit(self.load_batch, rows, epoch, index))
+                    if len(pending) >= self.prefetch:
+                        return
+
+            submit()
+            while pending:
+                future = pending.popleft()
+                submit()
+                batch = future.result()
+                instrument.count("files_processed", len(batch[0] if self.class_mode else batch))
+                yield batch
+
+    def __iter__(self):
+        return self.batches()
+
+    def forever(self):
+        """
+        Yield batches epoch after epoch, for model.fit with steps_per_epoch=len(loader).
+
+        Yields:
+            tuple: The images and labels of every batch.
+        """
+        while True:
+            yield from self.batches()
+
+    def to_tf_dataset(self):
+        """
+        Wrap the loader in a tf.data.Dataset repeating over epochs.
+
+        Use it with model.fit(dataset, steps_per_epoch=len(loader)).
+
+        Returns:
+            tf.data.Dataset: The dataset.
+        """
+        import tensorflow as tf
+
+        width, height = self.size
+        image_spec = tf.TensorSpec((None, height, width, 3), tf.float32)
+        if self.class_mode == "categorical":
+            spec = (image_spec, tf.TensorSpec((None, len(self.classes)), tf.float32))
+        elif self.class_mode == "sparse":
+            spec = (image_spec, tf.TensorSpec((None,), tf.int64))
+        else:
+            spec = image_spec
+
+        # The loader prefetches on its own threads already
+        return tf.data.Dataset.from_generator(self.forever, output_signature=spec)
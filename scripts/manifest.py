@@ -0,0 +1,209 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scripts import constants as const
+from scripts.zip_source import read_bytes
+from scripts.decode import decode_image, image_size, get_backend
+from scripts.scanner import Scanner
+from scripts.lazy import lazy_import
+from scripts.instrument import instrument
+from scripts.blob_store import map_unique
+
+pd = lazy_import("pandas")
+
+# Version of the statistics computed by describe_image, bumped when their semantics change
+# (since 2: computed on RGB through the decode layer), so that cached rows are recomputed
+DESCRIBE_VERSION = 2
+
+# Types of the values returned by describe_image, restored on cached rows
+DESCRIBE_TYPES = (int, int, np.uint8, np.uint8, float)
+
+
+def pixel_stats(img_array):
+    """
+    Compute the minimum, maximum and standard deviation of an image array.
+
+    8-bit images are reduced to a 256-bin histogram in a single pass, and the
+    statistics are derived from the histogram instead of scanning the array three times.
+
+    Parameters:
+        img_array (np.ndarray): The image array.
+
+    Returns:
+        tuple: The minimum value, maximum value and standard deviation.
+    """
+    if img_array.dtype != np.uint8:
+        return np.min(img_array), np.max(img_array), np.std(img_array)
+
+    # Count every pixel value in one pass
+    counts = np.bincount(img_array.ravel(), minlength=256)
+    values = np.nonzero(counts)[0]
+
+    # Derive the statistics from the histogram
+    levels = np.arange(256, dtype=np.float64)
+    total = counts.sum()
+    mean = np.dot(counts, levels) / total
+    std_dev = np.sqrt(np.dot(counts, (levels - mean) ** 2) / total)
+
+    return np.uint8(values[0]), np.uint8(values[-1]), std_dev
+
+
+def describe_image(img_path, reduce=1):
+    """
+    Read the dimensions and pixel statistics of an image.
+
+    The width and height come from the image header. When reduce is greater than 1,
+    the statistics are computed on a reduced-scale decode (JPEG DCT scaling). The
+    statistics are computed on the RGB pixels, whatever the mode of the file.
+
+    Parameters:
+        img_path (str): The path to the image file.
+        reduce (int): The downscaling factor used to compute the statistics. Default is 1.
+
+    Returns:
+        tuple: The width, height, minimum value, maximum value and standard deviation.
+    """
+    data = read_bytes(img_path)
+    min_size = None
+
+    if reduce > 1:
+        # Width and height are available without decoding the pixels
+        width, height = image_size(data)
+        min_size = (-(-width // reduce), -(-height // reduce))
+
+    # Let the JPEG decoder skip the DCT coefficients we do not need
+    pixels, (width, height) = decode_image(data, min_size=min_size, return_size=True)
+    min_val, max_val, std_dev = pixel_stats(pixels)
+
+    return width, height, min_val, max_val, std_dev
+
+
+def _describe_safe(task):
+    """Describe an image inside a worker process, returning the error instead of raising it."""
+    img_path, reduce = task
+    try:
+        return describe_image(img_path, reduce)
+    except Exception as e:
+        return e
+
+
+class ManifestBuilder:
+    def __init__(
+        self, workers=None, chunk_size=const.MANIFEST_CHUNK_SIZE, reduce=1, mp_context=None
+    ):
+        """
+        Builds the image manifest of a dataset directory in parallel.
+
+        Parameters:
+            workers (int): Number of worker processes. Default is the number of CPUs.
+            chunk_size (int): Number of images submitted to a worker at once. Default is 64.
+            reduce (int): The downscaling factor used to compute the statistics. Default is 1.
+            mp_context (multiprocessing.context.BaseContext): The start method of the worker processes.
+                Default is None (the platform default).
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.reduce = reduce
+        self.mp_context = mp_context
+
+    @property
+    def decoder(self):
+        """The version of the statistics and the decode backend computing them, which cached rows must match."""
+        return f"v{DESCRIBE_VERSION}-{get_backend().name}"
+
+    def scan(self, dir):
+        """
+        Scan the images of a dataset directory laid out as <category>/<style>/<file>, with their stat information.
+
+        A ZIP archive can be given instead of a directory; its members are listed without extracting it.
+
+        Parameters:
+            dir (str): The directory or ZIP archive containing the images.
+
+        Returns:
+            list of ScanEntry: The entry of every image, in sorted order.
+        """
+        if not os.path.exists(dir):
+            raise FileNotFoundError(f"Directory not found: {dir}")
+
+        return list(Scanner().scan(os.path.relpath(dir), depth=2))
+
+    def collect(self, dir):
+        """
+        List the images of a dataset directory laid out as <category>/<style>/<file>.
+
+        Parameters:
+            dir (str): The directory or ZIP archive containing the images.
+
+        Returns:
+            list of tuple: The image path, category and style of every file.
+        """
+        return [(entry.path, entry.category, entry.style) for entry in self.scan(dir)]
+
+    def describe(self, img_paths):
+        """
+        Describe the images, fanning out chunks of paths to a process pool.
+
+        Hard links to the same file, as in deduplicated dataset copies, are described once.
+
+        Parameters:
+            img_paths (list of str): The image paths.
+
+        Returns:
+            list: The result of describe_image for every path, or the exception raised for it.
+        """
+        return map_unique(list(img_paths), self._describe_files)
+
+    def _describe_files(self, img_paths):
+        """Describe distinct image files, in a process pool if the job is large enough."""
+        tasks = [(img_path, self.reduce) for img_path in img_paths]
+        instrument.count_bytes(img_paths)
+
+        # Small jobs are not worth the cost of starting the pool
+        if self.workers <= 1 or len(tasks) <= self.chunk_size:
+            return [_describe_safe(task) for task in tasks]
+
+        # The workers inherit or read the decode backend of this host
+        get_backend()
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context) as executor:
+            return list(executor.map(_describe_safe, tasks, chunksize=self.chunk_size))
+
+    def build(self, dir):
+        """
+        Build the manifest DataFrame of a dataset directory.
+
+        Parameters:
+            dir (str): The directory containing the images.
+
+        Returns:
+            pd.DataFrame: A DataFrame containing the image paths, classes, styles, widths, heights and pixel statistics.
+        """
+        entries = self.collect(dir)
+        results = self.describe([img_path for img_path, _, _ in entries])
+
+        return self.to_frame(entries, results)
+
+    @staticmethod
+    def to_frame(entries, results):
+        """
+        Assemble the manifest DataFrame, skipping the images that could not be processed.
+
+        Parameters:
+            entries (list of tuple): The image path, category and style of every file.
+            results (list): The result of describe_image for every entry.
+
+        Returns:
+            pd.DataFrame: The manifest DataFrame.
+        """
+        rows = []
+        for (img_path, category, style), result in zip(entries, results):
+            if isinstance(result, Exception):
+                print(f"Error processing image '{img_path}': {result}")
+                instrument.count("decode_failures")
+                continue
+
+            rows.append((img_path, category, style) + tuple(result))
+
+        instrument.count("files_processed", len(rows))
+
+        return pd.DataFrame(rows, columns=const.MANIFEST_COLUMNS)
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+from scripts.manifest import DESCRIBE_TYPES
+
+
+class ManifestCache:
+    # The columns identifying a row, before the statistics
+    COLUMNS = ("key", "size", "mtime_ns", "reduce", "decoder")
+
+    def __init__(self, cache_path):
+        """
+        On-disk cache of manifest rows keyed by file path, size and modification time.
+
+        Members of ZIP archives are keyed by their CRC instead of a modification time.
+        Rows computed with another reduce factor, statistics version or decode backend are stale.
+
+        Parameters:
+            cache_path (str): The path to the SQLite cache file.
+        """
+        self.cache_path = cache_path
+
+        # Counters of the last refresh
+        self.hits = 0
+        self.misses = 0
+        self.removed = 0
+
+        self.connection = sqlite3.connect(cache_path)
+
+        # Caches written before a column was added are dropped, their rows cannot be checked
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(manifest)")]
+        if columns and columns[: len(self.COLUMNS)] != list(self.COLUMNS):
+            self.connection.execute("DROP TABLE manifest")
+
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS manifest (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                reduce INTEGER NOT NULL,
+                decoder TEXT NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                min_value REAL,
+                max_value REAL,
+                std_dev REAL
+            )
+            """
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def default_path(dir):
+        """
+        Get the default cache file of a data directory, stored next to it.
+
+        Parameters:
+            dir (str): The data directory.
+
+        Returns:
+            str: The path to the cache file, e.g. data_1/.raw_manifest.sqlite for data_1/raw.
+        """
+        dir = os.path.abspath(dir)
+        return os.path.join(
+            os.path.dirname(dir), f".{os.path.basename(dir)}_manifest.sqlite"
+        )
+
+    def refresh(self, dir, builder):
+        """
+        Load the manifest of a directory, only describing new or modified files.
+
+        Rows of files that no longer exist in the directory are dropped from the cache.
+        Rows of other directories sharing the cache file are left untouched.
+
+        Parameters:
+            dir (str): The directory containing the images.
+            builder (ManifestBuilder): The builder used to list and describe the images.
+
+        Returns:
+            pd.DataFrame: The manifest DataFrame.
+        """
+        # The scan reads the signature of every file along the way
+        scanned = builder.scan(dir)
+        entries = [(entry.path, entry.category, entry.style) for entry in scanned]
+
+        # Read the cached rows of this directory once; the keys under it sort between
+        # the prefix and the prefix with its separator incremented
+        prefix = os.path.join(os.path.abspath(dir), "")
+        bounds = (prefix, prefix[:-1] + chr(ord(os.sep) + 1))
+        cached = {
+            row[0]: row[1:]
+            for row in self.connection.execute(
+                "SELECT * FROM manifest WHERE key >= ? AND key < ?", bounds
+            )
+        }
+
+        decoder = builder.decoder
+        keys = []
+        results = [None] * len(entries)
+        stale = []
+
+        for index, entry in enumerate(scanned):
+            key = os.path.abspath(entry.path)
+            size, version = entry.signature
+            keys.append((key, size, version, builder.reduce, decoder))
+
+            row = cached.pop(key, None)
+
+            # Reuse the statistics if the file is unchanged and they were computed the same way
+            if row is not None and tuple(row[:4]) == (size, version, builder.reduce, decoder):
+                # SQLite hands back floats, restore the types of describe_image
+                results[index] = tuple(
+                    cast(value) for cast, value in zip(DESCRIBE_TYPES, row[4:])
+                )
+            else:
+                stale.append(index)
+
+        # Describe the new and modified files only
+        described = builder.describe([entries[index][0] for index in stale])
+
+        upserts = []
+        for index, result in zip(stale, described):
+            results[index] = result
+
+            if not isinstance(result, Exception):
+                upserts.append(keys[index] + tuple(float(value) for value in result))
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", upserts
+        )
+
+        # Whatever is left in the cache has been deleted from the directory
+        self.connection.executemany(
+            "DELETE FROM manifest WHERE key = ?", [(key,) for key in cached]
+        )
+        self.connection.commit()
+
+        self.hits = len(entries) - len(stale)
+        self.misses = len(stale)
+        self.removed = len(cached)
+
+        return builder.to_frame(entries, results)
+
+    def stats(self):
+        """
+        Get the counters of the last refresh.
+
+        Returns:
+            dict: The number of hits, misses and removed rows, and the hit rate.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "removed": self.removed,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        """Remove every row from the cache."""
+        self.connection.execute("DELETE FROM manifest")
+        self.connection.commit()
+
+    def close(self):
+        """Close the cache file."""
+        self.connection.close()
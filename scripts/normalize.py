@@ -0,0 +1,176 @@
+import json
+import numpy as np
+from scripts.stream import ImageStream
+
+
+def normalize_minmax(images, out, min_value=0.0, max_value=1.0):
+    """
+    Scale every image of a batch to [min_value, max_value] using its own minimum and maximum.
+
+    Matches cv2.normalize with cv2.NORM_MINMAX, applied to each image as a whole.
+
+    Parameters:
+        images (np.ndarray): The batch of shape (N, H, W, C), typically uint8.
+        out (np.ndarray): The preallocated float32 array of the same shape to write to.
+        min_value (float): The minimum value of the normalized range. Default is 0.
+        max_value (float): The maximum value of the normalized range. Default is 1.
+
+    Returns:
+        np.ndarray: The out array.
+    """
+    axes = tuple(range(1, images.ndim))
+    lows = images.min(axis=axes, keepdims=True).astype(np.float32)
+    highs = images.max(axis=axes, keepdims=True).astype(np.float32)
+
+    # Constant images map to min_value, as with cv2.normalize
+    scales = (max_value - min_value) / np.where(highs > lows, highs - lows, np.inf)
+
+    np.subtract(images, lows, out=out)
+    np.multiply(out, scales, out=out)
+    np.add(out, min_value, out=out)
+
+    return out
+
+
+def normalize_standard(images, out, mean, std):
+    """
+    Standardize a batch with the per-channel dataset mean and standard deviation.
+
+    Parameters:
+        images (np.ndarray): The batch of shape (N, H, W, C), typically uint8.
+        out (np.ndarray): The preallocated float32 array of the same shape to write to.
+        mean (np.ndarray): The mean of every channel.
+        std (np.ndarray): The standard deviation of every channel.
+
+    Returns:
+        np.ndarray: The out array.
+    """
+    np.subtract(images, np.asarray(mean, dtype=np.float32), out=out)
+    np.divide(out, np.maximum(np.asarray(std, dtype=np.float32), 1e-12), out=out)
+
+    return out
+
+
+class DatasetStats:
+    # Number of pixels converted to float64 at once, 6 MB for 3 channels
+    CHUNK_PIXELS = 1 << 18
+
+    def __init__(self, channels=3):
+        """
+        Streaming per-channel mean and standard deviation (Welford / Chan merge).
+
+        Parameters:
+            channels (int): Number of channels. Default is 3.
+        """
+        self.count = 0
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+
+    def update(self, batch):
+        """
+        Merge the pixels of a batch into the statistics.
+
+        The batch is converted to float64 a chunk of pixels at a time, so the
+        temporaries stay a few MB whatever the batch size.
+
+        Parameters:
+            batch (np.ndarray): The batch of shape (N, H, W, C).
+        """
+        pixels = batch.reshape(-1, batch.shape[-1])
+
+        for start in range(0, len(pixels), self.CHUNK_PIXELS):
+            chunk = pixels[start : start + self.CHUNK_PIXELS].astype(np.float64)
+
+            # Statistics of the chunk alone, computed in place
+            chunk_mean = chunk.mean(axis=0)
+            np.subtract(chunk, chunk_mean, out=chunk)
+            np.square(chunk, out=chunk)
+
+            self.merge(len(chunk), chunk_mean, np.add.reduce(chunk, axis=0))
+
+    def merge(self, count, mean, m2):
+        """
+        Merge the statistics of other pixels into the running statistics.
+
+        Parameters:
+            count (int): The number of pixels.
+            mean (np.ndarray): Their per-channel mean.
+            m2 (np.ndarray): Their per-channel sum of squared deviations from the mean.
+        """
+        if count == 0:
+            return
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total
+        self.count = total
+
+    @property
+    def std(self):
+        """The per-channel population standard deviation."""
+        return np.sqrt(self.m2 / self.count) if self.count else np.zeros_like(self.m2)
+
+    @classmethod
+    def compute(cls, paths, size=(256, 256), batch_size=256, prefetch=512, workers=4):
+        """
+        Compute the statistics of images in one streaming, chunked pass.
+
+        Parameters:
+            paths (iterable of str): The image paths, such as the Path column of a manifest.
+            size (tuple): The (width, height) images are resized to, as used in training. Default is (256, 256).
+            batch_size (int): Number of images per chunk. Default is 256.
+            prefetch (int): Maximum number of decodes in flight. Default is 512.
+            workers (int): Number of decoding threads. Default is 4.
+
+        Returns:
+            DatasetStats: The statistics, in RGB channel order and the uint8 [0, 255] scale.
+        """
+        stats = cls()
+        stream = ImageStream(
+            paths, size=size, batch_size=batch_size, prefetch=prefetch, workers=workers
+        )
+        for _, batch in stream:
+            stats.update(batch)
+
+        return stats
+
+    def save(self, path):
+        """
+        Save the statistics to a JSON file.
+
+        Parameters:
+            path (str): The path to the file.
+        """
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "count": self.count,
+                    "mean": self.mean.tolist(),
+                    "std": self.std.tolist(),
+                    "m2": self.m2.tolist(),
+                },
+                f,
+                indent=2,
+            )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load statistics saved with save.
+
+        Parameters:
+            path (str): The path to the file.
+
+        Returns:
+            DatasetStats: The statistics.
+        """
+        with open(path) as f:
+            data = json.load(f)
+
+        stats = cls(len(data["mean"]))
+        stats.count = data["count"]
+        stats.mean = np.asarray(data["mean"])
+        stats.m2 = np.asarray(data["m2"])
+
+        return stats
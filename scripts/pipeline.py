@@ -0,0 +1,682 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from scripts import constants as const
+from scripts.scanner import Scanner, is_generated
+from scripts.resize import Resizer
+from scripts.augment import Augmenter
+from scripts.instrument import instrument
+from scripts.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# Kinds of artifacts: a file, the raw images of a dataset, or the images generated next to them
+ARTIFACT_KINDS = ("file", "raw", "generated")
+
+
+def digest(value):
+    """Hash a JSON-serializable value."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def fingerprint(path, kind="file"):
+    """
+    Fingerprint the current state of an artifact.
+
+    Files are fingerprinted by content, so that rewriting the same content does not
+    invalidate the next stages. Image trees are fingerprinted by the path, size and
+    modification time of their images.
+
+    Parameters:
+        path (str): The file or dataset directory.
+        kind (str): "file", "raw" (the raw images of a directory) or "generated" (the "aug_" and "_norm.jpg" files). Default is "file".
+
+    Returns:
+        str: The fingerprint, or None if the artifact does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+
+    if kind == "file":
+        content = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                content.update(block)
+        return content.hexdigest()
+
+    return tree_fingerprints(path)[kind]
+
+
+def tree_fingerprints(path):
+    """
+    Fingerprint the raw and the generated images of a directory in one scan.
+
+    Parameters:
+        path (str): The dataset directory.
+
+    Returns:
+        dict: The "raw" and "generated" fingerprints.
+    """
+    rows = {"raw": [], "generated": []}
+    for entry in Scanner().scan(path):
+        kind = "generated" if is_generated(os.path.basename(entry.path)) else "raw"
+        rows[kind].append((os.path.relpath(entry.path, path), entry.size, entry.version))
+
+    return {kind: digest(sorted(kind_rows)) for kind, kind_rows in rows.items()}
+
+
+def process_context():
+    """
+    Get the start method of the process pools created by the stages.
+
+    Stages run on threads, and forking while another thread holds a lock (decode backend,
+    SQLite, logging) can deadlock the child, so the workers are started from a clean process.
+
+    Returns:
+        multiprocessing.context.BaseContext: The forkserver context, or spawn where forkserver is not available.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+def write_csv(df, path):
+    """Write a DataFrame to CSV through a temporary file, so that a crash never leaves half a file."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    df.to_csv(temp_path, index=False)
+    os.replace(temp_path, path)
+
+
+class Checkpoint:
+    def __init__(self, path, stop=None):
+        """
+        Progress of a long stage, so that it resumes where it stopped.
+
+        Parameters:
+            path (str): The JSON file of the progress.
+            stop (threading.Event): Set when the run is interrupted. Default is None.
+        """
+        self.path = path
+        self.stop = stop
+
+    def load(self, key):
+        """
+        Load the progress saved for the same work.
+
+        Parameters:
+            key (str): The fingerprint of the work, such as the list of files and the parameters.
+
+        Returns:
+            dict: The progress, or None if there is none for this key.
+        """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return saved["progress"] if saved.get("key") == key else None
+
+    def save(self, key, progress):
+        """Save the progress of the work atomically, then stop there if the run is interrupted."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"key": key, "progress": progress}, f)
+        os.replace(temp_path, self.path)
+
+        if self.stop is not None and self.stop.is_set():
+            raise InterruptedError("Interrupted, the progress is saved")
+
+    def clear(self):
+        """Remove the progress once the stage is complete."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Stage:
+    def __init__(self, name, function, inputs=(), outputs=(), params=None, always=False):
+        """
+        A step of the pipeline with declared inputs and outputs.
+
+        A stage depends on the last earlier stage producing each of its inputs. A stage
+        may list an artifact as both input and output when it changes it in place.
+
+        Parameters:
+            name (str): The name of the stage, such as "data_1:resize".
+            function (callable): Runs the stage, given its Checkpoint.
+            inputs (list of str): The names of the artifacts the stage reads.
+            outputs (list of str): The names of the artifacts the stage writes.
+            params (dict): The parameters of the stage, part of its fingerprint. Default is None.
+            always (bool): Whether to run the stage on every run. Default is False.
+        """
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.always = always
+
+
+class Pipeline:
+    def __init__(self, state_dir, parallel=2):
+        """
+        Runs stages in dependency order, skipping the ones whose inputs did not change.
+
+        Parameters:
+            state_dir (str): The directory of the run state and the checkpoints.
+            parallel (int): Number of stages run concurrently. Default is 2.
+        """
+        self.state_dir = state_dir
+        self.parallel = max(parallel, 1)
+        self.artifacts = {}
+        self.stages = []
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+        # Fingerprints of the artifacts in this run, dropped when a stage writes them
+        self.fingerprints = {}
+
+        self.state_path = os.path.join(state_dir, "state.json")
+        try:
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    def artifact(self, name, path, kind="file"):
+        """
+        Declare an artifact.
+
+        Parameters:
+            name (str): The name stages refer to it by.
+            path (str): The file or directory.
+            kind (str): "file", "raw" or "generated". Default is "file".
+
+        Returns:
+            str: The name.
+        """
+        if kind not in ARTIFACT_KINDS:
+            raise ValueError(f"Invalid artifact kind. Use one of {', '.join(ARTIFACT_KINDS)}.")
+
+        self.artifacts[name] = (path, kind)
+        return name
+
+    def add(self, stage):
+        """Add a stage, after the stages it depends on."""
+        for name in stage.inputs + stage.outputs:
+            if name not in self.artifacts:
+                raise ValueError(f"Unknown artifact '{name}' of stage '{stage.name}'")
+
+        self.stages.append(stage)
+        return stage
+
+    def dependencies(self):
+        """
+        Get the stages every stage waits for.
+
+        Returns:
+            dict: The names of the dependencies of every stage.
+        """
+        producers = {}
+        dependencies = {}
+
+        for stage in self.stages:
+            dependencies[stage.name] = sorted(
+                {producers[name] for name in stage.inputs if name in producers}
+            )
+            for name in stage.outputs:
+                producers[name] = stage.name
+
+        return dependencies
+
+    def fingerprint(self, name):
+        """
+        Fingerprint the current state of an artifact, once per run until a stage writes it.
+
+        Image trees are walked once for the raw and the generated artifacts of a directory.
+
+        Parameters:
+            name (str): The name of the artifact.
+
+        Returns:
+            str: The fingerprint, or None if the artifact does not exist.
+        """
+        with self.lock:
+            if name in self.fingerprints:
+                return self.fingerprints[name]
+
+        path, kind = self.artifacts[name]
+        if kind == "file" or not os.path.exists(path):
+            values = {name: fingerprint(path, kind)}
+        else:
+            by_kind = tree_fingerprints(path)
+            values = {
+                other: by_kind[other_kind]
+                for other, (other_path, other_kind) in self.artifacts.items()
+                if other_path == path and other_kind != "file"
+            }
+
+        with self.lock:
+            # Keep the fingerprints other threads computed meanwhile
+            for other, value in values.items():
+                self.fingerprints.setdefault(other, value)
+            return self.fingerprints[name]
+
+    def invalidate(self, names):
+        """Drop the fingerprints of artifacts a stage wrote."""
+        with self.lock:
+            for name in names:
+                self.fingerprints.pop(name, None)
+
+    def key(self, stage):
+        """Fingerprint a stage: its parameters and the state of its inputs."""
+        return digest(
+            [stage.name, stage.params, {name: self.fingerprint(name) for name in stage.inputs}]
+        )
+
+    def up_to_date(self, stage, key):
+        """
+        Check whether a stage already ran on the same inputs, and its outputs are unchanged since.
+
+        Parameters:
+            stage (Stage): The stage.
+            key (str): The current fingerprint of the stage.
+
+        Returns:
+            bool: Whether the stage can be skipped.
+        """
+        record = self.state.get(stage.name)
+        if stage.always or record is None or key not in record["keys"]:
+            return False
+
+        return all(
+            self.fingerprint(name) == record["outputs"].get(name) for name in stage.outputs
+        )
+
+    def save_state(self):
+        """Write the run state atomically."""
+        os.makedirs(self.state_dir, exist_ok=True)
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(temp_path, self.state_path)
+
+    def run_stage(self, stage, force=False):
+        """
+        Run a stage unless it is up to date.
+
+        Parameters:
+            stage (Stage): The stage.
+            force (bool): Whether to run the stage even if it is up to date. Default is False.
+
+        Returns:
+            str: "ran" or "skipped".
+        """
+        key = self.key(stage)
+        if not force and self.up_to_date(stage, key):
+            print(f">>> [{stage.name}] up to date, skipped")
+            return "skipped"
+
+        checkpoint = Checkpoint(
+            os.path.join(self.state_dir, "checkpoints", stage.name.replace(":", "__") + ".json"),
+            stop=self.stop,
+        )
+
+        # Forget the previous run: the outputs are about to change
+        with self.lock:
+            if self.state.pop(stage.name, None) is not None:
+                self.save_state()
+
+        print(f">>> [{stage.name}] running")
+        start = time.perf_counter()
+        try:
+            with instrument.stage(f"pipeline.{stage.name}"):
+                stage.function(checkpoint)
+        finally:
+            # Only the outputs of the stage are walked again
+            self.invalidate(stage.outputs)
+        seconds = time.perf_counter() - start
+        checkpoint.clear()
+
+        # A stage changing its inputs in place is up to date for the state it left
+        record = {
+            "keys": sorted({key, self.key(stage)}),
+            "outputs": {name: self.fingerprint(name) for name in stage.outputs},
+            "seconds": seconds,
+        }
+        with self.lock:
+            self.state[stage.name] = record
+            self.save_state()
+
+        print(f">>> [{stage.name}] done in {seconds:.1f}s")
+        return "ran"
+
+    def run(self, force=()):
+        """
+        Run the pipeline, with independent stages run concurrently.
+
+        A failed stage does not stop the stages that do not depend on it. On an interruption,
+        the running stages stop at their next checkpoint.
+
+        Parameters:
+            force (list of str): Stages to run even if up to date, by full name ("data_1:resize")
+                or step name ("resize", for every dataset). "all" forces every stage. Default is ().
+
+        Returns:
+            dict: The status of every stage: "ran", "skipped", "failed" or "blocked".
+        """
+        force = set(force)
+        status = {}
+
+        # Artifacts may have changed since the last run
+        self.fingerprints.clear()
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            try:
+                self.schedule(executor, force, status)
+            except KeyboardInterrupt:
+                print(">>> Interrupted, saving the progress of the running stages")
+                self.stop.set()
+                raise
+
+        return {stage.name: status[stage.name] for stage in self.stages}
+
+    def schedule(self, executor, force, status):
+        """Submit every stage once its dependencies are complete, and wait for all of them."""
+        dependencies = self.dependencies()
+        waiting = list(self.stages)
+        running = {}
+
+        def forced(stage):
+            step = stage.name.split(":")[-1]
+            return "all" in force or stage.name in force or step in force
+
+        while waiting or running:
+            # Start every stage whose dependencies are complete
+            for stage in list(waiting):
+                states = [status.get(name) for name in dependencies[stage.name]]
+                if any(state in ("failed", "blocked") for state in states):
+                    waiting.remove(stage)
+                    status[stage.name] = "blocked"
+                    print(f">>> [{stage.name}] blocked by a failed stage")
+                elif all(state in ("ran", "skipped") for state in states):
+                    waiting.remove(stage)
+                    running[executor.submit(self.run_stage, stage, forced(stage))] = stage
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    status[stage.name] = future.result()
+                except Exception as e:
+                    print(f">>> [{stage.name}] failed: {e}")
+                    status[stage.name] = "failed"
+
+
+def preprocessing_pipeline(
+    data_dirs,
+    state_dir=".pipeline",
+    size=const.IMAGE_SIZE,
+    test_size=0.2,
+    growth=1.3,
+    seed=42,
+    workers=None,
+    parallel=2,
+    purge=False,
+    augment=True,
+    chunk_size=1000,
+):
+    """
+    Build the preprocessing of data_preprocessing.ipynb as a resumable pipeline.
+
+    For every dataset directory, such as data_1, the stages are:
+    purge (optional), resize, manifest, split, plan and augment. The datasets are
+    processed concurrently.
+
+    Parameters:
+        data_dirs (list of str): The dataset directories, each with a raw/<category>/<style>/<file> tree.
+        state_dir (str): The directory of the run state, checkpoints and manifest caches. Default is ".pipeline".
+        size (tuple): The (width, height) the raw images are resized to in place. Default is (256, 256).
+        test_size (float): Fraction of every category and style in the test set. Default is 0.2.
+        growth (float): The minimum growth factor of every style when oversampling. Default is 1.3.
+        seed (int): The seed of the split, the plan and the augmentations. Default is 42.
+        workers (int): Number of worker processes of every stage. Default is the CPUs shared by the parallel stages.
+        parallel (int): Number of stages run concurrently. Default is 2.
+        purge (bool): Whether to remove the files generated by previous runs first, without asking. Default is False.
+        augment (bool): Whether to write the augmented images of the plan. Without it, the plan is meant for the
+            in-memory AugmentingLoader. Default is True.
+        chunk_size (int): Number of images processed between two checkpoints. Default is 1000.
+
+    Returns:
+        Pipeline: The pipeline, to run.
+    """
+    # Imported here, the pipeline module itself stays light
+    from scripts.leon import Leon
+
+    leon = Leon()
+    workers = workers or max((os.cpu_count() or 1) // max(parallel, 1), 1)
+    mp_context = process_context()
+    pipeline = Pipeline(state_dir, parallel=parallel)
+
+    for data_dir in data_dirs:
+        dataset = os.path.basename(os.path.normpath(data_dir))
+        raw_dir = os.path.join(data_dir, const.RAW_DATA_DIR)
+        processed_dir = os.path.join(data_dir, const.PROCESSED_DATA_DIR)
+
+        raw = pipeline.artifact(f"{dataset}/raw", raw_dir, "raw")
+        generated = pipeline.artifact(f"{dataset}/generated", raw_dir, "generated")
+        manifest = pipeline.artifact(f"{dataset}/manifest", os.path.join(processed_dir, "manifest.csv"))
+        train_split = pipeline.artifact(f"{dataset}/train_split", os.path.join(processed_dir, "train_split.csv"))
+        test = pipeline.artifact(
+            f"{dataset}/test", os.path.join(data_dir, const.TEST_DATA_DIR, "test.csv")
+        )
+        plan = pipeline.artifact(f"{dataset}/plan", os.path.join(processed_dir, "oversampling_plan.csv"))
+        train = pipeline.artifact(f"{dataset}/train", os.path.join(processed_dir, "train.csv"))
+
+        def raw_paths(raw_dir=raw_dir):
+            """List the raw images, in a stable order."""
+            return [
+                entry.path
+                for entry in Scanner(stat=False).scan(raw_dir)
+                if not is_generated(os.path.basename(entry.path))
+            ]
+
+        if purge:
+
+            def run_purge(checkpoint, raw_dir=raw_dir):
+                paths = Scanner(stat=False).paths(raw_dir)
+                if paths:
+                    leon.remove_nonraw_files(paths, confirm=False)
+
+            pipeline.add(
+                Stage(f"{dataset}:purge", run_purge, outputs=[generated], always=True)
+            )
+
+        def run_resize(checkpoint, raw_paths=raw_paths):
+            paths = raw_paths()
+            key = digest([paths, size])
+            done = (checkpoint.load(key) or {}).get("done", 0)
+            resizer = Resizer(*size, workers=workers, mp_context=mp_context)
+
+            # Resize in chunks, saving the progress after every chunk
+            for start in range(done, len(paths), chunk_size):
+                chunk = paths[start : start + chunk_size]
+                report = resizer.resize_many(chunk)
+                checkpoint.save(key, {"done": start + len(chunk)})
+                print(
+                    f">>> {start + len(chunk)}/{len(paths)} images, "
+                    f"{report['resized']} resized, {report['failed']} failed"
+                )
+
+        pipeline.add(
+            Stage(
+                f"{dataset}:resize",
+                run_resize,
+                inputs=[raw],
+                outputs=[raw],
+                params={"size": list(size)},
+            )
+        )
+
+        def run_manifest(checkpoint, raw_dir=raw_dir, dataset=dataset, manifest=manifest):
+            df = leon.load_data_frame(
+                raw_dir,
+                workers=workers,
+                mp_context=mp_context,
+                cache=os.path.join(state_dir, f"{dataset}_manifest.sqlite"),
+            )
+            # The manifest only lists the raw images
+            df = df[~df["Path"].map(lambda path: is_generated(os.path.basename(path)))]
+            write_csv(df, pipeline.artifacts[manifest][0])
+
+        pipeline.add(Stage(f"{dataset}:manifest", run_manifest, inputs=[raw], outputs=[manifest]))
+
+        def run_split(checkpoint, manifest=manifest, train_split=train_split, test=test):
+            df = pd.read_csv(pipeline.artifacts[manifest][0])
+            df_train, df_test = leon.split_data_frame(df, test_size=test_size, seed=seed)
+            write_csv(df_train, pipeline.artifacts[train_split][0])
+            write_csv(df_test, pipeline.artifacts[test][0])
+
+        pipeline.add(
+            Stage(
+                f"{dataset}:split",
+                run_split,
+                inputs=[manifest],
+                outputs=[train_split, test],
+                params={"test_size": test_size, "seed": seed},
+            )
+        )
+
+        def run_plan(checkpoint, train_split=train_split, plan=plan):
+            df_train = pd.read_csv(pipeline.artifacts[train_split][0])
+            write_csv(
+                leon.plan_oversampling(df_train, growth=growth, seed=seed),
+                pipeline.artifacts[plan][0],
+            )
+
+        pipeline.add(
+            Stage(
+                f"{dataset}:plan",
+                run_plan,
+                inputs=[train_split],
+                outputs=[plan],
+                params={"growth": growth, "seed": seed},
+            )
+        )
+
+        if not augment:
+            continue
+
+        def run_augment(checkpoint, dataset=dataset, train_split=train_split, plan=plan, train=train):
+            df_train = pd.read_csv(pipeline.artifacts[train_split][0])
+            df_plan = pd.read_csv(pipeline.artifacts[plan][0])
+            rows_path = os.path.join(state_dir, "checkpoints", f"{dataset}__augment_rows.csv")
+
+            key = digest([pipeline.fingerprint(plan), seed])
+            progress = checkpoint.load(key) or {"done": 0, "rows": 0}
+
+            # Keep the rows of the chunks completed before the interruption. The file may hold
+            # the rows of a chunk appended right before the crash, drop them before appending.
+            if progress["rows"]:
+                new_rows = [
+                    pd.read_csv(rows_path, float_precision="round_trip").head(progress["rows"])
+                ]
+            else:
+                new_rows = [pd.DataFrame(columns=const.MANIFEST_COLUMNS)]
+            write_csv(new_rows[0], rows_path)
+
+            augmenter = Augmenter(seed=seed, workers=workers, mp_context=mp_context)
+            paths = df_plan["Path"].tolist()
+            counts = df_plan["Count"].tolist()
+
+            for start in range(progress["done"], len(paths), chunk_size):
+                rows = augmenter.augment_many(
+                    paths[start : start + chunk_size],
+                    counts[start : start + chunk_size],
+                    offset=start,
+                )
+                rows.to_csv(rows_path, mode="a", header=False, index=False)
+                new_rows.append(rows)
+
+                progress = {"done": start + chunk_size, "rows": progress["rows"] + len(rows)}
+                checkpoint.save(key, progress)
+                print(f">>> {min(start + chunk_size, len(paths))}/{len(paths)} images augmented")
+
+            write_csv(pd.concat([df_train, *new_rows], ignore_index=True), pipeline.artifacts[train][0])
+            os.remove(rows_path)
+
+        pipeline.add(
+            Stage(
+                f"{dataset}:augment",
+                run_augment,
+                inputs=[train_split, plan, generated],
+                outputs=[train, generated],
+                params={"seed": seed},
+            )
+        )
+
+    return pipeline
+
+
+def main(argv=None):
+    """Run the preprocessing of the datasets headlessly, resuming where the last run stopped."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("data_dirs", nargs="*", default=[const.DATA_DIR_1, const.DATA_DIR_2])
+    parser.add_argument("--state-dir", default=".pipeline", help="Directory of the run state and checkpoints")
+    parser.add_argument("--size", type=int, nargs=2, default=list(const.IMAGE_SIZE), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--growth", type=float, default=1.3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes per stage")
+    parser.add_argument("--parallel", type=int, default=2, help="Stages run concurrently")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Images between two checkpoints")
+    parser.add_argument(
+        "--purge",
+        action="store_true",
+        help="Remove the aug_ and _norm.jpg files of previous runs first, without asking",
+    )
+    parser.add_argument(
+        "--skip-augment",
+        action="store_true",
+        help="Stop at the oversampling plan, for the in-memory AugmentingLoader",
+    )
+    parser.add_argument(
+        "--force",
+        nargs="*",
+        default=[],
+        help="Stages to rerun even if up to date, e.g. resize or data_1:manifest, or all",
+    )
+    args = parser.parse_args(argv)
+
+    pipeline = preprocessing_pipeline(
+        args.data_dirs,
+        state_dir=args.state_dir,
+        size=tuple(args.size),
+        test_size=args.test_size,
+        growth=args.growth,
+        seed=args.seed,
+        workers=args.workers,
+        parallel=args.parallel,
+        purge=args.purge,
+        augment=not args.skip_augment,
+        chunk_size=args.chunk_size,
+    )
+    status = pipeline.run(force=args.force)
+
+    print(">>> Summary: " + ", ".join(f"{name} {state}" for name, state in status.items()))
+
+    return 0 if all(state in ("ran", "skipped") for state in status.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,516 @@
+import os
+import sys
+import json
+import time
+import threading
+import argparse
+import numpy as np
+from scripts import constants as const
+from scripts.scanner import Scanner
+from scripts.stream import ImageStream
+from scripts.sampling import stratified_split
+from scripts.embeddings import predict
+from scripts.lazy import lazy_import
+
+pd = lazy_import("pandas")
+tf = lazy_import("tensorflow")
+
+# Quantization modes of the exported models
+MODES = ("none", "float16", "dynamic", "int8")
+
+
+def configure_threads(intra_op=None, inter_op=None):
+    """
+    Set the thread pools of TensorFlow. Must be called before the first model is run.
+
+    Parameters:
+        intra_op (int): Threads used inside an operation. Default is None (TensorFlow's choice).
+        inter_op (int): Operations run concurrently. Default is None (TensorFlow's choice).
+    """
+    if intra_op:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    if inter_op:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+
+def sample_manifest(df, samples, seed=42):
+    """
+    Sample the rows of a manifest in proportion to every category and style.
+
+    Parameters:
+        df (pd.DataFrame): The manifest, with the Path, Category and Style columns.
+        samples (int): Number of rows to keep.
+        seed (int): The seed of the sample. Default is 42.
+
+    Returns:
+        pd.DataFrame: The sampled rows.
+    """
+    if samples >= len(df):
+        return df
+
+    # The "test" side of a stratified split is a stratified sample
+    by = tuple(column for column in ("Category", "Style") if column in df)
+    _, sample = stratified_split(df, test_size=samples / len(df), seed=seed, by=by)
+    return sample
+
+
+def image_batches(paths, size=const.IMAGE_SIZE, batch_size=32, workers=4):
+    """
+    Decode images into uint8 batches, kept in memory for repeated runs.
+
+    Parameters:
+        paths (list of str): The image paths.
+        size (tuple): The (width, height) of the images. Default is (256, 256).
+        batch_size (int): Number of images per batch. Default is 32.
+        workers (int): Number of decoding threads. Default is 4.
+
+    Returns:
+        list of tuple: The paths and the uint8 array of every batch.
+    """
+    stream = ImageStream(list(paths), size=size, batch_size=batch_size, workers=workers)
+    return [(list(batch_paths), batch) for batch_paths, batch in stream]
+
+
+def export_tflite(model, output_path, mode="dynamic", calibration=None):
+    """
+    Convert a Keras model to TFLite, optionally quantized.
+
+    The inputs and outputs stay float32 in every mode, so callers keep feeding images in [0, 1].
+
+    Parameters:
+        model (tf.keras.Model): The model.
+        output_path (str): The .tflite file to write.
+        mode (str): "none", "float16" (half-precision weights), "dynamic" (int8 weights) or
+            "int8" (int8 weights and activations, calibrated). Default is "dynamic".
+        calibration (list of np.ndarray): The uint8 image batches calibrating the activation ranges. Required for "int8".
+
+    Returns:
+        int: The size of the model file in bytes.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Invalid mode. Use one of {', '.join(MODES)}.")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if mode != "none":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+
+    if mode == "int8":
+        if not calibration:
+            raise ValueError("calibration batches are required for int8 quantization.")
+
+        def representative_dataset():
+            # One image at a time, scaled as the models expect
+            for batch in calibration:
+                for image in batch:
+                    yield [image[None].astype(np.float32) / 255.0]
+
+        converter.representative_dataset = representative_dataset
+        # Operations without an int8 kernel fall back to float
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+            tf.lite.OpsSet.TFLITE_BUILTINS,
+        ]
+
+    content = converter.convert()
+
+    # Write next to the target so the final rename is atomic
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(content)
+    os.replace(temp_path, output_path)
+
+    return len(content)
+
+
+class TFLiteModel:
+    def __init__(self, path, num_threads=None):
+        """
+        TFLite model with the predict interface of a Keras model, for CPU serving.
+
+        The batch dimension of the input is resized to every batch, and the interpreter is
+        guarded by a lock since it is not thread-safe.
+
+        Parameters:
+            path (str): The .tflite file.
+            num_threads (int): Number of threads of the interpreter. Default is None (TFLite's choice).
+        """
+        self.path = path
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def quantize(values, details):
+        """Convert float values to the integer type of a quantized tensor, if needed."""
+        if details["dtype"] == np.float32:
+            return values.astype(np.float32, copy=False)
+
+        scale, zero_point = details["quantization"]
+        info = np.iinfo(details["dtype"])
+        return np.clip(np.round(values / scale + zero_point), info.min, info.max).astype(
+            details["dtype"]
+        )
+
+    @staticmethod
+    def dequantize(values, details):
+        """Convert the values of a quantized tensor back to float32, if needed."""
+        if details["dtype"] == np.float32:
+            return values
+
+        scale, zero_point = details["quantization"]
+        return (values.astype(np.float32) - zero_point) * scale
+
+    def predict(self, batch, verbose=0):
+        """
+        Run the model on a batch.
+
+        Parameters:
+            batch (np.ndarray): The float32 batch of images in [0, 1].
+            verbose (int): Ignored, for compatibility with Keras. Default is 0.
+
+        Returns:
+            np.ndarray: The outputs, one row per image.
+        """
+        batch = np.asarray(batch)
+
+        with self.lock:
+            # Reallocate only when the batch size changes
+            if len(batch) != self.batch_size:
+                self.interpreter.resize_tensor_input(
+                    self.input["index"], [len(batch), *self.input["shape"][1:]]
+                )
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(batch)
+
+            self.interpreter.set_tensor(self.input["index"], self.quantize(batch, self.input))
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self.output["index"])
+
+        return self.dequantize(output, self.output)
+
+    def __call__(self, batch):
+        return self.predict(batch)
+
+
+def load_model(path, num_threads=None):
+    """
+    Load a Keras model, or a TFLite model if the path ends with .tflite.
+
+    Parameters:
+        path (str): The path to the model.
+        num_threads (int): Number of threads of a TFLite interpreter. Default is None.
+
+    Returns:
+        tf.keras.Model or TFLiteModel: The model.
+    """
+    if path.endswith(".tflite"):
+        return TFLiteModel(path, num_threads=num_threads)
+
+    return tf.keras.models.load_model(path, compile=False)
+
+
+def run_model(model, batches):
+    """
+    Run a model over batches and time every batch.
+
+    Parameters:
+        model (tf.keras.Model or TFLiteModel): The model.
+        batches (list of tuple): The paths and uint8 array of every batch.
+
+    Returns:
+        tuple: The outputs of every image and the seconds of every batch.
+    """
+    # The first call builds the graph or allocates the tensors
+    predict(model, batches[0][1][:1].astype(np.float32) / 255.0)
+
+    outputs = []
+    seconds = []
+    for _, batch in batches:
+        scaled = batch.astype(np.float32) / 255.0
+        start = time.perf_counter()
+        outputs.append(predict(model, scaled))
+        seconds.append(time.perf_counter() - start)
+
+    return np.concatenate(outputs), np.array(seconds)
+
+
+def latency_report(seconds, images):
+    """
+    Summarize the latency and throughput of a run.
+
+    Parameters:
+        seconds (np.ndarray): The seconds of every batch.
+        images (int): Number of images of the run.
+
+    Returns:
+        dict: The p50 and p95 batch latency in milliseconds and the images per second.
+    """
+    return {
+        "batch_p50_ms": float(np.percentile(seconds, 50) * 1000),
+        "batch_p95_ms": float(np.percentile(seconds, 95) * 1000),
+        "images_per_second": float(images / seconds.sum()) if seconds.sum() > 0 else 0.0,
+    }
+
+
+def classifier_drift(reference, candidate, labels=None):
+    """
+    Compare the class probabilities of a quantized classifier to the float one.
+
+    Parameters:
+        reference (np.ndarray): The probabilities of the float model.
+        candidate (np.ndarray): The probabilities of the quantized model.
+        labels (np.ndarray): The true class of every image, or -1 if unknown. Default is None.
+
+    Returns:
+        dict: The top-1 agreement, the largest probability change and the accuracy of both models.
+    """
+    report = {
+        "top1_agreement": float(np.mean(reference.argmax(1) == candidate.argmax(1))),
+        "max_probability_delta": float(np.abs(reference - candidate).max()),
+    }
+
+    if labels is not None and (labels >= 0).any():
+        known = labels >= 0
+        reference_accuracy = float(np.mean(reference[known].argmax(1) == labels[known]))
+        candidate_accuracy = float(np.mean(candidate[known].argmax(1) == labels[known]))
+        report["float_accuracy"] = reference_accuracy
+        report["quantized_accuracy"] = candidate_accuracy
+        report["accuracy_delta"] = candidate_accuracy - reference_accuracy
+
+    return report
+
+
+def embedding_drift(reference, candidate, k=10):
+    """
+    Compare the feature vectors of a quantized feature extractor to the float one.
+
+    Parameters:
+        reference (np.ndarray): The vectors of the float model.
+        candidate (np.ndarray): The vectors of the quantized model.
+        k (int): Number of neighbours compared between both models. Default is 10.
+
+    Returns:
+        dict: The mean and minimum cosine similarity, the mean relative L2 error and the overlap of the k nearest neighbours.
+    """
+    reference = reference.reshape(len(reference), -1).astype(np.float32)
+    candidate = candidate.reshape(len(candidate), -1).astype(np.float32)
+
+    reference_norms = np.linalg.norm(reference, axis=1) + 1e-12
+    candidate_norms = np.linalg.norm(candidate, axis=1) + 1e-12
+    cosine = np.sum(reference * candidate, axis=1) / (reference_norms * candidate_norms)
+    relative_l2 = np.linalg.norm(reference - candidate, axis=1) / reference_norms
+
+    report = {
+        "mean_cosine": float(cosine.mean()),
+        "min_cosine": float(cosine.min()),
+        "mean_relative_l2": float(relative_l2.mean()),
+    }
+
+    # Do the recommendations change: overlap of the neighbours within the sample
+    k = min(k, len(reference) - 1)
+    if k > 0:
+        neighbours = []
+        for vectors, norms in ((reference, reference_norms), (candidate, candidate_norms)):
+            unit = vectors / norms[:, None]
+            similarity = unit @ unit.T
+            np.fill_diagonal(similarity, -np.inf)
+            neighbours.append(np.argpartition(-similarity, k, axis=1)[:, :k])
+        overlap = [
+            len(np.intersect1d(left, right)) / k for left, right in zip(*neighbours)
+        ]
+        report[f"neighbour_overlap_at_{k}"] = float(np.mean(overlap))
+
+    return report
+
+
+def evaluate(reference, candidate, batches, kind="classifier", labels=None):
+    """
+    Compare a quantized model to the float one on the same batches.
+
+    Parameters:
+        reference (tf.keras.Model): The float model.
+        candidate (TFLiteModel): The quantized model.
+        batches (list of tuple): The paths and uint8 array of every batch.
+        kind (str): "classifier" or "embedding". Default is "classifier".
+        labels (np.ndarray): The true class of every image, for the classifier. Default is None.
+
+    Returns:
+        dict: The drift report and the latency of both models.
+    """
+    images = sum(len(batch) for _, batch in batches)
+    reference_outputs, reference_seconds = run_model(reference, batches)
+    candidate_outputs, candidate_seconds = run_model(candidate, batches)
+
+    if kind == "classifier":
+        drift = classifier_drift(reference_outputs, candidate_outputs, labels)
+    else:
+        drift = embedding_drift(reference_outputs, candidate_outputs)
+
+    return {
+        "images": images,
+        "drift": drift,
+        "float": latency_report(reference_seconds, images),
+        "quantized": latency_report(candidate_seconds, images),
+    }
+
+
+class QuantizationJob:
+    def __init__(
+        self,
+        data_dir,
+        output_dir,
+        mode="dynamic",
+        calibration_samples=200,
+        eval_samples=500,
+        batch_size=32,
+        num_threads=None,
+        inter_op_threads=None,
+        class_labels=const.CLASS_LABELS,
+        seed=42,
+    ):
+        """
+        Exports the classifier and the feature extractor to quantized TFLite models and
+        reports their drift and speed against the float models.
+
+        Parameters:
+            data_dir (str): The dataset directory laid out as <category>/<style>/<file>, for the calibration and evaluation samples.
+            output_dir (str): The directory of the exported models and the report.
+            mode (str): "none", "float16", "dynamic" or "int8". Default is "dynamic".
+            calibration_samples (int): Number of images calibrating the int8 activations. Default is 200.
+            eval_samples (int): Number of images of the evaluation. Default is 500.
+            batch_size (int): Number of images per inference batch. Default is 32.
+            num_threads (int): Intra-op threads of TensorFlow and threads of the interpreters. Default is None.
+            inter_op_threads (int): Inter-op threads of TensorFlow. Default is None.
+            class_labels (list of str): The label of every classifier output. Default is const.CLASS_LABELS.
+            seed (int): The seed of the samples. Default is 42.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Invalid mode. Use one of {', '.join(MODES)}.")
+
+        self.data_dir = data_dir
+        self.output_dir = output_dir
+        self.mode = mode
+        self.calibration_samples = calibration_samples
+        self.eval_samples = eval_samples
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.inter_op_threads = inter_op_threads
+        self.class_labels = list(class_labels)
+        self.seed = seed
+
+    def manifest(self):
+        """List the images of the dataset with their category and style, without decoding them."""
+        entries = Scanner(stat=False).scan(self.data_dir, depth=2)
+        return pd.DataFrame(
+            [(entry.path, entry.category, entry.style) for entry in entries],
+            columns=["Path", "Category", "Style"],
+        )
+
+    def run(self, classifier_path, feature_extractor_path):
+        """
+        Export both models and evaluate them.
+
+        Parameters:
+            classifier_path (str): The path to the Keras classifier, e.g. cache_cnn/best_cnn.h5.
+            feature_extractor_path (str): The path to the feature extractor SavedModel.
+
+        Returns:
+            dict: The path, size and evaluation of every exported model.
+        """
+        configure_threads(self.num_threads, self.inter_op_threads)
+
+        df = self.manifest()
+        if df.empty:
+            raise ValueError(f"No images found in {self.data_dir}")
+
+        # Calibrate and evaluate on different images
+        calibration_df = sample_manifest(df, self.calibration_samples, self.seed)
+        remaining = df.drop(calibration_df.index) if len(calibration_df) < len(df) else df
+        eval_df = sample_manifest(remaining, self.eval_samples, self.seed + 1)
+
+        calibration = None
+        if self.mode == "int8":
+            calibration = [
+                batch for _, batch in image_batches(calibration_df["Path"], batch_size=self.batch_size)
+            ]
+        eval_batches = image_batches(eval_df["Path"], batch_size=self.batch_size)
+
+        # Classes the classifier does not know are left out of the accuracy
+        label_of = {label: i for i, label in enumerate(self.class_labels)}
+        labels = np.array([label_of.get(category, -1) for category in eval_df["Category"]])
+
+        report = {"mode": self.mode, "threads": self.num_threads, "models": {}}
+        for name, path, kind in (
+            ("classifier", classifier_path, "classifier"),
+            ("feature_extractor", feature_extractor_path, "embedding"),
+        ):
+            model = tf.keras.models.load_model(path, compile=False)
+            output_path = os.path.join(self.output_dir, f"{name}_{self.mode}.tflite")
+
+            print(f">>> Exporting {name} ({self.mode}) to {output_path}")
+            size = export_tflite(model, output_path, self.mode, calibration)
+
+            quantized = TFLiteModel(output_path, num_threads=self.num_threads)
+            evaluation = evaluate(model, quantized, eval_batches, kind, labels)
+
+            report["models"][name] = {"path": output_path, "bytes": size, **evaluation}
+            print_evaluation(name, report["models"][name])
+
+        with open(os.path.join(self.output_dir, f"report_{self.mode}.json"), "w") as f:
+            json.dump(report, f, indent=2)
+
+        return report
+
+
+def print_evaluation(name, evaluation):
+    """Print the drift and speed of an exported model."""
+    drift = ", ".join(f"{key} {value:.4f}" for key, value in evaluation["drift"].items())
+    print(f">>> {name}: {evaluation['bytes'] / 1e6:.1f} MB, {drift}")
+    for side in ("float", "quantized"):
+        latency = evaluation[side]
+        print(
+            f"    {side:<10} p50 {latency['batch_p50_ms']:.1f} ms, p95 {latency['batch_p95_ms']:.1f} ms, "
+            f"{latency['images_per_second']:.1f} images/s"
+        )
+
+
+def main(argv=None):
+    """Export the classifier and the feature extractor to quantized TFLite models."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--classifier", required=True, help="The Keras classifier, e.g. cache_cnn/best_cnn.h5")
+    parser.add_argument("--feature-extractor", required=True, help="The feature extractor SavedModel")
+    parser.add_argument("--data-dir", required=True, help="The dataset sampled for calibration and evaluation")
+    parser.add_argument("--output-dir", default="tflite", help="The directory of the exported models")
+    parser.add_argument("--mode", choices=MODES, default="dynamic")
+    parser.add_argument("--calibration-samples", type=int, default=200)
+    parser.add_argument("--eval-samples", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op and interpreter threads")
+    parser.add_argument("--inter-op-threads", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    job = QuantizationJob(
+        args.data_dir,
+        args.output_dir,
+        mode=args.mode,
+        calibration_samples=args.calibration_samples,
+        eval_samples=args.eval_samples,
+        batch_size=args.batch_size,
+        num_threads=args.threads,
+        inter_op_threads=args.inter_op_threads,
+    )
+    job.run(args.classifier, args.feature_extractor)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+import numpy as np
+from scripts.lazy import lazy_import
+
+cluster = lazy_import("sklearn.cluster")
+
+
+def l2_normalize(vectors):
+    """
+    Scale vectors to unit length so that dot products are cosine similarities.
+
+    Parameters:
+        vectors (np.ndarray): The vectors, one per row.
+
+    Returns:
+        np.ndarray: The normalized float32 vectors.
+    """
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def top_k(scores, k):
+    """
+    Get the indices of the k highest scores of every row, best first.
+
+    Parameters:
+        scores (np.ndarray): The scores, one row per query.
+        k (int): Number of indices to keep.
+
+    Returns:
+        np.ndarray: The indices, one row per query.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+
+    # Partition first so that only k scores per row are sorted
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+class RecommenderIndex:
+    def __init__(self, n_clusters=None, seed=42):
+        """
+        Per-category cosine similarity index over feature vectors.
+
+        With n_clusters, the vectors of every category are partitioned once with KMeans
+        (IVF), and a query only scans the partitions of its closest centroids.
+
+        Parameters:
+            n_clusters (int): Number of partitions per category. Default is None (exhaustive search).
+            seed (int): The seed of the KMeans partitioning. Default is 42.
+        """
+        self.n_clusters = n_clusters
+        self.seed = seed
+        self.categories = {}
+
+    def build(self, vectors, paths, categories):
+        """
+        Build the index from feature vectors.
+
+        Parameters:
+            vectors (np.ndarray): The feature vectors, one per row.
+            paths (list of str): The image path of every vector.
+            categories (list of str): The category of every vector.
+
+        Returns:
+            RecommenderIndex: The index itself.
+        """
+        vectors = l2_normalize(vectors)
+        paths = np.asarray(paths, dtype=str)
+        categories = np.asarray(categories, dtype=str)
+
+        for category in np.unique(categories):
+            mask = categories == category
+            self.categories[category] = self.partition(vectors[mask], paths[mask])
+
+        return self
+
+    @classmethod
+    def from_frame(cls, df, n_clusters=None, seed=42):
+        """
+        Build the index from a feature vector DataFrame such as feature_vector.csv.
+
+        Parameters:
+            df (pd.DataFrame): The Path and Category columns, followed by one column per feature.
+            n_clusters (int): Number of partitions per category. Default is None (exhaustive search).
+            seed (int): The seed of the KMeans partitioning. Default is 42.
+
+        Returns:
+            RecommenderIndex: The index.
+        """
+        features = df.drop(columns=[c for c in ["Path", "Category", "Style"] if c in df])
+        return cls(n_clusters, seed).build(
+            features.to_numpy(np.float32), df["Path"], df["Category"]
+        )
+
+    def partition(self, vectors, paths):
+        """
+        Sort the vectors of a category by partition.
+
+        Parameters:
+            vectors (np.ndarray): The normalized vectors of the category.
+            paths (np.ndarray): The image paths of the category.
+
+        Returns:
+            dict: The vectors, paths, centroids and partition offsets of the category.
+        """
+        if not self.n_clusters or len(vectors) <= self.n_clusters:
+            return {
+                "vectors": vectors,
+                "paths": paths,
+                "centroids": np.empty((0, vectors.shape[1]), dtype=np.float32),
+                "offsets": np.array([0, len(vectors)]),
+            }
+
+        kmeans = cluster.KMeans(
+            n_clusters=self.n_clusters, init="k-means++", n_init="auto", random_state=self.seed
+        ).fit(vectors)
+
+        # Store the rows of every partition contiguously
+        order = np.argsort(kmeans.labels_, kind="stable")
+        counts = np.bincount(kmeans.labels_, minlength=self.n_clusters)
+
+        return {
+            "vectors": vectors[order],
+            "paths": paths[order],
+            "centroids": l2_normalize(kmeans.cluster_centers_),
+            "offsets": np.concatenate(([0], np.cumsum(counts))),
+        }
+
+    def search(self, category, queries, k, exclude_paths, n_probe):
+        """
+        Search the k most similar vectors of one category.
+
+        Parameters:
+            category (str): The category to search.
+            queries (np.ndarray): The normalized query vectors.
+            k (int): Number of results per query.
+            exclude_paths (list of str): The path to exclude from the results of every query, or None.
+            n_probe (int): Number of partitions scanned per query.
+
+        Returns:
+            list of tuple: The paths and similarities of every query.
+        """
+        entry = self.categories[category]
+        vectors, paths, offsets = entry["vectors"], entry["paths"], entry["offsets"]
+
+        # Row of every excluded path, -1 if it is not in the category
+        if "rows" not in entry:
+            entry["rows"] = {path: row for row, path in enumerate(paths)}
+        excluded = np.array(
+            [entry["rows"].get(path, -1) for path in exclude_paths]
+            if exclude_paths is not None
+            else [-1] * len(queries)
+        )
+
+        # Exhaustive search is a single matrix product for the whole batch
+        if len(entry["centroids"]) == 0:
+            scores = queries @ vectors.T
+            hits = np.flatnonzero(excluded >= 0)
+            scores[hits, excluded[hits]] = -np.inf
+            rows = [np.arange(len(vectors))] * len(queries)
+        else:
+            # Pick the closest partitions of every query
+            probes = top_k(queries @ entry["centroids"].T, n_probe)
+            rows = [
+                np.concatenate([np.arange(offsets[c], offsets[c + 1]) for c in probe])
+                for probe in probes
+            ]
+
+            width = max(len(row) for row in rows)
+            scores = np.full((len(queries), width), -np.inf, dtype=np.float32)
+            for i, row in enumerate(rows):
+                scores[i, : len(row)] = vectors[row] @ queries[i]
+                scores[i, : len(row)][row == excluded[i]] = -np.inf
+            rows = [np.pad(row, (0, width - len(row))) for row in rows]
+
+        results = []
+        for i, best in enumerate(top_k(scores, k)):
+            best = best[np.isfinite(scores[i, best])]
+            results.append((paths[rows[i][best]], scores[i, best]))
+
+        return results
+
+    def query(self, vectors, categories, k=10, exclude_paths=None, n_probe=1):
+        """
+        Find the k most similar items of the same category for a batch of query vectors.
+
+        Parameters:
+            vectors (np.ndarray): The query feature vectors, one per row.
+            categories (list of str): The category to search for every query.
+            k (int): Number of results per query. Default is 10.
+            exclude_paths (list of str): The path to exclude from the results of every query, such as the query image itself. Default is None.
+            n_probe (int): Number of partitions scanned per query when the index is partitioned. Default is 1.
+
+        Returns:
+            list of tuple: The paths and cosine similarities of every query, best first.
+        """
+        queries = l2_normalize(vectors)
+        categories = np.asarray(categories, dtype=str).reshape(-1)
+        if exclude_paths is not None:
+            exclude_paths = np.asarray(exclude_paths, dtype=str).reshape(-1)
+
+        results = [None] * len(queries)
+
+        # Answer the queries of every category as one batch
+        for category in np.unique(categories):
+            positions = np.flatnonzero(categories == category)
+            if category not in self.categories:
+                raise KeyError(f"Unknown category: {category}")
+
+            found = self.search(
+                category,
+                queries[positions],
+                k,
+                None if exclude_paths is None else exclude_paths[positions],
+                n_probe,
+            )
+            for position, result in zip(positions, found):
+                results[position] = result
+
+        return results
+
+    def save(self, path):
+        """
+        Save the index to a .npz file.
+
+        Parameters:
+            path (str): The path to the file.
+        """
+        arrays = {"categories": np.array(list(self.categories), dtype=str)}
+        for i, entry in enumerate(self.categories.values()):
+            for name in ["vectors", "paths", "centroids", "offsets"]:
+                arrays[f"{name}_{i}"] = entry[name]
+
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save.
+
+        Parameters:
+            path (str): The path to the file.
+
+        Returns:
+            RecommenderIndex: The index.
+        """
+        index = cls()
+        with np.load(path) as arrays:
+            for i, category in enumerate(arrays["categories"]):
+                index.categories[str(category)] = {
+                    name: arrays[f"{name}_{i}"]
+                    for name in ["vectors", "paths", "centroids", "offsets"]
+                }
+                if len(index.categories[str(category)]["centroids"]):
+                    index.n_clusters = len(index.categories[str(category)]["centroids"])
+
+        return index
@@ -0,0 +1,156 @@
+import os
+import stat
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image
+from scripts.instrument import instrument
+from scripts.blob_store import unique_files, link_replace
+
+
+def resize_file(path, width, height):
+    """
+    Resize an image in place, writing through a temporary file.
+
+    Files that already have the target size are left untouched. JPEG files much larger
+    than the target are decoded at a reduced scale.
+
+    Parameters:
+        path (str): The path to the image file.
+        width (int): The width of the resized image.
+        height (int): The height of the resized image.
+
+    Returns:
+        bool: Whether the image was resized (False if it already had the target size).
+    """
+    # Resizing stays on PIL whatever the decode backend of the host, so the same files
+    # resize to the same pixels everywhere, in their own mode (alpha, palette, CMYK)
+    with Image.open(path) as image:
+        # The header is enough to tell whether there is anything to do
+        if image.size == (width, height):
+            return False
+
+        image_format = image.format
+
+        # Let the JPEG decoder skip the scales we do not need
+        if image_format == "JPEG":
+            image.draft(image.mode, (width, height))
+
+        resized_image = image.resize((width, height))
+
+    # Write next to the source so the final rename is atomic
+    directory, filename = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory or ".", prefix=".tmp_", suffix=os.path.splitext(filename)[1]
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            resized_image.save(f, format=image_format)
+
+        # mkstemp creates the file readable by its owner only, keep the mode of the original
+        os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return True
+
+
+def _resize_safe(task):
+    """Resize an image inside a worker, returning the error instead of raising it."""
+    path, width, height = task
+    try:
+        return resize_file(path, width, height)
+    except Exception as e:
+        return e
+
+
+class Resizer:
+    def __init__(
+        self, width, height, workers=None, use_processes=False, chunk_size=16, mp_context=None
+    ):
+        """
+        Resizes many images in place on a thread or process pool.
+
+        Parameters:
+            width (int): The width of the resized images.
+            height (int): The height of the resized images.
+            workers (int): Number of workers. Default is the number of CPUs.
+            use_processes (bool): Whether to use processes instead of threads. Default is False.
+            chunk_size (int): Number of images submitted to a worker process at once. Default is 16.
+            mp_context (multiprocessing.context.BaseContext): The start method of the worker processes.
+                Default is None (the platform default).
+        """
+        self.width = width
+        self.height = height
+        self.workers = workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.chunk_size = chunk_size
+        self.mp_context = mp_context
+
+    def resize_many(self, paths):
+        """
+        Resize the images and report the throughput.
+
+        Hard links to the same file are resized once, then linked to the resized file
+        again, since replacing the file breaks the link.
+
+        Parameters:
+            paths (list of str): The paths to the image files.
+
+        Returns:
+            dict: The number of resized, skipped and failed images, the elapsed seconds and the images per second.
+        """
+        representatives, inverse = unique_files(paths)
+        tasks = [(paths[i], self.width, self.height) for i in representatives]
+
+        # Count the bytes before the files are replaced
+        instrument.count_bytes([paths[i] for i in representatives])
+        start = time.perf_counter()
+
+        # PIL releases the GIL while decoding and resizing, so threads scale as well
+        if self.workers <= 1:
+            results = [_resize_safe(task) for task in tasks]
+        elif self.use_processes:
+            with ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=self.mp_context
+            ) as executor:
+                results = list(
+                    executor.map(_resize_safe, tasks, chunksize=self.chunk_size)
+                )
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(_resize_safe, tasks))
+
+        # Share the resized file with the other links of the original. A link that
+        # cannot be made (another file system, a removed file) fails that path only.
+        results = [results[i] for i in inverse]
+        for index, (path, position, result) in enumerate(zip(paths, inverse, results)):
+            source = paths[representatives[position]]
+            if result is True and path != source:
+                try:
+                    link_replace(source, path)
+                except OSError as e:
+                    results[index] = e
+
+        elapsed = time.perf_counter() - start
+
+        report = {"resized": 0, "skipped": 0, "failed": 0}
+        for path, result in zip(paths, results):
+            if isinstance(result, Exception):
+                print(f"Error resizing image '{path}': {result}")
+                report["failed"] += 1
+            elif result:
+                report["resized"] += 1
+            else:
+                report["skipped"] += 1
+
+        instrument.count("files_processed", report["resized"] + report["skipped"])
+        instrument.count("files_resized", report["resized"])
+        instrument.count("decode_failures", report["failed"])
+
+        report["seconds"] = elapsed
+        report["images_per_second"] = len(paths) / elapsed if elapsed > 0 else 0.0
+
+        return report
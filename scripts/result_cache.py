@@ -0,0 +1,367 @@
+import os
+import io
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def model_signature(paths):
+    """
+    Get the size and modification time of every file of the models.
+
+    Parameters:
+        paths (list of str): The model files or SavedModel directories.
+
+    Returns:
+        tuple: The (path, size, mtime) of every file, sorted.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+
+    return tuple(
+        (file, os.stat(file).st_size, os.stat(file).st_mtime_ns) for file in sorted(files)
+    )
+
+
+def model_fingerprint(paths):
+    """
+    Hash the content of every file of the models.
+
+    Parameters:
+        paths (list of str): The model files or SavedModel directories.
+
+    Returns:
+        str: The SHA-256 hex digest of the models.
+    """
+    digest = hashlib.sha256()
+    for file, _, _ in model_signature(paths):
+        digest.update(os.path.basename(file).encode())
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(
+        self,
+        cache_dir,
+        model_paths,
+        max_memory_bytes=64 << 20,
+        max_disk_bytes=1 << 30,
+        max_age_seconds=None,
+        check_interval=1.0,
+        prune_ratio=0.9,
+    ):
+        """
+        Two-tier cache of model results keyed by the content of the image and the models.
+
+        Results live in an in-memory LRU backed by .npz files on disk. The key combines the
+        SHA-256 of the image bytes with a fingerprint of the model files, so results are
+        invalidated as soon as a model file changes.
+
+        Parameters:
+            cache_dir (str): The directory of the on-disk tier.
+            model_paths (list of str): The model files or SavedModel directories the results depend on.
+            max_memory_bytes (int): Size bound of the in-memory tier. Default is 64 MiB.
+            max_disk_bytes (int): Size bound of the on-disk tier, enforced as entries are written. Default is 1 GiB.
+            max_age_seconds (float): Entries older than this are evicted. Default is None (no limit).
+            check_interval (float): Minimum seconds between two checks of the model files. Default is 1.
+            prune_ratio (float): Fraction of max_disk_bytes the on-disk tier is pruned down to once exceeded,
+                so that a full cache is not walked on every write. Default is 0.9.
+        """
+        self.cache_dir = cache_dir
+        self.model_paths = list(model_paths)
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_age_seconds = max_age_seconds
+        self.check_interval = check_interval
+        self.prune_ratio = prune_ratio
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+        # Serializes the model checks and the prunes, which walk the on-disk tier
+        self.maintenance_lock = threading.RLock()
+        # Bytes of the on-disk tier, counted by the first prune, then by put and prune
+        self.disk_bytes = None
+        self.last_prune = 0.0
+
+        # Counters reported by stats
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        self.signature = None
+        self.fingerprint = None
+        self.last_check = 0.0
+        self.check_models(force=True)
+
+    def check_models(self, force=False):
+        """
+        Recompute the model fingerprint if a model file changed.
+
+        Parameters:
+            force (bool): Whether to check regardless of check_interval. Default is False.
+        """
+        now = time.monotonic()
+        if not force and now - self.last_check < self.check_interval:
+            return
+
+        with self.maintenance_lock:
+            # Another thread may have checked while this one waited
+            if not force and now - self.last_check < self.check_interval:
+                return
+            self.last_check = now
+
+            signature = model_signature(self.model_paths)
+            if signature == self.signature:
+                return
+
+            self.signature = signature
+            self.fingerprint = model_fingerprint(self.model_paths)
+
+            # Results of the previous models can never be hit again
+            with self.lock:
+                self.memory.clear()
+                self.memory_bytes = 0
+            self.prune()
+
+    def key(self, data):
+        """Get the cache key of image bytes."""
+        return hashlib.sha256(data).hexdigest()
+
+    def entry_path(self, key):
+        """Get the on-disk path of an entry."""
+        return os.path.join(self.cache_dir, self.fingerprint[:16], key[:2], f"{key}.npz")
+
+    def get(self, data):
+        """
+        Look up the result of an image.
+
+        Parameters:
+            data (bytes): The image bytes.
+
+        Returns:
+            dict: The cached label, probabilities and embedding, or None on a miss.
+        """
+        self.check_models()
+        key = self.key(data)
+
+        with self.lock:
+            if key in self.memory:
+                result, size, stored = self.memory[key]
+
+                # Expired results leave memory, their file is expired too
+                if self.max_age_seconds and time.time() - stored > self.max_age_seconds:
+                    del self.memory[key]
+                    self.memory_bytes -= size
+                else:
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                    self.bytes_saved += len(data)
+                    return result
+
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as arrays:
+                result = {name: arrays[name] for name in arrays.files}
+            result["label"] = str(result["label"])
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # A concurrent prune may have removed the entry since it was read
+        try:
+            stat = os.stat(path)
+            stored = stat.st_mtime
+            expired = self.max_age_seconds and time.time() - stored > self.max_age_seconds
+            if expired:
+                os.remove(path)
+                with self.lock:
+                    self.disk_bytes -= stat.st_size
+        except FileNotFoundError:
+            stored = time.time()
+            expired = False
+
+        if expired:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.disk_hits += 1
+            self.bytes_saved += len(data)
+        self.remember(key, result, stored)
+
+        return result
+
+    def put(self, data, label, probabilities=None, embedding=None):
+        """
+        Store the result of an image in both tiers.
+
+        Parameters:
+            data (bytes): The image bytes.
+            label (str): The predicted class.
+            probabilities (np.ndarray): The class probabilities. Default is None.
+            embedding (np.ndarray): The feature vector. Default is None.
+        """
+        result = {"label": label}
+        if probabilities is not None:
+            result["probabilities"] = np.asarray(probabilities)
+        if embedding is not None:
+            result["embedding"] = np.asarray(embedding)
+
+        key = self.key(data)
+        self.remember(key, result)
+
+        # Write through a temporary file so readers never see a partial entry
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(buffer, **result)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(buffer.getvalue())
+
+        try:
+            replaced_size = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced_size = 0
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.disk_bytes += len(buffer.getvalue()) - replaced_size
+            over_size = self.disk_bytes > self.max_disk_bytes
+
+        # Prune once the size bound is exceeded, and at least every max_age_seconds
+        expiring = (
+            self.max_age_seconds and time.monotonic() - self.last_prune > self.max_age_seconds
+        )
+        if (over_size or expiring) and self.maintenance_lock.acquire(blocking=False):
+            # A prune already running in another thread does the job
+            try:
+                self.prune(target_bytes=int(self.max_disk_bytes * self.prune_ratio))
+            finally:
+                self.maintenance_lock.release()
+
+    def remember(self, key, result, stored=None):
+        """
+        Insert a result in the in-memory tier, evicting the least recently used ones.
+
+        Parameters:
+            key (str): The cache key.
+            result (dict): The result.
+            stored (float): When the result was computed, for max_age_seconds. Default is None (now).
+        """
+        size = sum(np.asarray(value).nbytes for value in result.values())
+
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= self.memory.pop(key)[1]
+            self.memory[key] = (result, size, time.time() if stored is None else stored)
+            self.memory_bytes += size
+
+            while self.memory_bytes > self.max_memory_bytes and self.memory:
+                _, (_, evicted_size, _) = self.memory.popitem(last=False)
+                self.memory_bytes -= evicted_size
+
+    def prune(self, target_bytes=None):
+        """
+        Evict on-disk entries of other model versions, entries older than max_age_seconds,
+        and the oldest entries beyond max_disk_bytes.
+
+        Entries written or removed by other threads during the walk are skipped.
+
+        Parameters:
+            target_bytes (int): The size the oldest entries are evicted down to. Default is max_disk_bytes.
+
+        Returns:
+            int: The number of bytes freed.
+        """
+        with self.maintenance_lock:
+            self.last_prune = time.monotonic()
+            if not os.path.exists(self.cache_dir):
+                with self.lock:
+                    if self.disk_bytes is None:
+                        self.disk_bytes = 0
+                return 0
+
+            if target_bytes is None:
+                target_bytes = self.max_disk_bytes
+
+            current = self.fingerprint[:16]
+            now = time.time()
+            freed = 0
+            entries = []
+
+            for root, _, names in os.walk(self.cache_dir):
+                stale_model = os.path.relpath(root, self.cache_dir).split(os.sep)[0] != current
+                for name in names:
+                    # Entries being written are renamed once complete
+                    if name.endswith(".tmp"):
+                        continue
+
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                        expired = (
+                            self.max_age_seconds and now - stat.st_mtime > self.max_age_seconds
+                        )
+                        if stale_model or expired:
+                            os.remove(path)
+                            freed += stat.st_size
+                        else:
+                            entries.append((stat.st_mtime, stat.st_size, path))
+                    except FileNotFoundError:
+                        continue
+
+            # Evict the oldest entries until the size bound holds
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= target_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+            # Only count what this prune removed: entries written during the walk
+            # were counted by put and may not have been seen
+            with self.lock:
+                if self.disk_bytes is None:
+                    self.disk_bytes = total
+                else:
+                    self.disk_bytes -= freed
+
+            return freed
+
+    def stats(self):
+        """
+        Get the counters of the cache.
+
+        Returns:
+            dict: The memory hits, disk hits, misses, hit rate, image bytes whose inference was skipped, and memory usage.
+        """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "memory_bytes": self.memory_bytes,
+        }
@@ -0,0 +1,209 @@
+import numpy as np
+from scripts.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# Columns of the oversampling targets, one row per stratum
+TARGET_COLUMNS = [
+    "Category",
+    "Style",
+    "Current_Count",
+    "Avg_Count",
+    "Max_Count",
+    "Threshold",
+    "Final_Count",
+    "Generate_Count",
+]
+
+
+def strata(df, by=("Category", "Style")):
+    """
+    Number the strata of a manifest.
+
+    Parameters:
+        df (pd.DataFrame): The manifest.
+        by (tuple of str): The columns defining the strata. Default is ("Category", "Style").
+
+    Returns:
+        tuple: The stratum of every row (0 to n_strata - 1, in sorted order of the columns) and the value of every column for every stratum.
+    """
+    codes = np.zeros(len(df), dtype=np.int64)
+    levels = []
+    for column in by:
+        column_codes, uniques = pd.factorize(df[column], sort=True)
+        codes = codes * len(uniques) + column_codes
+        levels.append(np.asarray(uniques))
+
+    # Compact the combined codes to the strata that occur
+    present = np.flatnonzero(np.bincount(codes, minlength=np.prod([len(l) for l in levels])))
+    remap = np.zeros(present[-1] + 1 if len(present) else 0, dtype=np.int64)
+    remap[present] = np.arange(len(present))
+
+    # Decode the value of every column from the combined code of every stratum
+    values = []
+    for level in reversed(levels):
+        values.append(level[present % len(level)])
+        present = present // len(level)
+
+    return remap[codes], values[::-1]
+
+
+def shuffled_ranks(codes, seed=42):
+    """
+    Rank the rows of every stratum in a random order.
+
+    Parameters:
+        codes (np.ndarray): The stratum of every row.
+        seed (int): The seed of the order. Default is 42.
+
+    Returns:
+        np.ndarray: The rank of every row within its stratum, from 0.
+    """
+    rng = np.random.default_rng(seed)
+
+    # A stable sort of shuffled rows by stratum keeps the shuffle within every stratum.
+    # Small integer keys let numpy use a radix sort.
+    permutation = rng.permutation(len(codes))
+    keys = codes[permutation]
+    if len(codes) and codes.max() < np.iinfo(np.int16).max:
+        keys = keys.astype(np.int16)
+    order = permutation[np.argsort(keys, kind="stable")]
+
+    sizes = np.bincount(codes)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+    ranks = np.empty(len(codes), dtype=np.int64)
+    ranks[order] = np.arange(len(codes)) - np.repeat(starts, sizes)
+
+    return ranks
+
+
+def stratified_split(df, test_size=0.2, seed=42, by=("Category", "Style")):
+    """
+    Split a manifest into train and test sets, stratified by category and style.
+
+    Every stratum contributes ceil(test_size * size) rows to the test set, as
+    train_test_split does, but a stratum always keeps at least one training row.
+
+    Parameters:
+        df (pd.DataFrame): The manifest.
+        test_size (float): Fraction of every stratum in the test set. Default is 0.2.
+        seed (int): The seed of the split. Default is 42.
+        by (tuple of str): The columns defining the strata. Default is ("Category", "Style").
+
+    Returns:
+        tuple: The train and test DataFrames, in the order of the manifest.
+    """
+    if not 0 < test_size < 1:
+        raise ValueError("test_size must be between 0 and 1")
+
+    if len(df) == 0:
+        return df.copy(), df.copy()
+
+    codes, _ = strata(df, by)
+    sizes = np.bincount(codes)
+
+    test_sizes = np.minimum(np.ceil(sizes * test_size).astype(np.int64), sizes - 1)
+    is_test = shuffled_ranks(codes, seed) < test_sizes[codes]
+
+    return df[~is_test], df[is_test]
+
+
+def target_counts(codes, category_values, growth=1.3):
+    """
+    Compute the counts of the oversampling rule for every stratum.
+
+    Parameters:
+        codes (np.ndarray): The stratum of every row.
+        category_values (np.ndarray): The category of every stratum.
+        growth (float): The minimum growth factor of every stratum. Default is 1.3.
+
+    Returns:
+        tuple: The current, average, maximum, threshold and final count of every stratum.
+    """
+    counts = np.bincount(codes)
+
+    # Category of every stratum
+    categories, category_of = np.unique(category_values, return_inverse=True)
+    category_of = category_of.reshape(-1)
+
+    # Average (truncated) and maximum count of the styles of every category
+    averages = (
+        np.bincount(category_of, weights=counts) // np.bincount(category_of)
+    ).astype(np.int64)[category_of]
+    maxima = np.zeros(len(categories), dtype=np.int64)
+    np.maximum.at(maxima, category_of, counts)
+    maxima = maxima[category_of]
+
+    thresholds = averages + maxima
+    finals = np.maximum(thresholds, (counts * growth).astype(np.int64))
+
+    return counts, averages, maxima, thresholds, finals
+
+
+def oversampling_targets(df, growth=1.3, by=("Category", "Style")):
+    """
+    Compute the number of images every style of a category should reach.
+
+    A stratum reaches the larger of the average plus the maximum count of the styles
+    of its category, and its own count times growth.
+
+    Parameters:
+        df (pd.DataFrame): The manifest.
+        growth (float): The minimum growth factor of every stratum. Default is 1.3.
+        by (tuple of str): The category and style columns. Default is ("Category", "Style").
+
+    Returns:
+        pd.DataFrame: One row per stratum with the current, average, maximum, threshold, final and generated counts.
+    """
+    codes, (category_values, style_values) = strata(df, by)
+    counts, averages, maxima, thresholds, finals = target_counts(
+        codes, category_values, growth
+    )
+
+    return pd.DataFrame(
+        {
+            "Category": category_values,
+            "Style": style_values,
+            "Current_Count": counts,
+            "Avg_Count": averages,
+            "Max_Count": maxima,
+            "Threshold": thresholds,
+            "Final_Count": finals,
+            "Generate_Count": finals - counts,
+        },
+        columns=TARGET_COLUMNS,
+    )
+
+
+def oversampling_plan(df, growth=1.3, seed=42, by=("Category", "Style")):
+    """
+    Compute the number of augmented images to generate from every image.
+
+    The images to generate for a stratum are spread evenly over its images; the
+    remainder goes to images picked at random under the seed.
+
+    Parameters:
+        df (pd.DataFrame): The manifest, with the Path column.
+        growth (float): The minimum growth factor of every stratum. Default is 1.3.
+        seed (int): The seed of the remainder assignment. Default is 42.
+        by (tuple of str): The category and style columns. Default is ("Category", "Style").
+
+    Returns:
+        pd.DataFrame: The Path, Category, Style and Count of every image with a positive count.
+    """
+    if len(df) == 0:
+        return pd.DataFrame(columns=["Path", *by, "Count"])
+
+    codes, (category_values, _) = strata(df, by)
+    counts, _, _, _, finals = target_counts(codes, category_values, growth)
+    generate = finals - counts
+
+    per_image = generate[codes] // counts[codes]
+    per_image += shuffled_ranks(codes, seed) < (generate % counts)[codes]
+
+    keep = per_image > 0
+    plan = df.loc[keep, ["Path", *by]].reset_index(drop=True)
+    plan["Count"] = per_image[keep]
+
+    return plan
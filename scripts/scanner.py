@@ -0,0 +1,197 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from scripts import constants as const
+from scripts.zip_source import ZipImageSource, file_signature
+
+
+class ScanEntry(NamedTuple):
+    """An image file found by the scanner, with its stat information."""
+
+    path: str
+    category: str
+    style: str
+    size: int
+    # Modification time for files on disk, CRC for archive members, as in file_signature
+    version: int
+    inode: int
+
+    @property
+    def signature(self):
+        """The (size, version) signature of the file, as from file_signature."""
+        return self.size, self.version
+
+
+def is_generated(name):
+    """
+    Check whether a file was generated next to the raw images, by the augmentation or the normalization.
+
+    Parameters:
+        name (str): The file name.
+
+    Returns:
+        bool: Whether the file is not a raw image.
+    """
+    return name.startswith(const.AUGMENTED_PREFIX) or name.endswith(const.NORMALIZED_SUFFIX)
+
+
+def parse_classes(parts):
+    """
+    Get the category and style of a file laid out as .../<category>/<style>/<file>.
+
+    Parameters:
+        parts (tuple of str): The components of the path.
+
+    Returns:
+        tuple: The category and style, or empty strings if the path is too short.
+    """
+    category = parts[-3] if len(parts) >= 3 else ""
+    style = parts[-2] if len(parts) >= 2 else ""
+    return category, style
+
+
+class Scanner:
+    def __init__(self, extensions=const.IMAGE_EXTENSIONS, workers=8, stat=True, follow_links=False):
+        """
+        Parallel os.scandir walker listing the image files of dataset directories.
+
+        Directories are scanned on a thread pool, since the system calls release the GIL
+        and are slow on network storage. Entries are streamed in a deterministic order:
+        breadth-first, every directory sorted by name, which for <category>/<style>/<file>
+        trees is the sorted order of the paths.
+
+        Parameters:
+            extensions (tuple of str): The file extensions to list, matched case-insensitively. None lists every file. Default is the image extensions.
+            workers (int): Number of scanning threads. Default is 8.
+            stat (bool): Whether to read the size, modification time and inode of every file. Default is True.
+            follow_links (bool): Whether to descend into symbolic links to directories. Default is False, as os.walk.
+        """
+        self.extensions = tuple(ext.lower() for ext in extensions) if extensions else None
+        self.workers = workers or os.cpu_count() or 1
+        self.stat = stat
+        self.follow_links = follow_links
+
+    def matches(self, name):
+        """Check whether a file name is listed: not hidden, with one of the extensions."""
+        if name.startswith("."):
+            return False
+        return self.extensions is None or name.lower().endswith(self.extensions)
+
+    def scan_dir(self, dir, parts):
+        """
+        List the files and subdirectories of one directory.
+
+        Parameters:
+            dir (str): The directory.
+            parts (tuple of str): The components of the directory below the scanned root.
+
+        Returns:
+            tuple: The ScanEntry of every matching file and the sorted subdirectories.
+        """
+        files = []
+        subdirs = []
+
+        try:
+            with os.scandir(dir) as iterator:
+                items = sorted(iterator, key=lambda item: item.name)
+        except OSError:
+            # Unreadable directories are skipped, as os.walk does
+            return files, subdirs
+
+        for item in items:
+            try:
+                if item.is_dir(follow_symlinks=self.follow_links):
+                    if not item.name.startswith("."):
+                        subdirs.append((item.path, parts + (item.name,)))
+                    continue
+
+                if not self.matches(item.name):
+                    continue
+
+                # The stat of the entry is cached, and free on Windows
+                size = version = inode = 0
+                if self.stat:
+                    stat = item.stat()
+                    size, version, inode = stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+                category, style = parse_classes(parts + (item.name,))
+                files.append(ScanEntry(item.path, category, style, size, version, inode))
+            except OSError:
+                # Removed while scanning
+                continue
+
+        return files, subdirs
+
+    def scan(self, roots, depth=None):
+        """
+        Stream the image files of directories or ZIP archives.
+
+        Parameters:
+            roots (str or list of str): The directories or ZIP archives.
+            depth (int): Only list the files this many directories below a root directory, e.g. 2
+                for <category>/<style>/<file>. Archive members are all listed. Default is None (every file).
+
+        Yields:
+            ScanEntry: The entry of every file, breadth-first over the roots.
+        """
+        if isinstance(roots, (str, os.PathLike)):
+            roots = [roots]
+
+        for root in roots:
+            if not os.path.exists(root):
+                raise FileNotFoundError(f"Directory not found: {root}")
+
+        # The pool is shut down as soon as the caller stops consuming
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            pending = deque()
+            for root in roots:
+                if os.path.isfile(root):
+                    yield from self.scan_archive(root)
+                    continue
+                pending.append((executor.submit(self.scan_dir, os.fspath(root), ()), 0))
+
+            # Every directory is submitted as soon as it is found, and consumed in order
+            while pending:
+                future, level = pending.popleft()
+                files, subdirs = future.result()
+
+                if depth is None or level < depth:
+                    for subdir, parts in subdirs:
+                        pending.append((executor.submit(self.scan_dir, subdir, parts), level + 1))
+
+                if depth is None or level == depth:
+                    yield from files
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def scan_archive(self, path):
+        """
+        Stream the image members of a ZIP archive, read from its index.
+
+        Parameters:
+            path (str): The ZIP archive.
+
+        Yields:
+            ScanEntry: The entry of every member.
+        """
+        for img_path, category, style in ZipImageSource(path).entries:
+            if not self.matches(os.path.basename(img_path)):
+                continue
+
+            size, version = file_signature(img_path) if self.stat else (0, 0)
+            yield ScanEntry(img_path, category, style, size, version, 0)
+
+    def paths(self, roots, depth=None):
+        """
+        List the image paths of directories or ZIP archives.
+
+        Parameters:
+            roots (str or list of str): The directories or ZIP archives.
+            depth (int): Only list the files this many directories below a root. Default is None (every file).
+
+        Returns:
+            list of str: The image paths.
+        """
+        return [entry.path for entry in self.scan(roots, depth)]
@@ -0,0 +1,402 @@
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from scripts import constants as const
+from scripts.zip_source import read_bytes
+from scripts.decode import decode_image
+from scripts.result_cache import ResultCache
+from scripts.embeddings import FeatureStore, predict
+from scripts.quantize import load_model, configure_threads
+
+
+class ServiceMetrics:
+    def __init__(self, window=10000):
+        """
+        Latency percentiles and batch-size histogram of the service.
+
+        Parameters:
+            window (int): Number of most recent requests the percentiles are computed over. Default is 10000.
+        """
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.errors = 0
+
+    def record_request(self, seconds, failed=False):
+        """Record the latency of a request."""
+        self.latencies.append(seconds)
+        self.requests += 1
+        self.errors += int(failed)
+
+    def record_batch(self, size):
+        """Record the size of an inference batch."""
+        self.batch_sizes[size] += 1
+
+    def summary(self):
+        """
+        Summarize the metrics.
+
+        Returns:
+            dict: The request and error counts, latency percentiles in milliseconds and batch-size histogram.
+        """
+        latencies = np.asarray(self.latencies) * 1000
+        percentiles = (
+            dict(zip(["p50", "p90", "p99"], np.percentile(latencies, [50, 90, 99]).tolist()))
+            if len(latencies)
+            else {}
+        )
+        batches = sum(self.batch_sizes.values())
+
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_ms": percentiles,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "mean_batch_size": (
+                sum(size * count for size, count in self.batch_sizes.items()) / batches
+                if batches
+                else 0.0
+            ),
+        }
+
+
+class MicroBatcher:
+    def __init__(self, function, max_batch_size=32, max_wait_ms=5, executor=None, metrics=None):
+        """
+        Groups concurrent requests into batches processed by a single call.
+
+        A batch is dispatched when it reaches max_batch_size, or max_wait_ms after its
+        first request arrived, whichever comes first.
+
+        Parameters:
+            function (callable): Processes a list of items and returns one result per item.
+            max_batch_size (int): Maximum number of items per batch. Default is 32.
+            max_wait_ms (float): Maximum time the first item of a batch waits for others. Default is 5.
+            executor (Executor): Where the function runs, off the event loop. Default is a single thread.
+            metrics (ServiceMetrics): Where batch sizes are recorded. Default is None.
+        """
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.metrics = metrics
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        """Start collecting batches on the running event loop."""
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.collect())
+
+    async def submit(self, item):
+        """
+        Submit an item and wait for its result.
+
+        Parameters:
+            item: The item to process.
+
+        Returns:
+            The result of the item.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def collect(self):
+        """Collect the queued items into batches and run them, forever."""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            # Wait for more items until the batch is full or the first item is due
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            if self.metrics is not None:
+                self.metrics.record_batch(len(batch))
+
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.function, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class RecommendationService:
+    def __init__(
+        self,
+        classifier,
+        feature_extractor,
+        index,
+        max_batch_size=32,
+        max_wait_ms=5,
+        decode_workers=4,
+        class_labels=const.CLASS_LABELS,
+        cache=None,
+    ):
+        """
+        Classifies images and recommends similar items, batching concurrent requests.
+
+        Parameters:
+            classifier (tf.keras.Model): The CNN classifier.
+            feature_extractor (tf.keras.Model): The feature extractor.
+            index (RecommenderIndex): The index of the catalogue feature vectors.
+            max_batch_size (int): Maximum number of images per inference batch. Default is 32.
+            max_wait_ms (float): Maximum time a request waits for a batch to fill. Default is 5.
+            decode_workers (int): Number of threads decoding uploaded images. Default is 4.
+            class_labels (list of str): The label of every classifier output. Default is const.CLASS_LABELS.
+            cache (ResultCache): Cache of the results of images already seen. Default is None.
+        """
+        self.classifier = classifier
+        self.feature_extractor = feature_extractor
+        self.index = index
+        self.class_labels = class_labels
+        self.cache = cache
+        self.metrics = ServiceMetrics()
+        self.decoder = ThreadPoolExecutor(max_workers=decode_workers)
+        self.batcher = MicroBatcher(
+            self.infer, max_batch_size, max_wait_ms, metrics=self.metrics
+        )
+
+    @classmethod
+    def from_files(
+        cls,
+        classifier_path,
+        feature_extractor_path,
+        features_dir,
+        n_clusters=None,
+        cache_dir=None,
+        num_threads=None,
+        **kwargs,
+    ):
+        """
+        Load the models and the feature store once.
+
+        Parameters:
+            classifier_path (str): The path to the classifier, e.g. cache_cnn/best_cnn.h5, or its .tflite export.
+            feature_extractor_path (str): The path to the feature extractor SavedModel, or its .tflite export.
+            features_dir (str): The directory of the FeatureStore.
+            n_clusters (int): Number of partitions per category of the index. Default is None.
+            cache_dir (str): The directory of the result cache. Default is None (no cache).
+            num_threads (int): Intra-op threads of TensorFlow and threads of the TFLite interpreters. Default is None.
+
+        Returns:
+            RecommendationService: The service.
+        """
+        configure_threads(num_threads)
+        classifier = load_model(classifier_path, num_threads=num_threads)
+        feature_extractor = load_model(feature_extractor_path, num_threads=num_threads)
+        index = FeatureStore(features_dir).to_recommender(n_clusters)
+
+        if cache_dir:
+            kwargs["cache"] = ResultCache(cache_dir, [classifier_path, feature_extractor_path])
+
+        return cls(classifier, feature_extractor, index, **kwargs)
+
+    def infer(self, images):
+        """
+        Classify and embed a batch of images.
+
+        Parameters:
+            images (list of np.ndarray): The uint8 RGB images.
+
+        Returns:
+            list of tuple: The label, class probabilities and feature vector of every image.
+        """
+        batch = np.stack(images).astype(np.float32) / 255.0
+        probabilities = predict(self.classifier, batch)
+        vectors = predict(self.feature_extractor, batch)
+
+        return [
+            (self.class_labels[int(np.argmax(probs))], probs, vector)
+            for probs, vector in zip(probabilities, vectors)
+        ]
+
+    @staticmethod
+    def decode(data):
+        """Decode uploaded image bytes as a fixed-size RGB array."""
+        return decode_image(data, size=const.IMAGE_SIZE)
+
+    async def recommend(self, path=None, data=None, k=10):
+        """
+        Classify an image and find the k most similar items of its category.
+
+        Parameters:
+            path (str): The path to an image on disk. Default is None.
+            data (bytes): The uploaded image bytes, if no path is given. Default is None.
+            k (int): Number of recommendations. Default is 10.
+
+        Returns:
+            dict: The predicted category, class probabilities and recommendations.
+        """
+        loop = asyncio.get_running_loop()
+        if path is not None:
+            data = await loop.run_in_executor(self.decoder, read_bytes, path)
+
+        # Images already seen skip decoding and inference
+        cached = None
+        if self.cache is not None:
+            cached = await loop.run_in_executor(self.decoder, self.cache.get, data)
+        if cached is not None:
+            label, probabilities, vector = (
+                cached["label"],
+                cached["probabilities"],
+                cached["embedding"],
+            )
+        else:
+            image = await loop.run_in_executor(self.decoder, self.decode, data)
+            label, probabilities, vector = await self.batcher.submit(image)
+            if self.cache is not None:
+                await loop.run_in_executor(
+                    self.decoder, self.cache.put, data, label, probabilities, vector
+                )
+        (paths, scores), = self.index.query(
+            vector[None], [label], k=k, exclude_paths=None if path is None else [path]
+        )
+
+        return {
+            "category": label,
+            "probabilities": dict(zip(self.class_labels, np.asarray(probabilities).tolist())),
+            "recommendations": [
+                {"path": str(p), "similarity": float(s)} for p, s in zip(paths, scores)
+            ],
+        }
+
+    async def handle(self, reader, writer):
+        """Serve the HTTP requests of one connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = await self.route(method, target, headers, body)
+
+                content = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(content)}\r\n\r\n".encode()
+                    + content
+                )
+                await writer.drain()
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, headers, body):
+        """
+        Dispatch a request.
+
+        POST /recommend takes either a JSON body {"path": ...} or raw image bytes, and an
+        optional k query parameter. GET /metrics returns the service metrics.
+
+        Returns:
+            tuple: The HTTP status line and the JSON payload.
+        """
+        url = urlparse(target)
+
+        if method == "GET" and url.path == "/metrics":
+            summary = self.metrics.summary()
+            if self.cache is not None:
+                summary["cache"] = self.cache.stats()
+            return "200 OK", summary
+
+        if method == "GET" and url.path == "/health":
+            return "200 OK", {"status": "ok"}
+
+        if method != "POST" or url.path != "/recommend":
+            return "404 Not Found", {"error": f"No route for {method} {url.path}"}
+
+        start = time.perf_counter()
+        try:
+            k = int(parse_qs(url.query).get("k", [10])[0])
+            if headers.get("content-type", "").startswith("application/json"):
+                result = await self.recommend(path=json.loads(body)["path"], k=k)
+            else:
+                result = await self.recommend(data=body, k=k)
+        except Exception as e:
+            self.metrics.record_request(time.perf_counter() - start, failed=True)
+            return "400 Bad Request", {"error": str(e)}
+
+        self.metrics.record_request(time.perf_counter() - start)
+        return "200 OK", result
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        """
+        Serve requests until cancelled.
+
+        Parameters:
+            host (str): The address to bind. Default is "127.0.0.1".
+            port (int): The port to bind. Default is 8000.
+        """
+        self.batcher.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f">>> Serving on http://{host}:{port}")
+
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Furniture classification and recommendation service.")
+    parser.add_argument("--classifier", default="cache_cnn/best_cnn.h5")
+    parser.add_argument("--feature-extractor", default="feature_extract")
+    parser.add_argument("--features", required=True, help="Directory of the feature store.")
+    parser.add_argument("--clusters", type=int, default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--cache-dir", default=None, help="Directory of the result cache.")
+    parser.add_argument("--threads", type=int, default=None, help="Inference threads.")
+    args = parser.parse_args()
+
+    service = RecommendationService.from_files(
+        args.classifier,
+        args.feature_extractor,
+        args.features,
+        n_clusters=args.clusters,
+        cache_dir=args.cache_dir,
+        num_threads=args.threads,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    asyncio.run(service.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import json
+import numpy as np
+from scripts.stream import ImageStream
+from scripts.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# Files of a shard directory
+SHARD_INDEX_FILE = "index.csv"
+SHARD_META_FILE = "meta.json"
+
+
+class ShardWriter:
+    def __init__(self, output_dir, size=(256, 256), shard_size=4096, prefetch=64, workers=4):
+        """
+        Packs the images of a manifest into fixed-shape uint8 .npy shards.
+
+        Parameters:
+            output_dir (str): The directory to write the shards to.
+            size (tuple): The (width, height) every image is resized to. Default is (256, 256).
+            shard_size (int): Number of images per shard. Default is 4096.
+            prefetch (int): Maximum number of decodes in flight. Default is 64.
+            workers (int): Number of decoding threads. Default is 4.
+        """
+        self.output_dir = output_dir
+        self.size = tuple(size)
+        self.shard_size = shard_size
+        self.prefetch = prefetch
+        self.workers = workers
+
+    def write(self, df):
+        """
+        Decode the images of a manifest and write them to shards.
+
+        Parameters:
+            df (pd.DataFrame): The manifest, with at least the Path, Category and Style columns.
+
+        Returns:
+            pd.DataFrame: The index of the shards, with the Path, Category, Style, Shard and Offset columns.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        width, height = self.size
+
+        labels = dict(zip(df["Path"], zip(df["Category"], df["Style"])))
+        stream = ImageStream(
+            df["Path"],
+            size=self.size,
+            batch_size=min(self.shard_size, 256),
+            prefetch=self.prefetch,
+            workers=self.workers,
+        )
+
+        index = []
+        counts = []
+        shard = None
+        written = 0
+
+        for batch_paths, batch in stream:
+            for path, array in zip(batch_paths, batch):
+                shard_id, offset = divmod(written, self.shard_size)
+
+                # Open the next shard, sized for the paths that are left
+                if offset == 0:
+                    if shard is not None:
+                        shard.flush()
+                    capacity = min(self.shard_size, len(df) - written)
+                    shard = np.lib.format.open_memmap(
+                        self.shard_path(shard_id),
+                        mode="w+",
+                        dtype=np.uint8,
+                        shape=(capacity, height, width, 3),
+                    )
+                    counts.append(0)
+
+                shard[offset] = array
+                counts[shard_id] += 1
+
+                category, style = labels[path]
+                index.append((path, category, style, shard_id, offset))
+                written += 1
+
+        if shard is not None:
+            shard.flush()
+
+        df_index = pd.DataFrame(
+            index, columns=["Path", "Category", "Style", "Shard", "Offset"]
+        )
+        df_index.to_csv(os.path.join(self.output_dir, SHARD_INDEX_FILE), index=False)
+
+        with open(os.path.join(self.output_dir, SHARD_META_FILE), "w") as f:
+            json.dump(
+                {"size": list(self.size), "shard_size": self.shard_size, "counts": counts},
+                f,
+            )
+
+        return df_index
+
+    def shard_path(self, shard_id):
+        """Get the path of a shard file."""
+        return os.path.join(self.output_dir, f"shard_{shard_id:05d}.npy")
+
+
+class ShardReader:
+    def __init__(self, shard_dir):
+        """
+        Reads image shards through memory maps, handing out zero-copy batch views.
+
+        Parameters:
+            shard_dir (str): The directory written by ShardWriter.
+        """
+        if not os.path.exists(shard_dir):
+            raise FileNotFoundError(f"Directory not found: {shard_dir}")
+
+        with open(os.path.join(shard_dir, SHARD_META_FILE)) as f:
+            meta = json.load(f)
+
+        self.shard_dir = shard_dir
+        self.size = tuple(meta["size"])
+        self.shard_size = meta["shard_size"]
+        self.counts = meta["counts"]
+        self.index = pd.read_csv(os.path.join(shard_dir, SHARD_INDEX_FILE))
+
+        # Only the pages that are read are ever loaded into memory
+        self.shards = [
+            np.load(os.path.join(shard_dir, f"shard_{shard_id:05d}.npy"), mmap_mode="r")
+            for shard_id in range(len(self.counts))
+        ]
+
+    def __len__(self):
+        return len(self.index)
+
+    def batch(self, start, stop):
+        """
+        Get the images of the rows [start, stop).
+
+        Rows within a single shard are returned as a view of the memory map; a range
+        crossing a shard boundary is copied.
+
+        Parameters:
+            start (int): The first row.
+            stop (int): The row after the last one.
+
+        Returns:
+            np.ndarray: The uint8 array of shape (N, height, width, 3).
+        """
+        stop = min(stop, len(self))
+        parts = []
+
+        # Take the slice of every shard the range overlaps
+        while start < stop:
+            shard_id, offset = divmod(start, self.shard_size)
+            end = min(stop, (shard_id + 1) * self.shard_size)
+            parts.append(self.shards[shard_id][offset : offset + end - start])
+            start = end
+
+        if len(parts) == 1:
+            return parts[0]
+
+        return np.concatenate(parts)
+
+    def batches(self, batch_size, shuffle=False, seed=None):
+        """
+        Iterate over the shards in batches that never cross a shard boundary.
+
+        Shuffling permutes the order of the batches, keeping every batch a zero-copy view.
+
+        Parameters:
+            batch_size (int): The maximum number of images per batch.
+            shuffle (bool): Whether to visit the batches in random order. Default is False.
+            seed (int): The seed of the shuffle. Default is None.
+
+        Yields:
+            tuple: The index rows and the uint8 array of the batch.
+        """
+        spans = []
+        for shard_id, count in enumerate(self.counts):
+            shard_start = shard_id * self.shard_size
+            for start in range(shard_start, shard_start + count, batch_size):
+                spans.append((start, min(start + batch_size, shard_start + count)))
+
+        if shuffle:
+            np.random.default_rng(seed).shuffle(spans)
+
+        for start, stop in spans:
+            yield self.index.iloc[start:stop], self.batch(start, stop)
@@ -0,0 +1,124 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from scripts.decode import decode_image
+from scripts.instrument import instrument
+
+
+def load_image(path, size=None):
+    """
+    Fully decode an image as RGB, so that it no longer depends on an open file handle.
+
+    Parameters:
+        path (str): The image path.
+        size (tuple): The (width, height) to resize the image to. Default is None (original size).
+
+    Returns:
+        PIL.Image.Image: The decoded image.
+    """
+    return Image.fromarray(decode_image(path, size=size))
+
+
+def load_array(path, size):
+    """
+    Decode an image as a fixed-size RGB uint8 array.
+
+    Parameters:
+        path (str): The image path.
+        size (tuple): The (width, height) of the array.
+
+    Returns:
+        np.ndarray: The array of shape (height, width, 3).
+    """
+    # Let the JPEG decoder skip the scales we do not need
+    return decode_image(path, size=size)
+
+
+class ImageStream:
+    def __init__(self, paths, size=None, batch_size=None, prefetch=16, workers=4):
+        """
+        Iterates over decoded images while a thread pool prefetches the next ones.
+
+        At most prefetch images are decoded ahead of the consumer, so memory stays bounded
+        whatever the number of paths.
+
+        Parameters:
+            paths (iterable of str): The image paths. Can be a generator.
+            size (tuple): The (width, height) images are resized to. Required for batches. Default is None.
+            batch_size (int): If set, yield (paths, uint8 array) batches instead of single images. Default is None.
+            prefetch (int): Maximum number of decodes in flight. Default is 16.
+            workers (int): Number of decoding threads. Default is 4.
+        """
+        if batch_size and size is None:
+            raise ValueError("size is required to yield batches.")
+
+        self.paths = paths
+        self.size = tuple(size) if size is not None else None
+        self.batch_size = batch_size
+        self.prefetch = max(prefetch, batch_size or 1)
+        self.workers = workers or os.cpu_count() or 1
+
+    def images(self):
+        """
+        Yield the decoded images in path order, skipping the ones that cannot be read.
+
+        Yields:
+            tuple: The image path and its PIL image, or its uint8 array if size is set.
+        """
+        decode = load_array if self.size is not None else load_image
+        pending = deque()
+        paths = iter(self.paths)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def submit():
+                # Keep the window of in-flight decodes full
+                for path in paths:
+                    pending.append((path, executor.submit(decode, path, self.size)))
+                    if len(pending) >= self.prefetch:
+                        return
+
+            submit()
+            while pending:
+                path, future = pending.popleft()
+                submit()
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error reading image '{path}': {e}")
+                    instrument.count("decode_failures")
+                    continue
+
+                instrument.count("files_processed")
+                if instrument.enabled:
+                    instrument.count_bytes([path])
+                yield path, result
+
+    def batches(self):
+        """
+        Yield fixed-size batches of decoded images. The last batch may be smaller.
+
+        Yields:
+            tuple: The list of image paths and the uint8 array of shape (N, height, width, 3).
+        """
+        width, height = self.size
+        batch_paths = []
+        batch = np.empty((self.batch_size, height, width, 3), dtype=np.uint8)
+
+        for path, array in self.images():
+            batch[len(batch_paths)] = array
+            batch_paths.append(path)
+
+            if len(batch_paths) == self.batch_size:
+                yield batch_paths, batch
+                batch_paths = []
+                batch = np.empty_like(batch)
+
+        if batch_paths:
+            yield batch_paths, batch[: len(batch_paths)]
+
+    def __iter__(self):
+        return self.batches() if self.batch_size else self.images()
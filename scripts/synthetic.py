@@ -0,0 +1,348 @@
+import os
+import io
+import json
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw, ImageEnhance
+from scripts import constants as const
+
+# Description of a generated dataset, used to reuse it when the parameters match
+SYNTHETIC_META_FILE = "synthetic.json"
+
+# Version of the generation, bumped when the same parameters give another dataset
+# (since 2: the duplicates are counted over the whole dataset)
+SYNTHETIC_VERSION = 2
+
+
+def draw_furniture(draw, rng, category, width, height, color):
+    """
+    Draw a rough silhouette of a piece of furniture.
+
+    Parameters:
+        draw (ImageDraw.ImageDraw): The drawing context.
+        rng (np.random.Generator): The random generator.
+        category (str): The category, one of const.CLASS_LABELS.
+        width (int): The width of the image.
+        height (int): The height of the image.
+        color (tuple): The RGB color of the piece.
+    """
+    # Random placement and scale of the piece
+    cx = width * rng.uniform(0.35, 0.65)
+    cy = height * rng.uniform(0.45, 0.65)
+    w = width * rng.uniform(0.4, 0.7)
+    h = height * rng.uniform(0.3, 0.5)
+    left, right, top, bottom = cx - w / 2, cx + w / 2, cy - h / 2, cy + h / 2
+    leg = max(2, int(w * 0.05))
+
+    if category == "beds":
+        draw.rectangle([left, cy, right, bottom], fill=color)
+        draw.rectangle([left, top, left + w * 0.1, bottom], fill=color)
+        draw.rectangle([left + w * 0.12, cy - h * 0.12, left + w * 0.35, cy], fill=(240, 240, 240))
+    elif category == "chairs":
+        draw.rectangle([cx - w / 4, cy, cx + w / 4, cy + h * 0.1], fill=color)
+        draw.rectangle([cx - w / 4, top, cx - w / 4 + leg, bottom], fill=color)
+        draw.rectangle([cx + w / 4 - leg, cy, cx + w / 4, bottom], fill=color)
+    elif category == "dressers":
+        draw.rectangle([left, top, right, bottom], fill=color)
+        for i in range(1, 4):
+            y = top + h * i / 4
+            draw.line([left, y, right, y], fill=(30, 30, 30), width=2)
+    elif category == "lamps":
+        draw.polygon([(cx - w / 4, cy), (cx + w / 4, cy), (cx + w / 8, top), (cx - w / 8, top)], fill=color)
+        draw.rectangle([cx - leg / 2, cy, cx + leg / 2, bottom], fill=(60, 60, 60))
+        draw.ellipse([cx - w / 6, bottom - h * 0.05, cx + w / 6, bottom + h * 0.05], fill=(60, 60, 60))
+    elif category == "sofas":
+        draw.rounded_rectangle([left, cy - h * 0.2, right, bottom], radius=int(h * 0.15), fill=color)
+        draw.rectangle([left, top, left + w * 0.12, bottom], fill=color)
+        draw.rectangle([right - w * 0.12, top, right, bottom], fill=color)
+    else:
+        draw.rectangle([left, top, right, top + h * 0.1], fill=color)
+        draw.rectangle([left + leg, top, left + 2 * leg, bottom], fill=color)
+        draw.rectangle([right - 2 * leg, top, right - leg, bottom], fill=color)
+
+
+def synthesize_image(rng, category, style, width, height):
+    """
+    Synthesize an image of a category in a style.
+
+    The style sets the palette, the category sets the silhouette, and the rest is random.
+
+    Parameters:
+        rng (np.random.Generator): The random generator.
+        category (str): The category, one of const.CLASS_LABELS.
+        style (str): The style, such as "Modern".
+        width (int): The width of the image.
+        height (int): The height of the image.
+
+    Returns:
+        Image.Image: The RGB image.
+    """
+    # The palette of a style is the same for every image
+    palette = np.random.default_rng(list(style.encode())).integers(40, 230, size=(2, 3))
+    background = tuple(int(c) for c in np.clip(palette[0] + rng.integers(-20, 21, 3), 0, 255))
+    color = tuple(int(c) for c in np.clip(palette[1] + rng.integers(-30, 31, 3), 0, 255))
+
+    image = Image.new("RGB", (width, height), background)
+    draw = ImageDraw.Draw(image)
+
+    # Floor line, then the piece
+    floor = int(height * rng.uniform(0.75, 0.9))
+    draw.rectangle([0, floor, width, height], fill=tuple(c // 2 for c in background))
+    draw_furniture(draw, rng, category, width, height, color)
+
+    # Sensor noise so that images do not compress to nothing
+    pixels = np.asarray(image, dtype=np.int16)
+    pixels += rng.integers(-8, 9, size=pixels.shape, dtype=np.int16)
+
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def near_duplicate(image, rng, quality=80):
+    """
+    Make a near duplicate of an image: a small brightness change and a JPEG round trip.
+
+    Parameters:
+        image (Image.Image): The original image.
+        rng (np.random.Generator): The random generator.
+        quality (int): The JPEG quality of the round trip. Default is 80.
+
+    Returns:
+        Image.Image: The near duplicate.
+    """
+    image = ImageEnhance.Brightness(image).enhance(rng.uniform(0.95, 1.05))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    buffer.seek(0)
+
+    return Image.open(buffer).convert("RGB")
+
+
+def generate_folder(task):
+    """
+    Generate the images of one category/style folder.
+
+    Parameters:
+        task (tuple): The folder, category, style, number of images, width, height, number of duplicates, near duplicate ratio, quality and seed.
+
+    Returns:
+        tuple: The number of unique images, exact duplicates and near duplicates written.
+    """
+    folder, category, style, count, width, height, duplicates, near_ratio, quality, seed = task
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    uniques = count - duplicates
+
+    images = []
+    for i in range(uniques):
+        image = synthesize_image(rng, category, style, width, height)
+        image.save(os.path.join(folder, f"{i}.jpg"), "JPEG", quality=quality)
+        images.append(image)
+
+    exact = near = 0
+    for i in range(duplicates):
+        source = int(rng.integers(uniques))
+        output_path = os.path.join(folder, f"dup_{i}_of_{source}.jpg")
+
+        if rng.random() < near_ratio:
+            near_duplicate(images[source], rng).save(output_path, "JPEG", quality=quality)
+            near += 1
+        else:
+            shutil.copyfile(os.path.join(folder, f"{source}.jpg"), output_path)
+            exact += 1
+
+    return uniques, exact, near
+
+
+def spread_duplicates(total, counts):
+    """
+    Spread the duplicates of a dataset over its folders as evenly as possible.
+
+    Rounding the duplicates of every folder on its own loses them all when the folders
+    are small, such as 500 images over 102 folders at a rate of 0.05.
+
+    Parameters:
+        total (int): The number of duplicates of the dataset.
+        counts (np.ndarray): The number of images of every folder.
+
+    Returns:
+        np.ndarray: The number of duplicates of every folder, the first folders getting the remainder.
+    """
+    # Every non-empty folder keeps at least one unique image to duplicate
+    capacities = np.maximum(np.asarray(counts) - 1, 0)
+    duplicates = np.zeros(len(capacities), dtype=int)
+    remaining = min(int(total), int(capacities.sum()))
+
+    while remaining > 0:
+        open_folders = np.flatnonzero(duplicates < capacities)
+        shares = np.full(len(open_folders), remaining // len(open_folders))
+        shares[: remaining % len(open_folders)] += 1
+
+        added = np.minimum(shares, capacities[open_folders] - duplicates[open_folders])
+        duplicates[open_folders] += added
+        remaining -= int(added.sum())
+
+    return duplicates
+
+
+def _generate_safe(task):
+    """Generate a folder inside a worker process, returning the error instead of raising it."""
+    try:
+        return generate_folder(task)
+    except Exception as e:
+        return e
+
+
+class DatasetGenerator:
+    def __init__(
+        self,
+        num_images=1000,
+        width=256,
+        height=256,
+        duplicate_rate=0.05,
+        near_duplicate_ratio=0.5,
+        categories=None,
+        styles=None,
+        quality=90,
+        seed=42,
+        workers=None,
+    ):
+        """
+        Generator of synthetic furniture datasets laid out as data_x/raw/<category>/<style>/*.jpg.
+
+        Parameters:
+            num_images (int): Total number of images, spread evenly over the folders. Default is 1000.
+            width (int): The width of the images. Default is 256.
+            height (int): The height of the images. Default is 256.
+            duplicate_rate (float): Fraction of the images that duplicate another image of their folder. Default is 0.05.
+            near_duplicate_ratio (float): Fraction of the duplicates that are near (not exact) duplicates. Default is 0.5.
+            categories (list of str): The categories. Default is const.CLASS_LABELS.
+            styles (list of str): The styles. Default is const.STYLE_LABELS.
+            quality (int): The JPEG quality. Default is 90.
+            seed (int): The seed of the dataset. Default is 42.
+            workers (int): Number of worker processes. Default is the number of CPUs.
+        """
+        self.num_images = num_images
+        self.width = width
+        self.height = height
+        self.duplicate_rate = duplicate_rate
+        self.near_duplicate_ratio = near_duplicate_ratio
+        self.categories = list(categories or const.CLASS_LABELS)
+        self.styles = list(styles or const.STYLE_LABELS)
+        self.quality = quality
+        self.seed = seed
+        self.workers = workers
+
+    def params(self):
+        """Get the parameters that determine the generated dataset."""
+        return {
+            "version": SYNTHETIC_VERSION,
+            "num_images": self.num_images,
+            "width": self.width,
+            "height": self.height,
+            "duplicate_rate": self.duplicate_rate,
+            "near_duplicate_ratio": self.near_duplicate_ratio,
+            "categories": self.categories,
+            "styles": self.styles,
+            "quality": self.quality,
+            "seed": self.seed,
+        }
+
+    def generate(self, data_dir, overwrite=False):
+        """
+        Generate the dataset, or reuse it if it was generated with the same parameters.
+
+        Parameters:
+            data_dir (str): The dataset directory, such as "data_x". The images go to its raw subdirectory.
+            overwrite (bool): Whether to regenerate an existing dataset. Default is False.
+
+        Returns:
+            dict: The raw directory and the number of unique images, exact duplicates and near duplicates.
+        """
+        raw_dir = os.path.join(data_dir, const.RAW_DATA_DIR)
+        meta_path = os.path.join(data_dir, SYNTHETIC_META_FILE)
+
+        if not overwrite and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["params"] == self.params():
+                return meta["report"]
+
+        if os.path.exists(raw_dir):
+            shutil.rmtree(raw_dir)
+
+        # Spread the images evenly, the first folders get the remainder
+        folders = [(c, s) for c in self.categories for s in self.styles]
+        counts = np.full(len(folders), self.num_images // len(folders))
+        counts[: self.num_images % len(folders)] += 1
+        duplicates = spread_duplicates(round(self.num_images * self.duplicate_rate), counts)
+
+        tasks = [
+            (
+                os.path.join(raw_dir, category, style),
+                category,
+                style,
+                int(count),
+                self.width,
+                self.height,
+                int(folder_duplicates),
+                self.near_duplicate_ratio,
+                self.quality,
+                [self.seed, i],
+            )
+            for i, ((category, style), count, folder_duplicates) in enumerate(
+                zip(folders, counts, duplicates)
+            )
+        ]
+
+        report = {"raw_dir": raw_dir, "unique": 0, "exact_duplicates": 0, "near_duplicates": 0}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for task, result in zip(tasks, executor.map(_generate_safe, tasks)):
+                if isinstance(result, Exception):
+                    print(f">>> Error generating {task[0]}: {result}")
+                    continue
+                report["unique"] += result[0]
+                report["exact_duplicates"] += result[1]
+                report["near_duplicates"] += result[2]
+
+        with open(meta_path, "w") as f:
+            json.dump({"params": self.params(), "report": report}, f, indent=2)
+
+        return report
+
+
+def main():
+    """Generate a synthetic dataset from the command line."""
+    parser = argparse.ArgumentParser(description="Generate a synthetic furniture dataset.")
+    parser.add_argument("data_dir", help="The dataset directory, such as data_x.")
+    parser.add_argument("--num-images", type=int, default=1000)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--duplicate-rate", type=float, default=0.05)
+    parser.add_argument("--near-duplicate-ratio", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    generator = DatasetGenerator(
+        num_images=args.num_images,
+        width=args.width,
+        height=args.height,
+        duplicate_rate=args.duplicate_rate,
+        near_duplicate_ratio=args.near_duplicate_ratio,
+        seed=args.seed,
+        workers=args.workers,
+    )
+    report = generator.generate(args.data_dir, overwrite=args.overwrite)
+
+    print(
+        f">>> {report['unique']} images, {report['exact_duplicates']} exact and "
+        f"{report['near_duplicates']} near duplicates in {report['raw_dir']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import os
 import importlib
+import importlib.util
 import inspect
+from scripts.lazy import lazy_import, is_loaded
 
 # Styling constants
 BULLET_POINT = ">>>"
@@ -18,8 +20,16 @@ class Utils:
         return os.path.dirname(Utils.get_file_path())  # Call static method directly
 
     @staticmethod
-    def import_modules(module_list=[]):
-        """Import modules with optional aliases into the caller's namespace."""
+    def import_modules(module_list=[], lazy=True):
+        """
+        Import modules with optional aliases into the caller's namespace.
+
+        Parameters:
+            module_list (list of tuple): Extra (name, alias) pairs to import. Default is [].
+            lazy (bool): Whether to bind lazy modules that are only imported on first
+                attribute access, so that unused heavy modules such as tensorflow cost
+                nothing. Default is True.
+        """
 
         core_modules = [
             ("os", None),
@@ -39,18 +49,24 @@ class Utils:
 
         frame = inspect.currentframe().f_back  # Get the caller's frame
 
-        module_list += core_modules  # Add core modules to the list
+        # Do not extend the default list, which is shared between calls
+        module_list = module_list + core_modules
 
         for name, alias in module_list:
             try:
-                module = importlib.import_module(name)
+                if lazy:
+                    # Fail early on missing modules without importing them
+                    if importlib.util.find_spec(name.split(".")[0]) is None:
+                        raise ImportError(f"No module named '{name}'")
+                    module = lazy_import(name)
+                else:
+                    module = importlib.import_module(name)
+
+                frame.f_globals[alias or name] = module
+                suffix = "" if is_loaded(module) else " (lazy)"
                 if alias:  # Import with alias
-                    frame.f_globals[alias] = importlib.__import__(
-                        name, fromlist=[alias]
-                    )
-                    print(f"{BULLET_POINT} {name} imported as {alias}")
+                    print(f"{BULLET_POINT} {name} imported as {alias}{suffix}")
                 else:
-                    frame.f_globals[name] = module  # Import without alias
-                    print(f"{BULLET_POINT} {name} imported")
+                    print(f"{BULLET_POINT} {name} imported{suffix}")
             except ImportError as e:
                 print(f"{BULLET_POINT} Error importing {name}: {e}")
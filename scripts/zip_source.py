@@ -0,0 +1,190 @@
+import io
+import os
+import re
+import zipfile
+import threading
+from functools import lru_cache
+from PIL import Image
+from scripts import constants as const
+
+# ZIP archives opened by this process, keyed by process id and archive path
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _is_archive(path):
+    """Check whether a path prefix is a ZIP archive on disk."""
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
+
+
+def split_archive_path(path):
+    """
+    Split a path pointing inside a ZIP archive, such as data_1.zip/raw/beds/Modern/1.jpg.
+
+    Parameters:
+        path (str): The image path.
+
+    Returns:
+        tuple: The archive path and the member name, or None if the path is not inside an archive.
+    """
+    parts = re.split(r"[\\/]", path)
+
+    for i, part in enumerate(parts[:-1]):
+        if part.lower().endswith(".zip"):
+            archive = os.sep.join(parts[: i + 1]) or os.sep
+            if _is_archive(archive):
+                return archive, "/".join(parts[i + 1 :])
+
+    return None
+
+
+def get_archive(archive):
+    """
+    Get the ZIP archive opened by the current process.
+
+    Handles are not shared across forked workers, as they would share the file offset.
+
+    Parameters:
+        archive (str): The path to the ZIP archive.
+
+    Returns:
+        tuple: The zipfile.ZipFile and the lock guarding its reads.
+    """
+    key = (os.getpid(), os.path.abspath(archive))
+
+    with _archives_lock:
+        if key not in _archives:
+            _archives[key] = (zipfile.ZipFile(archive, "r"), threading.Lock())
+        return _archives[key]
+
+
+def read_bytes(path):
+    """
+    Read the bytes of a file on disk or inside a ZIP archive.
+
+    Parameters:
+        path (str): The file path.
+
+    Returns:
+        bytes: The file content.
+    """
+    location = split_archive_path(path)
+
+    if location is None:
+        with open(path, "rb") as f:
+            return f.read()
+
+    archive, member = location
+    zip_ref, lock = get_archive(archive)
+    with lock:
+        return zip_ref.read(member)
+
+
+def open_image(path):
+    """
+    Open an image on disk or inside a ZIP archive.
+
+    Parameters:
+        path (str): The image path.
+
+    Returns:
+        PIL.Image.Image: The lazily decoded image.
+    """
+    if split_archive_path(path) is None:
+        return Image.open(path)
+
+    return Image.open(io.BytesIO(read_bytes(path)))
+
+
+def file_signature(path):
+    """
+    Get the (size, version) signature of a file used to detect changes.
+
+    Files on disk use their modification time, archive members their CRC.
+
+    Parameters:
+        path (str): The file path.
+
+    Returns:
+        tuple: The size and version of the file.
+    """
+    location = split_archive_path(path)
+
+    if location is None:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    archive, member = location
+    zip_ref, lock = get_archive(archive)
+    info = zip_ref.getinfo(member)
+    return info.file_size, info.CRC
+
+
+class ZipImageSource:
+    def __init__(self, path):
+        """
+        Image source reading the members of a ZIP archive without extracting it.
+
+        Parameters:
+            path (str): The path to the ZIP archive.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File not found: {path}")
+
+        self.path = path
+        self.entries = []
+
+        # Index the image members once
+        zip_ref, _ = get_archive(path)
+        for info in zip_ref.infolist():
+            parts = info.filename.split("/")
+            if info.is_dir() or "__MACOSX" in parts or parts[-1].startswith("."):
+                continue
+            if not parts[-1].lower().endswith(const.IMAGE_EXTENSIONS):
+                continue
+
+            # Members are laid out as .../<category>/<style>/<file>
+            category = parts[-3] if len(parts) >= 3 else ""
+            style = parts[-2] if len(parts) >= 2 else ""
+            self.entries.append((self.member_path(info.filename), category, style))
+
+    def member_path(self, member):
+        """
+        Get the path addressing a member of the archive.
+
+        Parameters:
+            member (str): The member name.
+
+        Returns:
+            str: The path, e.g. data_1.zip/raw/beds/Modern/1.jpg.
+        """
+        return os.path.join(self.path, *member.split("/"))
+
+    def paths(self, prefix=""):
+        """
+        Get the paths of the indexed images.
+
+        Parameters:
+            prefix (str): Only return the members starting with this prefix. Default is "".
+
+        Returns:
+            list of str: The image paths.
+        """
+        root = self.member_path(prefix) if prefix else self.path
+        return [path for path, _, _ in self.entries if path.startswith(root)]
+
+    def open(self, path):
+        """
+        Open one of the images, decoding it straight from the archive.
+
+        Parameters:
+            path (str): The image path.
+
+        Returns:
+            PIL.Image.Image: The lazily decoded image.
+        """
+        return open_image(path)
+
+    def __len__(self):
+        return len(self.entries)
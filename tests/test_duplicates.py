@@ -0,0 +1,80 @@
+import time
+import numpy as np
+import pytest
+from scripts.duplicates import DuplicateFinder, HammingIndex, group_pairs, popcount
+
+
+def random_hashes(count, seed=0):
+    """Draw well-spread 64-bit hashes, the worst case of the index."""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 2**63, count, dtype=np.uint64) * np.uint64(2) + rng.integers(
+        0, 2, count, dtype=np.uint64
+    )
+
+
+def brute_force_pairs(hashes, max_distance):
+    i, j = np.triu_indices(len(hashes), 1)
+    close = popcount(hashes[i] ^ hashes[j]) <= max_distance
+    return np.stack([i[close], j[close]], axis=1)
+
+
+@pytest.mark.parametrize("max_distance", [0, 1, 3, 4, 6, 8, 10, 12])
+def test_pairs_match_brute_force(max_distance):
+    rng = np.random.default_rng(1)
+    hashes = random_hashes(2000)
+
+    # Plant near duplicates at every distance
+    for _ in range(300):
+        i, j = rng.integers(len(hashes), size=2)
+        flips = rng.choice(64, rng.integers(0, 13), replace=False)
+        hashes[j] = hashes[i] ^ np.uint64(sum(1 << int(bit) for bit in flips))
+
+    pairs = HammingIndex(hashes, max_distance).pairs()
+
+    assert np.array_equal(pairs, brute_force_pairs(hashes, max_distance))
+
+
+@pytest.mark.parametrize("max_distance, max_probes, max_seconds", [(4, 100, 10), (10, 1000, 60)])
+def test_pairs_scale_to_100k_hashes(max_distance, max_probes, max_seconds):
+    hashes = random_hashes(100_000)
+    hashes[1] = hashes[0] ^ np.uint64((1 << max_distance) - 1)
+
+    index = HammingIndex(hashes, max_distance)
+    start = time.perf_counter()
+    pairs = index.pairs()
+    elapsed = time.perf_counter() - start
+
+    assert [0, 1] in pairs.tolist()
+    assert index.radius <= 2
+    assert index.probes <= max_probes
+    assert elapsed < max_seconds
+
+
+def test_group_pairs_builds_stars():
+    # 2 is close to 1 but not to 0: it must not join the group of 0
+    assert group_pairs(5, [(0, 1), (1, 2), (3, 4)]) == [[0, 1], [3, 4]]
+
+
+def test_popcount_table_matches_native(monkeypatch):
+    hashes = random_hashes(1000)
+    expected = [bin(int(value)).count("1") for value in hashes]
+
+    assert popcount(hashes).tolist() == expected
+
+    # NumPy 1.x has no bitwise_count
+    monkeypatch.delattr(np, "bitwise_count", raising=False)
+    assert popcount(hashes).tolist() == expected
+
+
+@pytest.mark.parametrize("candidate_distance, max_seconds", [(6, 10), (8, 30), (10, 60)])
+def test_ssim_candidates_scale_with_distance(candidate_distance, max_seconds):
+    hashes = random_hashes(100_000)
+
+    start = time.perf_counter()
+    HammingIndex(hashes, candidate_distance).pairs()
+
+    assert time.perf_counter() - start < max_seconds
+
+
+def test_default_candidate_distance():
+    assert DuplicateFinder(hash_type="ssim").candidate_distance == 8
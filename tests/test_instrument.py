@@ -0,0 +1,20 @@
+import sys
+import importlib
+import scripts.instrument
+
+
+def test_rss_without_resource(monkeypatch):
+    # Windows has no resource module and no /proc
+    monkeypatch.setitem(sys.modules, "resource", None)
+    instrument = importlib.reload(scripts.instrument)
+    try:
+        assert instrument.resource is None
+        monkeypatch.delattr(instrument.os, "sysconf")
+        assert instrument.rss_bytes() == 0
+    finally:
+        monkeypatch.undo()
+        importlib.reload(scripts.instrument)
+
+
+def test_rss_bytes():
+    assert scripts.instrument.rss_bytes() > 0
@@ -0,0 +1,47 @@
+import os
+import pandas as pd
+from scripts.synthetic import DatasetGenerator
+from scripts.manifest import ManifestBuilder
+from scripts.manifest_cache import ManifestCache
+
+
+def make_dataset(tmp_path, name, seed):
+    generator = DatasetGenerator(num_images=40, width=32, height=32, seed=seed, workers=1)
+    return generator.generate(str(tmp_path / name))["raw_dir"]
+
+
+def test_cached_frame_matches_uncached_build(tmp_path):
+    raw_dir = make_dataset(tmp_path, "data_x", seed=1)
+    builder = ManifestBuilder(workers=1)
+    cache = ManifestCache(str(tmp_path / "manifest.sqlite"))
+
+    uncached = builder.build(raw_dir)
+    cache.refresh(raw_dir, builder)
+    cached = cache.refresh(raw_dir, builder)
+
+    assert cache.stats()["hits"] == len(uncached)
+    assert cached.dtypes.to_dict() == uncached.dtypes.to_dict()
+    pd.testing.assert_frame_equal(cached, uncached)
+
+
+def test_shared_cache_keeps_the_rows_of_other_directories(tmp_path):
+    # The second directory name extends the first one, their keys must not mix
+    first = make_dataset(tmp_path, "data_1", seed=1)
+    second = make_dataset(tmp_path, "data_1_copy", seed=2)
+    builder = ManifestBuilder(workers=1)
+    cache = ManifestCache(str(tmp_path / "shared.sqlite"))
+
+    cache.refresh(first, builder)
+    cache.refresh(second, builder)
+    assert cache.stats()["removed"] == 0
+
+    for raw_dir in (first, second):
+        df = cache.refresh(raw_dir, builder)
+        assert cache.stats() == {"hits": len(df), "misses": 0, "removed": 0, "hit_rate": 1.0}
+
+    # Deleted files are still dropped from their own directory
+    os.remove(df["Path"].iloc[0])
+    cache.refresh(second, builder)
+    assert cache.stats()["removed"] == 1
+    cache.refresh(first, builder)
+    assert cache.stats()["misses"] == 0
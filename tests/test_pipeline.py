@@ -0,0 +1,6 @@
+from scripts.pipeline import process_context
+
+
+def test_stage_pools_do_not_fork():
+    # Stages run on threads, their worker processes must start from a clean process
+    assert process_context().get_start_method() in ("forkserver", "spawn")
@@ -0,0 +1,56 @@
+import os
+import time
+import threading
+import numpy as np
+from scripts.result_cache import ResultCache
+
+
+def disk_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+def make_cache(tmp_path, **kwargs):
+    model_path = tmp_path / "model.bin"
+    model_path.write_bytes(b"weights")
+    return ResultCache(str(tmp_path / "cache"), [str(model_path)], **kwargs)
+
+
+def test_concurrent_puts_keep_the_disk_bounded(tmp_path):
+    max_disk_bytes = 20_000
+    cache = make_cache(tmp_path, max_disk_bytes=max_disk_bytes, max_memory_bytes=1000)
+    threads = 8
+
+    def put_many(thread):
+        for i in range(200):
+            cache.put(f"{thread}-{i}".encode(), "beds", embedding=np.ones(256, np.float32))
+
+    workers = [threading.Thread(target=put_many, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    entry_size = max(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(tmp_path / "cache")
+        for name in names
+    )
+
+    # The tracked size is exact, and at most one entry per thread landed after the last prune
+    assert cache.disk_bytes == disk_size(tmp_path / "cache")
+    assert disk_size(tmp_path / "cache") <= max_disk_bytes + threads * entry_size
+
+
+def test_expired_results_are_not_served_from_memory(tmp_path):
+    cache = make_cache(tmp_path, max_age_seconds=0.2)
+    cache.put(b"image", "beds")
+
+    assert cache.get(b"image")["label"] == "beds"
+
+    time.sleep(0.3)
+    assert cache.get(b"image") is None
+    assert cache.memory_bytes == 0
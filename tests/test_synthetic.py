@@ -0,0 +1,24 @@
+import os
+import numpy as np
+from scripts.synthetic import DatasetGenerator, spread_duplicates
+
+
+def test_spread_duplicates_keeps_the_total():
+    counts = np.full(102, 5)
+    counts[:92] += 1
+
+    duplicates = spread_duplicates(round(602 * 0.05), counts)
+
+    assert duplicates.sum() == 30
+    assert duplicates.max() - duplicates.min() <= 1
+    assert (duplicates < counts).all()
+
+
+def test_generated_dataset_has_the_requested_duplicates(tmp_path):
+    generator = DatasetGenerator(num_images=500, width=32, height=32, duplicate_rate=0.05, workers=1)
+    report = generator.generate(str(tmp_path / "data_x"))
+
+    files = [name for _, _, names in os.walk(report["raw_dir"]) for name in names]
+    assert len(files) == 500
+    assert report["exact_duplicates"] + report["near_duplicates"] == 25
+    assert sum(name.startswith("dup_") for name in files) == 25